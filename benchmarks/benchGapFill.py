@@ -0,0 +1,105 @@
+#!/usr/local/lcls/package/python/current/bin/python
+############################################################################
+# Compares the old element-by-element nan padding against what a missed-pulse
+# callback costs now: PulseStore.advance moving the head past the dropped
+# shots, which evicts their rows (PulseStore._evictRows) from a full window
+# and its running statistics in one vectorized pass (plus, every window's
+# worth of evicted rows, the rebuild of the statistics that triggers). Each
+# "event" is one burst of dropped shots, timed on a fresh copy of the same
+# full window, for the A/B pair and for a correlation matrix's worth of
+# devices.
+#
+# Usage: python benchmarks/benchGapFill.py [numEvents]
+############################################################################
+
+from os import path
+from sys import argv, path as sysPath
+from timeit import default_timer
+
+from numpy import empty, nan, arange
+from numpy.random import RandomState
+
+sysPath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from rtbsaBuffer import PulseStore, HSTBR_LENGTH
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+BURST_SIZES = [1, 2, 10, 100, 1000, 2000, HSTBR_LENGTH - 1]
+
+# How many devices the store has, for B vs A and for the correlation matrix
+DEVICE_COUNTS = [2, 32]
+
+# Fiducials between shots at 120Hz
+STEP = 3
+
+
+# The implementation this replaced, kept here as the reference point
+def padWithNansLoop(dataBuffer, start, end):
+    for idx in xrange(start, end):
+        dataBuffer[idx] = nan
+
+
+# A full window of numDevices columns of noise, with the head on the shot
+# with key 0
+def genStore(numDevices, seed=0):
+    store = PulseStore(["D" + str(index) for index in range(numDevices)],
+                       HSTBR_LENGTH)
+    keys = STEP * arange(1 - HSTBR_LENGTH, 1)
+    noise = RandomState(seed).randn(HSTBR_LENGTH, numDevices)
+
+    for device, column in store.columns.items():
+        store.seed(device, noise[:, column], keys, STEP)
+
+    return store
+
+
+def timeLoop(burstSize, numEvents):
+    dataBuffer = empty(HSTBR_LENGTH)
+
+    begin = default_timer()
+    for _ in xrange(numEvents):
+        padWithNansLoop(dataBuffer, 0, burstSize)
+    return (default_timer() - begin) / numEvents
+
+
+# The next sample comes burstSize shots late, so burstSize - 1 shots were
+# missed and burstSize rows get evicted to make room
+def timeAdvance(full, store, burstSize, numEvents):
+    elapsed = 0.0
+
+    for _ in xrange(numEvents):
+        store.copyFrom(full)
+
+        begin = default_timer()
+        store.advance(burstSize * STEP, STEP)
+        elapsed += default_timer() - begin
+
+    return elapsed / numEvents
+
+
+def main():
+    numEvents = int(argv[1]) if len(argv) > 1 else 200
+
+    stores = [(genStore(numDevices), genStore(numDevices))
+              for numDevices in DEVICE_COUNTS]
+
+    print("{:>8} {:>10} ".format("burst", "loop (us)")
+          + " ".join("{:>16}".format("advance x{} (us)".format(numDevices))
+                     for numDevices in DEVICE_COUNTS))
+
+    for burstSize in BURST_SIZES:
+        times = [timeLoop(burstSize, numEvents)]
+        times += [timeAdvance(full, store, burstSize, numEvents)
+                  for full, store in stores]
+
+        print("{:>8} {:>10.2f} ".format(burstSize, times[0] * 1e6)
+              + " ".join("{:>16.2f}".format(time * 1e6)
+                         for time in times[1:]))
+
+
+if __name__ == "__main__":
+    main()
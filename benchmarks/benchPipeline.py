@@ -0,0 +1,440 @@
+#!/usr/local/lcls/package/python/current/bin/python
+############################################################################
+# Times the frames of every plot, stage by stage, on simulated data (see
+# rtbsaSource.SimulatedSource), going through the same engine the GUI uses:
+#
+#   acquire  the callbacks for one frame's worth of shots going into the
+#            raw buffers (the simulator generates them beforehand, so its own
+#            cost isn't counted)
+#   publish  copying the raw buffers into a snapshot
+#   sync     lining A and B up by pulse key (B vs A only)
+#   filter   the nan/hard limit/std dev cuts
+#   stats    the AVG/STD/correlation overlays, or the correlation matrix
+#   fit      the fit coefficients, and the fit curve on its grid
+#   spectrum the Welch spectrum (A FFT only)
+#   render   what gets handed to pyqtgraph: the min/max decimated curve, the
+#            density map, the waterfall or the correlation heatmap
+#
+# for every plot, number of points, fit order and with the std dev cut on or
+# off (the A FFT and the correlation matrix of MATRIX_SIZE PVs don't fit or
+# cut, so they only get run once per number of points). The latency
+# percentiles of each stage are printed and written out as JSON, along with
+# how far each stage pushes the traced memory above where it started (its
+# peak temporary memory, in bytes) if tracemalloc can track that, which
+# takes Python 3.9 and up. That isn't supported on Python 2.7 (which the GUI
+# runs on), where peakBytes is always null.
+#
+# Usage: python benchmarks/benchPipeline.py [--frames N] [--modes time,pairs]
+#            [--points 120,2800] [--orders 1,2] [--output results.json]
+#        python benchmarks/benchPipeline.py --compare old.json new.json
+############################################################################
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from json import dump, load
+from os import path
+from platform import platform, python_version
+from subprocess import CalledProcessError, check_output
+from sys import exit, path as sysPath
+from timeit import default_timer
+from warnings import simplefilter
+
+from numpy import (__version__ as numpyVersion, percentile, mean, median, std,
+                   nanmean, nanstd, corrcoef, polyval, log1p, nan_to_num)
+
+# numpy 2 only has it in numpy.exceptions (which is new in 1.25)
+try:
+    from numpy.exceptions import RankWarning
+except ImportError:
+    from numpy import RankWarning
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sysPath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from rtbsaEngine import Engine, EngineConfig
+from rtbsaRender import decimateMinMax, DENSITY_MAP_THRESHOLD
+from rtbsaSource import SimulatedSource
+from rtbsaStats import MAX_FIT_ORDER
+
+MODES = ["time", "pairs", "fft", "matrix"]
+POINT_COUNTS = [120, 2800, 30000, 300000]
+FIT_ORDERS = list(range(1, MAX_FIT_ORDER + 1))
+
+DEVICES = {"A": "GDET:FEE1:241:ENRC", "B": "GDET:FEE1:242:ENRC"}
+
+# How many PVs the correlation matrix is of (about as many as the common
+# list), and what they're called
+MATRIX_SIZE = 32
+MATRIX_PVS = ["BENCH:MATRIX:{}:VAL".format(i) for i in range(MATRIX_SIZE)]
+
+RATE = 120.0
+
+# One 50ms frame at 120Hz
+SHOTS_PER_FRAME = 6
+
+# How wide the plot is taken to be, in pixels
+PLOT_WIDTH = 1000
+
+PERCENTILES = [50, 90, 99]
+
+# How much slower (as a fraction) counts as a regression in --compare
+REGRESSION_THRESHOLD = 0.1
+
+
+############################################################################
+# Times (and optionally tracks the peak memory of) each stage of a frame. A
+# stage's peak is how far the memory tracemalloc traces went above where it
+# was when the stage started, which is what the stage's temporaries cost
+# rather than a count of allocations. Peaks are tracked on separate frames
+# from the timed ones, since tracemalloc slows everything down.
+############################################################################
+class StageTimer(object):
+
+    def __init__(self, trackPeaks=False):
+        self.trackPeaks = trackPeaks
+        self.times = OrderedDict()
+        self.peaks = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        if self.trackPeaks:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        begin = default_timer()
+        try:
+            yield
+        finally:
+            self.times.setdefault(name, []).append(default_timer() - begin)
+
+            if self.trackPeaks:
+                self.peaks.setdefault(name, []).append(
+                    tracemalloc.get_traced_memory()[1] - before)
+
+
+############################################################################
+# One plot, set up the way the GUI sets it up: the history buffers first,
+# cut down to numPoints, then the BR PVs
+############################################################################
+class PipelineBench(object):
+
+    def __init__(self, mode, numPoints, fitOrder, stdDevCut, seed=0):
+        self.mode = mode
+        self.fitOrder = fitOrder
+
+        self.source = SimulatedSource(rate=RATE, seed=seed,
+                                      historyLength=numPoints)
+
+        config = EngineConfig(numPoints=numPoints, fitOrder=fitOrder or 2)
+        config.devices.update(DEVICES)
+        config.stdDevCut = stdDevCut
+
+        self.engine = Engine(config, lambda: self.source.rate,
+                             capacity=numPoints)
+        self.acquisition = self.engine.acquisition
+
+        if mode == "matrix":
+            self.engine.setDevices(list(DEVICES.items())
+                                   + [(pv, pv) for pv in MATRIX_PVS])
+            self.devices = MATRIX_PVS
+        else:
+            self.devices = ["A", "B"] if mode == "pairs" else ["A"]
+
+        # The callbacks the simulator has fired that haven't been fed to the
+        # acquisition worker yet
+        self.pending = []
+
+        # What the last frame's AVG/STD/correlation overlays would have shown,
+        # when they weren't the running statistics
+        self.overlays = None
+
+        self.connect("HSTBR")
+        self.source.advanceShots(1)
+        self.feed()
+
+        self.acquisition.truncate(numPoints)
+
+        self.connect("BR")
+
+    def connect(self, suffix):
+        for device in self.devices:
+            pvName = self.engine.config.devices[device]
+            self.source.pv(pvName + "HSTBR").clear_callbacks()
+            self.source.pv(pvName + "BR").clear_callbacks()
+
+            # noinspection PyUnusedLocal
+            def callback(pvname=None, value=None, timestamp=None,
+                         device=device, **kw):
+                self.pending.append((device, pvname, timestamp, value,
+                                     kw.get("nanoseconds")))
+
+            self.source.pv(pvName + suffix).add_callback(callback)
+
+    def feed(self):
+        for sample in self.pending:
+            self.acquisition.updateTimeAndBuffer(*sample)
+        self.pending = []
+
+    def frame(self, timer):
+        self.source.advanceShots(SHOTS_PER_FRAME)
+
+        with timer.stage("acquire"):
+            self.feed()
+
+        with timer.stage("publish"):
+            self.acquisition.publish()
+
+        getattr(self, self.mode + "Frame")(timer)
+
+    def fit(self, xData, yData, useRunningFit):
+        co = self.engine.fitCoefficients(xData, yData, self.fitOrder,
+                                         useRunningFit)
+        return polyval(co, self.engine.fitGrid(xData))
+
+    def timeFrame(self, timer):
+        engine = self.engine
+
+        with timer.stage("filter"):
+            xData, yData = engine.timeSeries()
+
+        with timer.stage("stats"):
+            useRunningStats = engine.runningStatsApply(engine.timePlotFilter)
+            if not useRunningStats:
+                self.overlays = mean(yData), std(yData)
+
+        with timer.stage("fit"):
+            self.fit(xData, yData, useRunningStats)
+
+        with timer.stage("render"):
+            decimateMinMax(xData, yData, PLOT_WIDTH)
+
+    def pairsFrame(self, timer):
+        engine = self.engine
+
+        with timer.stage("sync"):
+            engine.synchronize()
+
+        with timer.stage("filter"):
+            bufferA, bufferB = engine.pairs()
+
+        with timer.stage("stats"):
+            useRunningStats = engine.runningStatsApply(engine.pairFilter)
+            if not useRunningStats:
+                self.overlays = (nanmean(bufferB), nanstd(bufferB),
+                                 corrcoef(bufferA, bufferB).item(1))
+
+        with timer.stage("fit"):
+            self.fit(bufferA, bufferB, useRunningStats)
+
+        with timer.stage("render"):
+            if bufferA.size > DENSITY_MAP_THRESHOLD:
+                log1p(engine.pairDensity(bufferA, bufferB).counts)
+
+    def fftFrame(self, timer):
+        with timer.stage("spectrum"):
+            self.engine.updateSpectrum(RATE)
+
+        with timer.stage("render"):
+            self.engine.spectrogram.ordered()
+
+    def matrixFrame(self, timer):
+        with timer.stage("stats"):
+            matrix = self.engine.correlationMatrix(MATRIX_PVS)
+
+        with timer.stage("render"):
+            nan_to_num(matrix)
+
+
+def summarize(samples, scale):
+    samples = [sample * scale for sample in samples]
+    summary = OrderedDict(("p" + str(p), float(percentile(samples, p)))
+                          for p in PERCENTILES)
+    summary["mean"] = float(mean(samples))
+    summary["max"] = float(max(samples))
+    return summary
+
+
+def runBench(mode, numPoints, fitOrder, stdDevCut, numFrames, numWarmup):
+    bench = PipelineBench(mode, numPoints, fitOrder, stdDevCut)
+
+    for _ in range(numWarmup):
+        bench.frame(StageTimer())
+
+    timer = StageTimer()
+    for _ in range(numFrames):
+        bench.frame(timer)
+
+    totals = [sum(times) for times in zip(*timer.times.values())]
+
+    result = OrderedDict([("mode", mode), ("numPoints", numPoints),
+                          ("fitOrder", fitOrder), ("stdDevCut", stdDevCut),
+                          ("frames", numFrames)])
+
+    # In microseconds
+    result["stages"] = OrderedDict((name, summarize(times, 1e6))
+                                   for name, times in timer.times.items())
+    result["total"] = summarize(totals, 1e6)
+
+    # tracemalloc.reset_peak is new in Python 3.9, and Python 2 doesn't
+    # have tracemalloc at all, so there are no peaks under either
+    result["peakBytes"] = None
+    if tracemalloc is not None and hasattr(tracemalloc, "reset_peak"):
+        peakTimer = StageTimer(trackPeaks=True)
+        tracemalloc.start()
+        try:
+            for _ in range(max(1, numFrames // 10)):
+                bench.frame(peakTimer)
+        finally:
+            tracemalloc.stop()
+
+        result["peakBytes"] = OrderedDict(
+            (name, int(median(sizes)))
+            for name, sizes in peakTimer.peaks.items())
+
+    return result
+
+
+def configurations(modes, pointCounts, fitOrders):
+    for mode in modes:
+        for numPoints in pointCounts:
+            if mode in ("fft", "matrix"):
+                yield mode, numPoints, None, False
+                continue
+
+            for fitOrder in fitOrders:
+                for stdDevCut in (False, True):
+                    yield mode, numPoints, fitOrder, stdDevCut
+
+
+def gitRevision():
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"],
+                            cwd=path.dirname(path.abspath(__file__))
+                            ).decode().strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def configName(result):
+    return "{:>5} {:>6} {:>5} {:>5}".format(
+        result["mode"], result["numPoints"],
+        "-" if result["fitOrder"] is None else result["fitOrder"],
+        "cut" if result["stdDevCut"] else "")
+
+
+def printResult(result):
+    stages = " ".join("{}={:.0f}".format(name, summary["p50"])
+                      for name, summary in result["stages"].items())
+    print("{} {:>10.0f} {:>10.0f}   {}".format(
+        configName(result), result["total"]["p50"], result["total"]["p99"],
+        stages))
+
+
+############################################################################
+# Lines up the results of two runs by configuration and compares the median
+# frame time. Returns how many configurations got slower than the threshold
+############################################################################
+def compare(oldFile, newFile, threshold):
+    with open(oldFile) as f:
+        old = load(f)
+    with open(newFile) as f:
+        new = load(f)
+
+    def key(result):
+        return (result["mode"], result["numPoints"], result["fitOrder"],
+                result["stdDevCut"])
+
+    oldResults = dict((key(result), result) for result in old["results"])
+
+    print("{} vs {}".format(old["meta"]["revision"], new["meta"]["revision"]))
+    print("{:>25} {:>10} {:>10} {:>7}".format("config", "old p50",
+                                               "new p50", "ratio"))
+
+    regressions = 0
+    for result in new["results"]:
+        oldResult = oldResults.get(key(result))
+        if oldResult is None:
+            continue
+
+        oldTime = oldResult["total"]["p50"]
+        newTime = result["total"]["p50"]
+        ratio = newTime / oldTime if oldTime else float("inf")
+
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        print("{} {:>10.0f} {:>10.0f} {:>6.2f}x{}".format(
+            configName(result), oldTime, newTime, ratio, flag))
+
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Per-stage frame timings")
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--points",
+                        default=",".join(str(n) for n in POINT_COUNTS))
+    parser.add_argument("--orders",
+                        default=",".join(str(n) for n in FIT_ORDERS))
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float,
+                        default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    # The high order fits of pure noise are badly conditioned, which is fine
+    # for timing them
+    simplefilter("ignore", RankWarning)
+
+    if args.compare:
+        exit(1 if compare(args.compare[0], args.compare[1],
+                          args.threshold) else 0)
+
+    modes = args.modes.split(",")
+    pointCounts = [int(n) for n in args.points.split(",")]
+    fitOrders = [int(n) for n in args.orders.split(",")]
+
+    revision = gitRevision()
+    started = datetime.now()
+
+    meta = OrderedDict([("revision", revision),
+                        ("date", started.isoformat()),
+                        ("python", python_version()),
+                        ("numpy", numpyVersion),
+                        ("platform", platform()),
+                        ("frames", args.frames),
+                        ("shotsPerFrame", SHOTS_PER_FRAME),
+                        ("rate", RATE),
+                        ("units", "microseconds")])
+
+    print("{:>25} {:>10} {:>10}   stage p50s (us)".format(
+        "config", "p50 (us)", "p99 (us)"))
+
+    results = []
+    for configuration in configurations(modes, pointCounts, fitOrders):
+        result = runBench(*(configuration + (args.frames, args.warmup)))
+        printResult(result)
+        results.append(result)
+
+    output = args.output or "pipeline-{}-{}.json".format(
+        revision or "unknown", started.strftime("%Y%m%d-%H%M%S"))
+
+    with open(output, "w") as f:
+        dump(OrderedDict([("meta", meta), ("results", results)]), f,
+             indent=2)
+
+    print("Wrote " + output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/local/lcls/package/python/current/bin/python
+############################################################################
+# Times a correlation scan (rtbsaScan.CorrelationScan) of numPVs simulated
+# BSA PVs against a target, with the simulator running in real time at
+# 120Hz, for a few different maximum lags. Fetching is most of it, since
+# every history buffer only comes in on the shot after it's subscribed to.
+#
+# Usage: python benchmarks/benchScan.py [numPVs]
+############################################################################
+
+from math import isnan
+from os import path
+from sys import argv, path as sysPath
+from timeit import default_timer
+
+sysPath.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from rtbsaScan import CorrelationScan
+from rtbsaSource import SimulatedSource, PVPool
+
+MAX_LAGS = [0, 5, 20]
+
+
+def main():
+    numPVs = int(argv[1]) if len(argv) > 1 else 1000
+    pvs = ["BENCH:SCAN:{}:VAL".format(index) for index in range(numPVs)]
+
+    source = SimulatedSource(rate=120.0)
+    source.start()
+
+    print("{:>8} {:>10} {:>12} {:>10}".format("max lag", "total (s)",
+                                              "PVs/s", "ranked"))
+
+    try:
+        for maxLag in MAX_LAGS:
+            scan = CorrelationScan(PVPool(source), lambda: source.rate,
+                                   "BENCH:SCAN:TARGET:VAL", pvs,
+                                   maxLag=maxLag)
+
+            begin = default_timer()
+            for _ in scan.run():
+                pass
+            elapsed = default_timer() - begin
+
+            ranked = sum(1 for result in scan.results
+                         if not isnan(result.correlation))
+
+            print("{:>8} {:>10.2f} {:>12.0f} {:>10}".format(
+                maxLag, elapsed, numPVs / elapsed, ranked))
+
+    finally:
+        source.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,101 @@
 #!/usr/local/lcls/package/python/current/bin/python
 # Written by Zimmer, edited by Ahmed, refactored by Lisa
 
+from functools import partial
 from os import path
 from sys import argv, exit
 from time import time
 
-from epics import PV
-
 # TODO import these with the namespace
-from numpy import (polyfit, poly1d, polyval, corrcoef, std, mean, concatenate,
-                   empty, nan, zeros, isnan, linalg, abs,
-                   fft, argsort, interp, arange, nanmin, nanmax)
+from numpy import (poly1d, polyval, corrcoef, std, mean, linalg, arange,
+                   nanmin, nanmax, log1p, nan_to_num, absolute, isnan)
 
-from PyQt4.QtCore import QTimer, QObject, SIGNAL, Qt
+from PyQt4.QtCore import (QTimer, QObject, QEventLoop, SIGNAL, Qt,
+                          pyqtSignal, QRectF)
 from PyQt4.QtGui import (QMainWindow, QLabel, QGridLayout, QPalette,
-                         QApplication, QAction, QFileDialog, QIcon, QMessageBox)
-from pyqtgraph import PlotWidget, PlotCurveItem, ScatterPlotItem, TextItem
+                         QApplication, QAction, QFileDialog, QIcon, QMessageBox,
+                         QInputDialog, QProgressDialog)
+from pyqtgraph import (PlotWidget, PlotCurveItem, ScatterPlotItem, TextItem,
+                       ImageItem)
 
 from scipy.stats import nanmean, nanstd
 from subprocess import CalledProcessError, check_output
 
 from rtbsa_UI import Ui_RTBSA
+from rtbsaBuffer import MAX_HISTORY_LENGTH
+from rtbsaEngine import Engine, EngineConfig
+from rtbsaRender import DENSITY_MAP_THRESHOLD
+from rtbsaScan import CorrelationScan
+from rtbsaScheduler import FrameScheduler
+from rtbsaTiming import StageTimings
+import rtbsaRender
+import rtbsaSource
 import rtbsaUtils
 
+# How often the frame timings on screen get refreshed, in milliseconds
+TIMING_REFRESH_INTERVAL = 1000
+
+# How often the frame timings get printed while a plot's running, in seconds
+TIMING_LOG_INTERVAL = 60
+
+# How many of the best correlated PVs a scan offers to plot
+SCAN_RESULTS_SHOWN = 50
+
+
+############################################################################
+# Painting happens in the event loop some time after a frame has handed
+# pyqtgraph its data, so it gets timed here rather than in the update methods
+############################################################################
+class TimedPlotWidget(PlotWidget):
+
+    timings = None
+
+    def paintEvent(self, event):
+        if self.timings is None:
+            return PlotWidget.paintEvent(self, event)
+
+        with self.timings.stage("paint"):
+            return PlotWidget.paintEvent(self, event)
+
+
+############################################################################
+# The acquisition worker and the rate PV call us back from their own threads.
+# Emitting one of these hands the notification over to the GUI thread (Qt
+# queues signals that cross threads), which is what lets us sleep in an event
+# loop instead of spinning while we wait for data or beam.
+############################################################################
+class AcquisitionSignals(QObject):
+    historyReceived = pyqtSignal(str)
+    rateChanged = pyqtSignal()
+    stopped = pyqtSignal()
+
 
 # noinspection PyArgumentList,PyCompatibility
 class RTBSA(QMainWindow):
 
-    def __init__(self, parent=None):
+    # source is where the PVs come from (Channel Access by default, see
+    # rtbsaSource)
+    def __init__(self, parent=None, source=None):
         QMainWindow.__init__(self, parent)
+        self.source = source or rtbsaSource.EpicsSource()
         self.help_menu = self.menuBar().addMenu("&Help")
         self.file_menu = self.menuBar().addMenu("&File")
+        self.view_menu = self.menuBar().addMenu("&View")
         self.status_text = QLabel()
-        self.plot = PlotWidget(alpha=0.75)
+        self.filterStatus = QLabel()
+        self.timingStatus = QLabel()
+
+        # Rolling timings of each stage of the plot updates, and of the CA
+        # callbacks
+        self.timings = StageTimings()
+
+        self.plot = TimedPlotWidget(alpha=0.75)
+        self.plot.timings = self.timings
+        self.timingOverlay = QLabel(self.plot)
+        self.timingOverlay.setStyleSheet(
+            'QLabel{background-color:rgba(0,0,0,160);color:white;padding:4px}')
+        self.timingOverlay.move(60, 10)
+        self.timingOverlay.hide()
         self.ui = Ui_RTBSA()
         self.ui.setupUi(self)
         self.setWindowTitle('Real Time BSA')
@@ -45,64 +108,94 @@ class RTBSA(QMainWindow):
         self.populateBSAPVs()
         self.connectGuiFunctions()
 
-        # Initial number of points
-        self.numPoints = 2800
+        # The PVs the correlation matrix is shown for
+        self.matrixPVs = list(rtbsaUtils.commonlist)
 
-        # Initial number of standard deviations
-        self.stdDevstoKeep = 3.0
+        # Everything the analysis needs to know about the settings. The
+        # initial number of points is 2800, with a 3 standard deviation cut
+        # and a polynomial fit of order 2
+        self.config = EngineConfig(numPoints=2800, stdDevsToKeep=3.0,
+                                   fitOrder=2,
+                                   hardLimits=rtbsaUtils.hardLimits)
 
         # 20ms polling time
         self.updateTime = 50
 
-        # Set initial polynomial fit to 2
-        self.fitOrder = 2
+        # How long to wait for the HSTBR PVs before giving up, in seconds
+        self.historyTimeout = 10
 
         self.disableInputs()
         self.abort = True
 
-        # Used to update plot
+        # Used to restart the plot after a settings change
         self.timer = QTimer(self)
 
-        self.ratePV = PV('IOC:IN20:EV01:RG01_ACTRATE')
+        self.signals = AcquisitionSignals(self)
+        self.signals.rateChanged.connect(self.rateChanged)
 
-        self.menuBar().setStyleSheet('QWidget{background-color:grey;color:purple}')
-        self.create_menu()
-        self.create_status_bar()
+        # Calls the update method for whichever plot is running. Frames get
+        # skipped when there's no new data or settings since the last one
+        self.scheduler = FrameScheduler(self, self.frameKey, self.getRate,
+                                        minInterval=self.updateTime,
+                                        timings=self.timings)
+
+        self.timingTimer = QTimer(self)
+        self.timingTimer.timeout.connect(self.refreshTimings)
+        self.timingTimer.start(TIMING_REFRESH_INTERVAL)
+        self.lastTimingLog = time()
 
-        # The PV names
-        self.devices = {"A": "", "B": ""}
+        self.ratePV = self.source.pv(rtbsaSource.RATE_PV)
+        self.ratePV.add_callback(self.rateCallback)
 
-        self.pvObjects = {"A": None, "B": None}
+        # Keeps the device PVs connected between plots, starting with the
+        # common ones, so picking a new one doesn't have to wait on CA
+        self.pvPool = rtbsaSource.PVPool(self.source)
+        self.pvPool.preconnect([pv + "BR" for pv in rtbsaUtils.commonlist])
 
-        # The raw, unsynchronized, unfiltered buffers
-        self.rawBuffers = {"A": empty(2800), "B": empty(2800)}
+        self.menuBar().setStyleSheet('QWidget{background-color:grey;color:purple}')
+        self.create_menu()
+        self.create_status_bar()
+        self.settingsChanged()
 
-        # The times when each buffer finished its last data acquisition
-        self.timeStamps = {"A": None, "B": None}
+        self.subscriptions = dict.fromkeys(self.config.devices)
 
-        self.synchronizedBuffers = {"A": empty(2800), "B": empty(2800)}
+        # The HSTBR subscriptions filling in the histories that came out of
+        # the cache, by device
+        self.gapFills = {}
 
-        # Versions of data buffers A and B that are filtered by standard
-        # deviation. Didn't want to edit those buffers directly so that we could
-        # unfilter or refilter with a different number more efficiently
-        self.filteredBuffers = {"A": empty(2800), "B": empty(2800)}
+        # Does all the buffering, synchronizing, filtering and fitting. The
+        # raw buffers are fed from the CA thread, and the plots only ever
+        # read the snapshots they're published in
+        self.engine = Engine(self.config, self.getRate,
+                             publishInterval=self.updateTime / 1000.0)
+        self.engine.acquisition.historyListeners.append(
+            self.signals.historyReceived.emit)
+        self.signals.historyReceived.connect(self.endGapFill)
+        self.engine.acquisition.timings = self.timings
+        self.engine.start()
 
         # Text objects that appear on the plot
         self.text = {"avg": None, "std": None, "slope": None, "corr": None}
 
         # All things plot related!
         self.plotAttributes = {"curve": None, "fit": None, "parab": None,
-                               "frequencies": None}
-
-        # Used for the kill swtich
-        self.counter = {"A": 0, "B": 0}
+                               "frequencies": None, "density": None,
+                               "waterfall": None, "matrix": None}
 
-        # Used to implement scrolling for time plots
-        self.currIdx = {"A": 0, "B": 0}
 
     def getRate(self):
         return rtbsaUtils.rateDict[self.ratePV.value]
 
+    # noinspection PyUnusedLocal
+    def rateCallback(self, **kw):
+        self.signals.rateChanged.emit()
+
+    # Picks the plot back up if it was parked waiting for beam
+    def rateChanged(self):
+        if self.scheduler.paused and not self.abort and self.getRate() >= 1:
+            self.printStatus("Running", False)
+            self.scheduler.resume()
+
     def disableInputs(self):
         self.ui.fitOrder.setDisabled(True)
         self.ui.searchInputA.setDisabled(True)
@@ -170,6 +263,12 @@ class RTBSA(QMainWindow):
         self.ui.checkBoxLinFit.clicked.connect(self.line_click)
         self.ui.checkBoxShowGrid.clicked.connect(self.showGrid)
 
+        # Settings that change what gets drawn without restarting the plot
+        for checkBox in [self.ui.checkBoxShowAve, self.ui.checkBoxShowStdDev,
+                         self.ui.checkBoxCorrCoeff, self.ui.checkBoxStdDev,
+                         self.ui.checkBoxAutoscale]:
+            checkBox.clicked.connect(self.settingsChanged)
+
         # All the buttons in the Controls section
         self.ui.startButton.clicked.connect(self.initializePlot)
         self.ui.stopButton.clicked.connect(self.stop)
@@ -191,6 +290,8 @@ class RTBSA(QMainWindow):
         # updating the plot
         self.ui.numPoints.returnPressed.connect(self.points_entered)
         self.ui.numStdDevs.returnPressed.connect(self.stdDevEntered)
+        self.ui.numStdDevs.returnPressed.connect(self.settingsChanged)
+        self.ui.fitOrder.returnPressed.connect(self.settingsChanged)
 
         # Triggers a redrawing upon pressing enter in the search bar.
         # Proper usage should be using the search bar to search, and selecting
@@ -199,6 +300,28 @@ class RTBSA(QMainWindow):
         self.ui.searchInputA.returnPressed.connect(self.inputActivated)
         self.ui.searchInputB.returnPressed.connect(self.inputActivated)
 
+    # Copies the settings that change what's drawn (without restarting the
+    # plot) into the config, so the plots know to redraw even if there's no
+    # new data
+    def settingsChanged(self, *args):
+        self.config.stdDevCut = self.ui.checkBoxStdDev.isChecked()
+        self.config.robustCut = self.robustCutAction.isChecked()
+        self.config.densityMap = self.densityMapAction.isChecked()
+        self.config.waterfall = self.waterfallAction.isChecked()
+        self.config.changed()
+
+    # What a frame of the current plot depends on. The scheduler only redraws
+    # when this changes
+    def frameKey(self):
+        if self.correlationMatrixAction.isChecked():
+            devices = self.matrixPVs
+        elif self.ui.checkBoxBvsA.isChecked():
+            devices = ["A", "B"]
+        else:
+            devices = ["A"]
+
+        return self.engine.frameKey(devices)
+
     def showGrid(self):
         self.plot.showGrid(self.ui.checkBoxShowGrid.isChecked(),
                            self.ui.checkBoxShowGrid.isChecked())
@@ -223,6 +346,9 @@ class RTBSA(QMainWindow):
         palette = QPalette()
         palette.setColor(palette.Foreground, Qt.magenta)
         self.statusBar().addWidget(self.status_text, 1)
+        self.statusBar().addPermanentWidget(self.filterStatus)
+        self.statusBar().addPermanentWidget(self.timingStatus)
+        self.timingStatus.hide()
         self.statusBar().setPalette(palette)
 
     # Effectively an autocomplete
@@ -263,17 +389,17 @@ class RTBSA(QMainWindow):
 
     def correctNumpoints(self, errorMessage, acceptableValue):
         self.correctInput(errorMessage, str(acceptableValue), self.ui.numPoints)
-        self.numPoints = acceptableValue
+        self.config.numPoints = acceptableValue
 
     def correctStdDevs(self, errorMessage, acceptableValue):
         self.correctInput(errorMessage, str(acceptableValue),
                           self.ui.numStdDevs)
-        self.stdDevstoKeep = acceptableValue
+        self.config.stdDevsToKeep = acceptableValue
 
     def stdDevEntered(self):
         try:
-            self.stdDevstoKeep = float(self.ui.numStdDevs.text())
-            if self.stdDevstoKeep <= 0:
+            self.config.stdDevsToKeep = float(self.ui.numStdDevs.text())
+            if self.config.stdDevsToKeep <= 0:
                 raise ValueError
         except ValueError:
             self.correctStdDevs('Enter a float > 0', 3.0)
@@ -281,19 +407,24 @@ class RTBSA(QMainWindow):
 
     def points_entered(self):
         try:
-            self.numPoints = int(self.ui.numPoints.text())
+            self.config.numPoints = int(self.ui.numPoints.text())
         except ValueError:
-            self.correctNumpoints('Enter an integer, 1 to 2800', 120)
+            self.correctNumpoints('Enter an integer, 1 to '
+                                  + str(MAX_HISTORY_LENGTH), 120)
             return
 
-        if self.numPoints > 2800:
-            self.correctNumpoints('Max # points is 2800', 2800)
+        if self.config.numPoints > MAX_HISTORY_LENGTH:
+            self.correctNumpoints('Max # points is ' + str(MAX_HISTORY_LENGTH),
+                                  MAX_HISTORY_LENGTH)
             return
 
-        if self.numPoints < 1:
+        if self.config.numPoints < 1:
             self.correctNumpoints('Min # points is 1', 1)
             return
 
+        # The raw window (and so the running statistics) has to match what
+        # gets plotted. Growing it pads it with nans that BR data fills in
+        self.engine.acquisition.truncate(self.config.numPoints)
         self.reinitialize_plot()
 
     ############################################################################
@@ -301,7 +432,8 @@ class RTBSA(QMainWindow):
     # initializes the BSA plotting and then starts a timer to update the plot.
     ############################################################################
     def initializePlot(self):
-        plotTypeIsValid = (self.ui.checkBoxAvsT.isChecked()
+        showMatrix = self.correlationMatrixAction.isChecked()
+        plotTypeIsValid = (showMatrix or self.ui.checkBoxAvsT.isChecked()
                            or self.ui.checkBoxBvsA.isChecked()
                            or self.ui.checkBoxFFT.isChecked())
 
@@ -314,10 +446,19 @@ class RTBSA(QMainWindow):
         self.abort = False
 
         self.cleanPlot()
-        self.pvObjects["A"], self.pvObjects["B"] = None, None
+
+        # The matrix gets a column of the raw buffers for each of its PVs
+        self.watchDevices(self.matrixPVs if showMatrix else ())
+        self.subscriptions = dict.fromkeys(self.config.devices)
+
+        # Correlation matrix of however many PVs
+        if showMatrix:
+            if self.initializeBuffers(self.matrixPVs):
+                self.genPlotAndSetTimer(self.genCorrelationMatrix,
+                                        self.updateCorrelationMatrix)
 
         # Plot history buffer for one PV
-        if self.ui.checkBoxAvsT.isChecked():
+        elif self.ui.checkBoxAvsT.isChecked():
             if self.populateDevices(self.ui.dropdownButtonA, self.ui.dropdownA,
                                     self.ui.searchButtonA, self.ui.searchInputA,
                                     "A"):
@@ -341,14 +482,14 @@ class RTBSA(QMainWindow):
     def populateDevices(self, common_rb, common, enter_rb, enter, device):
 
         if common_rb.isChecked():
-            self.devices[device] = str(common.currentText())
+            self.config.devices[device] = str(common.currentText())
 
         elif enter_rb.isChecked():
             pv = str(enter.text()).strip()
 
             # Checks that it's non empty and that it's a BSA pv
             if pv and pv in self.bsapvs:
-                self.devices[device] = pv
+                self.config.devices[device] = pv
             else:
                 self.printStatus('Device ' + device + ' invalid. Aborting.')
                 self.ui.startButton.setEnabled(True)
@@ -374,263 +515,185 @@ class RTBSA(QMainWindow):
                                     "B"):
             return False
 
-        self.printStatus("Initializing/Synchronizing " + self.devices["A"]
-                         + " vs. " + self.devices["B"] + " buffers...")
-
-        self.initializeBuffers()
-
-        return True
-
-    def initializeBuffers(self):
-        # Initial population of our buffers using the HSTBR PV's in our
-        # callback functions
-        self.clearAndUpdateCallbacks("HSTBR", resetTime=True)
-
-        while ((not self.timeStamps["A"] or not self.timeStamps["B"])
-               and not self.abort):
-            QApplication.processEvents()
+        self.printStatus("Initializing/Synchronizing "
+                         + self.config.devices["A"] + " vs. "
+                         + self.config.devices["B"] + " buffers...")
+
+        return self.initializeBuffers()
+
+    def initializeBuffers(self, devices=("A", "B")):
+        # Initial population of our buffers from the history cache, or else
+        # using the HSTBR PV's in our callback functions
+        self.loadHistories(devices)
+
+        pvs = [self.config.devices[device] for device in devices]
+        timeStamps = self.engine.acquisition.timeStamps
+        if not self.waitFor(lambda: all(timeStamps[device]
+                                        for device in devices),
+                            [self.signals.historyReceived],
+                            self.historyTimeout,
+                            "Waiting for "
+                            + (" and ".join(pvs) if len(pvs) <= 2
+                               else str(len(pvs)) + " PVs'")
+                            + " history buffers..."):
+            self.historyTimedOut()
+            return False
 
-        self.adjustSynchronizedBuffers(True)
+        # Only keep the newest numPoints of each history buffer, so the
+        # running statistics cover the same window that gets plotted (this
+        # also makes sure the history buffers made it into a snapshot). If
+        # numPoints is more than the history buffer holds, the window starts
+        # out padded with nans and fills in as BR data comes in
+        self.engine.acquisition.truncate(self.config.numPoints)
+        self.engine.synchronize(devices)
 
         # Switch to BR PVs to avoid pulling an entire history buffer on every
-        # update.
-        self.clearAndUpdateCallbacks("BR", resetRawBuffer=True)
-
-    def clearAndUpdateCallbacks(self, suffix, resetTime=False,
-                                resetRawBuffer=False):
-        self.clearAndUpdateCallback("A", suffix, self.callbackA,
-                                    self.devices["A"], resetTime,
-                                    resetRawBuffer)
-        self.clearAndUpdateCallback("B", suffix, self.callbackB,
-                                    self.devices["B"], resetTime,
-                                    resetRawBuffer)
-
-    # noinspection PyTypeChecker
-    def clearAndUpdateCallback(self, device, suffix, callback, pvName,
-                               resetTime=False, resetRawBuffer=False):
-        self.clearPV(device)
-
-        # Without the time parameter, we wouldn't get the timestamp
-        self.pvObjects[device] = PV(pvName + suffix, form='time')
-
-        if resetTime:
-            self.timeStamps[device] = None
-
-        # Make sure that the initial raw buffer is synchronized and pad with
-        # nans if it's less than 2800 points long
-        if resetRawBuffer:
-            nanArray = empty(2800 - self.synchronizedBuffers[device].size)
-            nanArray[:] = nan
-            self.rawBuffers[device] = \
-                concatenate([self.synchronizedBuffers[device], nanArray])
-
-        self.pvObjects[device].add_callback(callback)
-
-    # Callback function for Device A
-    # noinspection PyUnusedLocal
-    def callbackA(self, pvname=None, value=None, timestamp=None, **kw):
-        self.updateTimeAndBuffer("A", pvname, timestamp, value)
+        # update. The pulse keys carry on from where the history left off, so
+        # there's no need to touch the raw buffers here
+        self.clearAndUpdateCallbacks("BR", devices=devices)
 
-    # Callback function for Device B
-    # noinspection PyUnusedLocal
-    def callbackB(self, pvname=None, value=None, timestamp=None, **kw):
-        self.updateTimeAndBuffer("B", pvname, timestamp, value)
+        return True
 
     ############################################################################
-    # This is where the data is actually acquired and saved to the buffers.
-    # Callbacks are effectively listeners that listen for change, so we
-    # basically put a callback on the PVs of interest (devices A and/or B) so
-    # that every time the value of that PV changes, we get that new value and
-    # append it to our raw data buffer for that device.
-    # Initialization of the buffer is slightly different in that the listener is
-    # put on the history buffer of that PV (denoted by the HSTBR suffix), so
-    # that we just immediately write the previous 2800 points to our raw buffer
+    # Gives the raw buffers a column for A and B plus one for each of the
+    # given PVs (named after the PV), unless that's what they've already got.
+    # Changing them throws out whatever's in the buffers.
     ############################################################################
-    def updateTimeAndBuffer(self, device, pvname, timestamp, value):
-
-        def padRawBufferWithNans(start, end):
-            rtbsaUtils.padWithNans(self.rawBuffers[device], start, end)
-
-        if "HSTBR" in pvname:
-            self.timeStamps[device] = timestamp
-
-            # value is the buffer because we're monitoring the HSTBR PV
-            self.rawBuffers[device] = value
-
-            # Reset the counter every time we reinitialize the plot
-            self.counter[device] = 0
-
-        else:
-            if not self.timeStamps[device]:
-                return
-
-            rate = self.getRate()
-            if rate < 1:
-                return
-
-            scalingFactor = 1.0 / rate
-            elapsedPulses = round((timestamp - self.timeStamps[device])
-                                  / scalingFactor)
-
-            currIdx = int((timestamp / scalingFactor) % self.numPoints)
-
-            if elapsedPulses <= 0:
-                return
+    def watchDevices(self, pvs=()):
+        devices = [("A", self.config.devices["A"]),
+                   ("B", self.config.devices["B"])]
+        devices.extend((pv, pv) for pv in pvs)
 
-            # Pad the buffer with nans for missed pulses
-            elif elapsedPulses > 1:
+        names = [device for device, _ in devices]
+        if names != self.engine.acquisition.devices:
+            self.engine.setDevices(devices)
 
-                # noinspection PyTypeChecker
-                lastIdx = int((self.timeStamps[device] / scalingFactor)
-                              % self.numPoints)
-
-                # Take care of wrap around
-                if currIdx < lastIdx:
-                    padRawBufferWithNans(lastIdx + 1, self.numPoints)
-                    padRawBufferWithNans(0, currIdx)
-
-                else:
-                    padRawBufferWithNans(lastIdx + 1, currIdx)
+    def historyTimedOut(self):
+        if not self.abort:
+            self.stop()
+            self.printStatus("Timed out waiting for history buffer. Aborting.")
 
-            # Directly index into the raw buffer using the timestamp
-            self.rawBuffers[device][currIdx] = value
+    ############################################################################
+    # Waits until isReady() comes true, the user hits stop, or timeout seconds
+    # go by (None waits forever), without spinning. We sit in a local event
+    # loop (so the GUI stays responsive) that only wakes up to re-check
+    # isReady() when one of the given signals fires, so an idle wait costs no
+    # CPU. If it takes more than half a second, waitingMessage goes in the
+    # status bar. Returns whether isReady() came true.
+    ############################################################################
+    def waitFor(self, isReady, signals, timeout, waitingMessage):
+        if isReady():
+            return True
 
-            self.counter[device] += elapsedPulses
-            self.timeStamps[device] = timestamp
-            self.currIdx[device] = currIdx
+        loop = QEventLoop()
+        signals = signals + [self.signals.stopped]
 
-    def clearPV(self, device):
-        pv = self.pvObjects[device]
-        if pv:
-            pv.clear_callbacks()
-            pv.disconnect()
+        timeoutTimer = QTimer()
+        timeoutTimer.setSingleShot(True)
+        timeoutTimer.timeout.connect(loop.quit)
 
-    def adjustSynchronizedBuffers(self, syncByTime=False):
-        numBadShots = self.populateSynchronizedBuffers(syncByTime)
-        blength = 2800 - numBadShots
+        messageTimer = QTimer()
+        messageTimer.setSingleShot(True)
+        messageTimer.timeout.connect(lambda: self.printStatus(waitingMessage,
+                                                              False))
 
-        # Make sure the buffer size doesn't exceed the desired number of points
-        if self.numPoints < blength:
-            self.synchronizedBuffers["A"] = \
-                self.synchronizedBuffers["A"][:self.numPoints]
+        for signal in signals:
+            signal.connect(loop.quit)
 
-            self.synchronizedBuffers["B"] = \
-                self.synchronizedBuffers["B"][:self.numPoints]
+        if timeout is not None:
+            timeoutTimer.start(int(timeout * 1000))
+        messageTimer.start(500)
 
-    # A spin loop that waits until the beam rate is at least 1Hz
-    def waitForRate(self):
+        while (not isReady() and not self.abort
+               and (timeout is None or timeoutTimer.isActive())):
+            loop.exec_()
 
-        start_time = time()
-        gotStuckAndNeedToUpdateMessage = False
+        for signal in signals:
+            signal.disconnect(loop.quit)
 
-        # self.rate is a PV, such that .value is shorthand for .getval
-        while self.ratePV.value < 2:
-            # noinspection PyArgumentList
-            QApplication.processEvents()
+        timeoutTimer.stop()
+        gotStuckAndNeedToUpdateMessage = not messageTimer.isActive()
+        messageTimer.stop()
 
-            if time() - start_time > 0.5:
-                gotStuckAndNeedToUpdateMessage = True
-                self.printStatus("Waiting for beam rate to be at least 1Hz...",
-                                 False)
-
-        if gotStuckAndNeedToUpdateMessage:
+        ready = bool(isReady())
+        if ready and gotStuckAndNeedToUpdateMessage:
             self.printStatus("Running", False)
 
-        return rtbsaUtils.rateDict[self.ratePV.value]
+        return ready
 
     ############################################################################
-    # Time 1 is when Device A started acquiring data, and Time 2 is when Device
-    # B started acquiring data. Since they're not guaranteed to start
-    # acquisition at the same time, one data buffer might be ahead of the other,
-    # meaning that the intersection of the two buffers would not include the
-    # first n elements of one and the last n elements of the other. See the
-    # diagram below, where the dotted line represents the time axis (one buffer
-    # is contained  by square brackets [], the other by curly braces {}, and the
-    # times where each starts and ends is indicated right underneath).
-    #
-    #
-    #          [           {                            ]           }
-    # <----------------------------------------------------------------------> t
-    #       t1_start    t2_start                     t1_end      t2_end
-    #
-    #
-    # Note that both buffers are of the same size (2800) so that:
-    # (t1_end - t1_start) = (t2_end - t2_start)
-    #
-    # From the diagram, we see that only the time between t2_start and t1_end
-    # contains data from both buffers (t1_start to t2_start only contains data
-    # from buffer 1, and t1_end to t2_end only contains data from buffer 2).
-    # Using that, we can chop the beginning of buffer 1 and the end of buffer 2
-    # so that we're only left with the overlapping region.
-    #
-    # In order to figure out how many points we need to chop from each buffer
-    # (it's the same number for both since they're both the same size), we
-    # multiply the time delta by the beam rate (yay dimensional analysis!):
-    # seconds * (shots/second) = (number of shots)
-    #
-    # That whole rigmarole only applies to the initial population of the buffers
-    # (where we're pulling the entire history buffer at once using the HSTBR
-    # suffix). From then on, we're indexing into the raw buffers using the
-    # pulse ID modulo 2800, so they're inherently synchronized
+    # Gets each device's history started. The PVs that were plotted recently
+    # get theirs straight back out of the acquisition worker's cache and go
+    # right on to their BR PV, with their HSTBR PV subscribed to on the side
+    # to fill in the shots they missed in the meantime. The rest get their
+    # HSTBR PV subscribed to as usual, and have to wait for it.
     ############################################################################
-    def populateSynchronizedBuffers(self, syncByTime):
-
-        def padSyncBufferWithNans(device, startIdx, endIdx):
-            lag = endIdx - startIdx
-
-            if lag > 20:
-                print ("Reinitializing buffers due to " + str(lag)
-                       + " shot lag for device " + device)
-                self.initializeBuffers()
-
-            else:
-                rtbsaUtils.padWithNans(self.synchronizedBuffers[device],
-                                       startIdx + 1, endIdx + 1)
-
-        def checkIndices(device, startIdx, endIdx):
-            # Check for index wraparound
-            if endIdx < startIdx:
-                padSyncBufferWithNans(device, startIdx, self.numPoints - 1)
-                padSyncBufferWithNans(device, 0, endIdx)
-
-            else:
-                padSyncBufferWithNans(device, startIdx, endIdx)
-
-        if syncByTime:
-            numBadShots = int(round((self.timeStamps["B"]
-                                     - self.timeStamps["A"])
-                                    * self.getRate()))
-
-            startA, endA = rtbsaUtils.getIndices(numBadShots, 1)
-            startB, endB = rtbsaUtils.getIndices(numBadShots, -1)
-
-            self.synchronizedBuffers["A"] = self.rawBuffers["A"][startA:endA]
-            self.synchronizedBuffers["B"] = self.rawBuffers["B"][startB:endB]
-
-            return abs(numBadShots)
-
-        else:
-
-            self.synchronizedBuffers["A"] = self.rawBuffers["A"]
-            self.synchronizedBuffers["B"] = self.rawBuffers["B"]
-
-            # The timestamps and indices get updated by the callbacks, so we
-            # store the values at the time of buffer-copying
-            timeStampA = self.timeStamps["A"]
-            timeStampB = self.timeStamps["B"]
+    def loadHistories(self, devices):
+        try:
+            restored = self.engine.acquisition.restoreHistories(
+                dict((device, self.config.devices[device])
+                     for device in devices),
+                self.config.numPoints)
+        except Exception as error:
+            self.printStatus("Unable to restore cached histories ("
+                             + str(error) + "), waiting on HSTBR instead")
+            restored = []
+
+        for device in restored:
+            self.endGapFill(device)
+            self.gapFills[device] = self.pvPool.subscribe(
+                self.config.devices[device] + "HSTBR",
+                partial(self.deviceCallback, device))
+
+        self.clearAndUpdateCallbacks("BR", devices=restored)
+        self.clearAndUpdateCallbacks("HSTBR",
+                                     devices=[device for device in devices
+                                              if device not in restored])
+
+    # A restored history's HSTBR subscription is only needed until its first
+    # callback
+    def endGapFill(self, device):
+        subscription = self.gapFills.pop(str(device), None)
+        if subscription:
+            self.pvPool.unsubscribe(subscription)
+
+    def clearAndUpdateCallbacks(self, suffix, devices=("A", "B")):
+        for device in devices:
+            self.clearAndUpdateCallback(device, suffix)
 
-            currIdxA = self.currIdx["A"]
-            currIdxB = self.currIdx["B"]
+    # noinspection PyTypeChecker
+    def clearAndUpdateCallback(self, device, suffix):
+        self.clearPV(device)
 
-            diff = timeStampA - timeStampB
+        self.subscriptions[device] = self.pvPool.subscribe(
+            self.config.devices[device] + suffix,
+            partial(self.deviceCallback, device))
 
-            if diff > 0:
-                checkIndices("A", currIdxB, currIdxA)
+    # Callback function for every device (bound to its device name). These
+    # run on the CA thread, so all they do is hand the sample over to the
+    # acquisition worker
+    # noinspection PyUnusedLocal
+    def deviceCallback(self, device, pvname=None, value=None, timestamp=None,
+                       **kw):
+        self.engine.acquisition.submit(device, pvname, timestamp, value,
+                                       kw.get("nanoseconds"))
 
-            elif diff < 0:
-                checkIndices("B", currIdxA, currIdxB)
+    # Takes our callback off of the device's PV, which stays connected in the
+    # pool for next time
+    def clearPV(self, device):
+        if self.subscriptions[device]:
+            self.pvPool.unsubscribe(self.subscriptions[device])
+            self.subscriptions[device] = None
+
+    # Waits until the beam rate is at least 1Hz. Returns the rate, or None if
+    # we gave up (or got stopped) first
+    def waitForRate(self, timeout=None):
+        if not self.waitFor(lambda: self.getRate() >= 1,
+                            [self.signals.rateChanged], timeout,
+                            "Waiting for beam rate to be at least 1Hz..."):
+            return None
 
-            return 0
+        return self.getRate()
 
     def genPlotAndSetTimer(self, genPlot, updateMethod):
         if self.abort:
@@ -642,10 +705,9 @@ class RTBSA(QMainWindow):
             self.printStatus('No Data, Aborting Plotting Algorithm')
             return
 
-        self.timer = QTimer(self)
-
-        # Run updateMethod every updatetime milliseconds
-        self.timer.singleShot(self.updateTime, updateMethod)
+        # Run updateMethod every updatetime milliseconds (or less often, if
+        # there's no point in going that fast)
+        self.scheduler.start(updateMethod)
 
         self.printStatus('Running')
 
@@ -653,17 +715,18 @@ class RTBSA(QMainWindow):
     def genTimePlotA(self):
         newData = self.initializeData()
 
-        if not newData.size:
+        if newData is None or not newData.size:
             self.printStatus('Invalid PV? Unable to get data. Aborting.')
             self.ui.startButton.setEnabled(True)
             return
 
-        data = newData[:self.numPoints]
+        data = newData[:self.config.numPoints]
 
         self.plotAttributes["curve"] = PlotCurveItem(data, pen=1)
         self.plot.addItem(self.plotAttributes["curve"])
 
-        self.plotFit(arange(self.numPoints), data, self.devices["A"])
+        self.plotFit(arange(self.config.numPoints), data,
+                     self.config.devices["A"])
 
     ############################################################################
     # This is the main plotting function for "Plot A vs Time" that gets called
@@ -675,113 +738,117 @@ class RTBSA(QMainWindow):
         if not self.checkPlotStatus():
             return
 
-        xData, yData = self.filterTimePlotBuffer()
+        with self.timings.stage("filter"):
+            xData, yData = self.engine.timeSeries()
+            self.showRejections(self.engine.timePlotFilter)
+
+        if not yData.size:
+            return
 
-        if yData.size:
-            self.plotAttributes["curve"].setData(yData)
+        with self.timings.stage("draw"):
+            # Plotted against the slot index so the curve stays put while a
+            # window that's longer than the history buffer fills in. Only
+            # the points that can light up a pixel get handed to pyqtgraph
+            self.plotAttributes["curve"].setData(
+                *rtbsaRender.decimateMinMax(xData, yData, self.plot.width()))
             if self.ui.checkBoxAutoscale.isChecked():
                 mx = max(yData)
                 mn = min(yData)
                 if mx - mn > .00001:
                     self.plot.setYRange(mn, mx)
-                    self.plot.setXRange(0, len(yData))
+                    self.plot.setXRange(0, self.config.numPoints)
+
+        useRunningStats = self.engine.runningStatsApply(
+            self.engine.timePlotFilter)
 
+        with self.timings.stage("stats"):
             if self.ui.checkBoxShowAve.isChecked():
-                rtbsaUtils.setPosAndText(self.text["avg"], mean(yData), 0,
+                average = (self.engine.overlayStats["meanA"]
+                           if useRunningStats else mean(yData))
+                rtbsaUtils.setPosAndText(self.text["avg"], average, 0,
                                          min(yData), 'AVG: ')
 
             if self.ui.checkBoxShowStdDev.isChecked():
-                rtbsaUtils.setPosAndText(self.text["std"], std(yData),
-                                         self.numPoints / 4, min(yData),
-                                         'STD: ')
+                stdDev = (self.engine.overlayStats["stdA"]
+                          if useRunningStats else std(yData))
+                rtbsaUtils.setPosAndText(self.text["std"], stdDev,
+                                         self.config.numPoints / 4,
+                                         min(yData), 'STD: ')
 
             if self.ui.checkBoxCorrCoeff.isChecked():
                 self.text["corr"].setText('')
 
+        with self.timings.stage("fit"):
             if self.ui.checkBoxLinFit.isChecked():
-                self.text["slope"].setPos(self.numPoints / 2, min(yData))
-                self.getLinearFit(xData, yData, True)
+                self.text["slope"].setPos(self.config.numPoints / 2,
+                                          min(yData))
+                self.getLinearFit(xData, yData, True, useRunningStats)
 
             elif self.ui.checkBoxPolyFit.isChecked():
-                self.text["slope"].setPos(self.numPoints / 2, min(yData))
-                self.getPolynomialFit(xData, yData, True)
-
-        self.timer.singleShot(self.updateTime, self.updateTimePlotA)
+                self.text["slope"].setPos(self.config.numPoints / 2,
+                                          min(yData))
+                self.getPolynomialFit(xData, yData, True, useRunningStats)
 
+    ############################################################################
+    # If there's no beam, rather than waiting around we pause the frame
+    # scheduler. rateChanged picks it back up once the rate PV says the beam
+    # is back.
+    ############################################################################
     def checkPlotStatus(self):
         QApplication.processEvents()
 
         if self.abort:
             return False
 
-        self.waitForRate()
+        if self.getRate() < 1:
+            self.scheduler.pause()
+            self.printStatus("Waiting for beam rate to be at least 1Hz...",
+                             False)
+            return False
 
         # kill switch to stop backgrounded, forgetten GUIs. Somewhere in the
         # ballpark of 20 minutes assuming 120Hz
-        if self.counter["A"] > 150000:
+        if max(self.engine.acquisition.counter.values()) > 150000:
             self.stop()
             self.printStatus("Stopping due to inactivity")
 
         return True
 
-    def filterTimePlotBuffer(self):
-        currIdx = self.currIdx["A"]
-        choppedBuffer = self.rawBuffers["A"][:self.numPoints]
-
-        # All this nonsense to make it scroll :P Thanks to Ben for the
-        # inspiration!
-        if currIdx > 0:
-            choppedBuffer = concatenate([choppedBuffer[currIdx:],
-                                         choppedBuffer[:currIdx]])
-
-        xData, yData = rtbsaUtils.filterBuffers(choppedBuffer,
-                                                lambda x: ~isnan(x),
-                                                arange(self.numPoints),
-                                                choppedBuffer)
-
-        if self.devices["A"] == "BLEN:LI24:886:BIMAX":
-            xData, yData = rtbsaUtils.filterBuffers(yData,
-                                                    lambda x:
-                                                    x < rtbsaUtils.IPK_LIMIT,
-                                                    xData, yData)
-
-        if self.ui.checkBoxStdDev.isChecked():
-            stdDevFilterFunc = self.StdDevFilterFunc(mean(yData), std(yData))
-            xData, yData = rtbsaUtils.filterBuffers(yData, stdDevFilterFunc,
-                                                    xData, yData)
-        return xData, yData
-
-    def getLinearFit(self, xData, yData, updateExistingPlot):
+    def getLinearFit(self, xData, yData, updateExistingPlot,
+                     useRunningFit=False):
         # noinspection PyTupleAssignmentBalance
-        m, b = polyfit(xData, yData, 1)
-        fitData = polyval([m, b], xData)
+        m, b = self.engine.fitCoefficients(xData, yData, 1, useRunningFit)
+        fitGrid = self.engine.fitGrid(xData)
+        fitData = polyval([m, b], fitGrid)
 
         self.text["slope"].setText('Slope: ' + str("{:.3e}".format(m)))
 
         if updateExistingPlot:
-            self.plotAttributes["fit"].setData(xData, fitData)
+            self.plotAttributes["fit"].setData(fitGrid, fitData)
         else:
             # noinspection PyTypeChecker
-            self.plotAttributes["fit"] = PlotCurveItem(xData, fitData, 'g-',
+            self.plotAttributes["fit"] = PlotCurveItem(fitGrid, fitData, 'g-',
                                                        linewidth=1)
 
-    def getPolynomialFit(self, xData, yData, updateExistingPlot):
-        co = polyfit(xData, yData, self.fitOrder)
+    def getPolynomialFit(self, xData, yData, updateExistingPlot,
+                         useRunningFit=False):
+        co = self.engine.fitCoefficients(xData, yData, self.config.fitOrder,
+                                         useRunningFit)
         pol = poly1d(co)
-        xDataSorted = sorted(xData)
-        fit = pol(xDataSorted)
+        fitGrid = self.engine.fitGrid(xData)
+        fit = pol(fitGrid)
 
         if updateExistingPlot:
-            self.plotAttributes["parab"].setData(xDataSorted, fit)
+            self.plotAttributes["parab"].setData(fitGrid, fit)
         else:
             # noinspection PyTypeChecker
-            self.plotAttributes["parab"] = PlotCurveItem(xDataSorted, fit,
+            self.plotAttributes["parab"] = PlotCurveItem(fitGrid, fit,
                                                          pen=3, size=2)
 
-        if self.fitOrder == 2:
+        if self.config.fitOrder == 2:
             self.text["slope"].setText('Peak: ' + str(-co[1] / (2 * co[0])))
 
-        elif self.fitOrder == 3:
+        elif self.config.fitOrder == 3:
             self.text["slope"].setText(str("{:.2e}".format(co[0])) + 'x^3'
                                        + str("+{:.2e}".format(co[1]))
                                        + 'x^2'
@@ -789,20 +856,49 @@ class RTBSA(QMainWindow):
                                        + str("+{:.2e}".format(co[3])))
 
     def genPlotAB(self):
-        if self.ui.checkBoxStdDev.isChecked():
-            self.plotCurveAndFit(self.filteredBuffers["A"],
-                                 self.filteredBuffers["B"])
-        else:
-            self.plotCurveAndFit(self.synchronizedBuffers["A"],
-                                 self.synchronizedBuffers["B"])
+        self.plotCurveAndFit(*self.filteredPairs())
 
     def plotCurveAndFit(self, xData, yData):
         # noinspection PyTypeChecker
-        self.plotAttributes["curve"] = ScatterPlotItem(xData, yData, pen=1,
+        self.plotAttributes["curve"] = ScatterPlotItem([], [], pen=1,
                                                        symbol='x', size=5)
-        self.plot.addItem(self.plotAttributes["curve"])
+
+        # Drawn under the markers and the fit
+        self.plotAttributes["density"] = ImageItem()
+        self.plotAttributes["density"].setZValue(-1)
+        self.plot.addItem(self.plotAttributes["density"])
+
+        self.plotPoints(xData, yData)
         self.plotFit(xData, yData,
-                     self.devices["B"] + ' vs. ' + self.devices["A"])
+                     self.config.devices["B"] + ' vs. '
+                     + self.config.devices["A"])
+
+    ############################################################################
+    # A ScatterPlotItem gets slow fast as the number of points goes up, so
+    # past DENSITY_MAP_THRESHOLD points we draw a 2D histogram of them instead
+    # (log scaled, so a few outliers still show up next to the dense core).
+    # The worker keeps the histogram of the raw pairs up to date as they come
+    # in, so this costs the same no matter how many points there are, unless
+    # something other than nans got cut and it has to be rebinned from the
+    # filtered buffers.
+    ############################################################################
+    def plotPoints(self, bufferA, bufferB):
+        density = self.plotAttributes["density"]
+
+        if not (self.config.densityMap
+                and bufferA.size > DENSITY_MAP_THRESHOLD):
+            density.setVisible(False)
+            self.plotAttributes["curve"].setData(bufferA, bufferB)
+            return
+
+        histogram = self.engine.pairDensity(bufferA, bufferB)
+
+        self.plotAttributes["curve"].setData([], [])
+
+        (xMin, xMax), (yMin, yMax) = histogram.xRange, histogram.yRange
+        density.setImage(log1p(histogram.counts))
+        density.setRect(QRectF(xMin, yMin, xMax - xMin, yMax - yMin))
+        density.setVisible(True)
 
     def plotFit(self, xData, yData, title):
         self.plot.addItem(self.plotAttributes["curve"])
@@ -832,105 +928,74 @@ class RTBSA(QMainWindow):
 
         QApplication.processEvents()
 
-        self.adjustSynchronizedBuffers()
-        self.filterNans()
-        self.filterPeakCurrent()
+        with self.timings.stage("sync"):
+            self.engine.synchronize()
 
-        if self.ui.checkBoxStdDev.isChecked():
-            self.filterStdDev()
-            self.updateLabelsAndFit(self.filteredBuffers["A"],
-                                    self.filteredBuffers["B"])
-        else:
-            self.updateLabelsAndFit(self.synchronizedBuffers["A"],
-                                    self.synchronizedBuffers["B"])
-
-        self.timer.singleShot(self.updateTime, self.updatePlotAB)
-
-    def filterNans(self):
-        def filterFunc(x): return ~isnan(x)
-
-        self.filterData(self.synchronizedBuffers["A"], filterFunc, True)
-        self.filterData(self.synchronizedBuffers["B"], filterFunc, True)
-
-    # Need to filter out errant indices from both buffers to keep them
-    # synchronized
-    def filterData(self, dataBuffer, filterFunc, changeOriginal):
-        bufferA, bufferB = rtbsaUtils.filterBuffers(dataBuffer, filterFunc,
-                                                    self.synchronizedBuffers[
-                                                        "A"],
-                                                    self.synchronizedBuffers[
-                                                        "B"])
-
-        if changeOriginal:
-            self.synchronizedBuffers["A"] = bufferA
-            self.synchronizedBuffers["B"] = bufferB
-        else:
-            self.filteredBuffers["A"] = bufferA
-            self.filteredBuffers["B"] = bufferB
+        self.updateLabelsAndFit(*self.filteredPairs())
 
-    # This PV gets insane values, apparently
-    def filterPeakCurrent(self):
-        def filterFunc(x):
-            return x < rtbsaUtils.IPK_LIMIT
+    def filteredPairs(self):
+        with self.timings.stage("filter"):
+            bufferA, bufferB = self.engine.pairs()
+            self.showRejections(self.engine.pairFilter)
+        return bufferA, bufferB
 
-        if self.devices["A"] == "BLEN:LI24:886:BIMAX":
-            self.filterData(self.synchronizedBuffers["A"], filterFunc, True)
-        if self.devices["B"] == "BLEN:LI24:886:BIMAX":
-            self.filterData(self.synchronizedBuffers["B"], filterFunc, True)
-
-    def filterStdDev(self):
-
-        bufferA = self.synchronizedBuffers["A"]
-        bufferB = self.synchronizedBuffers["B"]
-
-        self.filterData(bufferA, self.StdDevFilterFunc(mean(bufferA),
-                                                       std(bufferA)), False)
-
-        self.filterData(bufferB, self.StdDevFilterFunc(mean(bufferB),
-                                                       std(bufferB)), False)
-
-    def StdDevFilterFunc(self, average, stdDev):
-        return lambda x: abs(x - average) < self.stdDevstoKeep * stdDev
+    def showRejections(self, pipeline):
+        self.filterStatus.setText("Cut " + pipeline.describeRejections())
 
     # noinspection PyTypeChecker
     def updateLabelsAndFit(self, bufferA, bufferB):
-        self.plotAttributes["curve"].setData(bufferA, bufferB)
-
         try:
-            if self.ui.checkBoxAutoscale.isChecked():
-                self.setPlotRanges(bufferA, bufferB)
-
-            minBufferA = nanmin(bufferA)
-            minBufferB = nanmin(bufferB)
-            maxBufferA = nanmax(bufferA)
-            maxBufferB = nanmax(bufferB)
-
-            if self.ui.checkBoxShowAve.isChecked():
-                rtbsaUtils.setPosAndText(self.text["avg"], nanmean(bufferB),
-                                         minBufferA,
-                                         minBufferB, 'AVG: ')
-
-            if self.ui.checkBoxShowStdDev.isChecked():
-                xPos = (minBufferA + (minBufferA + maxBufferA) / 2) / 2
-
-                rtbsaUtils.setPosAndText(self.text["std"], nanstd(bufferB),
-                                         xPos, minBufferB, 'STD: ')
-
-            if self.ui.checkBoxCorrCoeff.isChecked():
-                correlation = corrcoef(bufferA, bufferB)
-                rtbsaUtils.setPosAndText(self.text["corr"], correlation.item(1),
-                                         minBufferA, maxBufferB,
-                                         "Corr. Coefficient: ")
-
-            if self.ui.checkBoxLinFit.isChecked():
-                self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
-                                          minBufferB)
-                self.getLinearFit(bufferA, bufferB, True)
-
-            elif self.ui.checkBoxPolyFit.isChecked():
-                self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
-                                          minBufferB)
-                self.getPolynomialFit(bufferA, bufferB, True)
+            with self.timings.stage("draw"):
+                self.plotPoints(bufferA, bufferB)
+
+                if self.ui.checkBoxAutoscale.isChecked():
+                    self.setPlotRanges(bufferA, bufferB)
+
+            with self.timings.stage("stats"):
+                minBufferA = nanmin(bufferA)
+                minBufferB = nanmin(bufferB)
+                maxBufferA = nanmax(bufferA)
+                maxBufferB = nanmax(bufferB)
+
+                useRunningStats = self.engine.runningStatsApply(
+                    self.engine.pairFilter)
+
+                if self.ui.checkBoxShowAve.isChecked():
+                    average = (self.engine.overlayStats["meanB"]
+                               if useRunningStats else nanmean(bufferB))
+                    rtbsaUtils.setPosAndText(self.text["avg"], average,
+                                             minBufferA,
+                                             minBufferB, 'AVG: ')
+
+                if self.ui.checkBoxShowStdDev.isChecked():
+                    xPos = (minBufferA + (minBufferA + maxBufferA) / 2) / 2
+
+                    # The n - 1 standard deviation, like nanstd
+                    stdDev = (self.engine.overlayStats["sampleStdB"]
+                              if useRunningStats else nanstd(bufferB))
+                    rtbsaUtils.setPosAndText(self.text["std"], stdDev,
+                                             xPos, minBufferB, 'STD: ')
+
+                if self.ui.checkBoxCorrCoeff.isChecked():
+                    correlation = (self.engine.overlayStats["corr"]
+                                   if useRunningStats
+                                   else corrcoef(bufferA, bufferB).item(1))
+                    rtbsaUtils.setPosAndText(self.text["corr"], correlation,
+                                             minBufferA, maxBufferB,
+                                             "Corr. Coefficient: ")
+
+            with self.timings.stage("fit"):
+                if self.ui.checkBoxLinFit.isChecked():
+                    self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
+                                              minBufferB)
+                    self.getLinearFit(bufferA, bufferB, True,
+                                      useRunningStats)
+
+                elif self.ui.checkBoxPolyFit.isChecked():
+                    self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
+                                              minBufferB)
+                    self.getPolynomialFit(bufferA, bufferB, True,
+                                          useRunningStats)
 
         except ValueError:
             print "Error updating plot range"
@@ -948,50 +1013,136 @@ class RTBSA(QMainWindow):
         if mn != mx:
             self.plot.setXRange(mn, mx)
 
-    def InitializeFFTPlot(self):
-        self.genPlotFFT(self.initializeData(), False)
+    ############################################################################
+    # The correlation matrix of the matrixPVs as a heatmap, from -1 (blue)
+    # through 0 (white) to 1 (red). The PVs are numbered along x and named
+    # along y, so each row is one PV against all of the others.
+    ############################################################################
+    def genCorrelationMatrix(self):
+        numPVs = len(self.matrixPVs)
+
+        self.plotAttributes["matrix"] = ImageItem()
+        self.plotAttributes["matrix"].setLookupTable(
+            rtbsaRender.divergingLookupTable())
+        self.plot.addItem(self.plotAttributes["matrix"])
+
+        self.plot.getAxis("bottom").setTicks(
+            [[(i + 0.5, str(i)) for i in range(numPVs)]])
+        self.plot.getAxis("left").setTicks(
+            [[(i + 0.5, str(i) + " " + pv)
+              for i, pv in enumerate(self.matrixPVs)]])
+        self.plot.setXRange(0, numPVs)
+        self.plot.setYRange(0, numPVs)
+
+        self.drawCorrelationMatrix()
+
+    # This is the main plotting function for the correlation matrix that gets
+    # called every self.updateTime milliseconds
+    def updateCorrelationMatrix(self):
+        if not self.checkPlotStatus():
+            return
+
+        self.drawCorrelationMatrix()
+
+    def drawCorrelationMatrix(self):
+        with self.timings.stage("stats"):
+            matrix = self.engine.correlationMatrix(self.matrixPVs)
+
+        with self.timings.stage("draw"):
+            # ImageItem can't draw nans, so the pairs that don't have a
+            # correlation yet show up as 0
+            self.plotAttributes["matrix"].setImage(nan_to_num(matrix),
+                                                   levels=(-1, 1))
 
-    # TODO I have no idea what's happening here
-    def genPlotFFT(self, newdata, updateExistingPlot):
+            # Which PV tracks the first one best is usually the question
+            others = absolute(nan_to_num(matrix[0, 1:]))
+            title = ("Correlation matrix of " + str(len(self.matrixPVs))
+                     + " PVs")
 
-        if not newdata.size:
+            if others.any():
+                best = int(others.argmax()) + 1
+                title += ("; " + self.matrixPVs[0] + " tracks "
+                          + self.matrixPVs[best] + " best (r = "
+                          + "{:.2f}".format(matrix[0, best]) + ")")
+
+            self.plot.setTitle(title)
+
+    def InitializeFFTPlot(self):
+        if self.initializeData() is None:
             return None
 
-        newdata = newdata[:self.numPoints]
+        return self.genPlotFFT(False)
 
-        nans, x = isnan(newdata), lambda z: z.nonzero()[0]
-        # interpolate nans
-        newdata[nans] = interp(x(nans), x(~nans), newdata[~nans])
-        # remove DC component
-        newdata = newdata - mean(newdata)
+    ############################################################################
+    # The spectrum is Welch averaged over segments of the window, and only
+    # the segments that new shots have completed get transformed on each
+    # update (see rtbsaSpectrum)
+    ############################################################################
+    def genPlotFFT(self, updateExistingPlot):
+        rate = self.waitForRate()
+        if not rate:
+            return None
 
-        newdata = concatenate([newdata, zeros(self.numPoints * 2)])
+        # A new plot means new data, so none of the cached segments are any
+        # good
+        with self.timings.stage("spectrum"):
+            result = self.engine.updateSpectrum(
+                rate, restart=not updateExistingPlot)
 
-        ps = abs(fft.fft(newdata)) / newdata.size
+        if result is None:
+            return None
 
-        self.waitForRate()
-        frequencies = fft.fftfreq(newdata.size, 1.0 / self.getRate())
-        keep = (frequencies >= 0)
-        ps = ps[keep]
-        frequencies = frequencies[keep]
-        idx = argsort(frequencies)
+        frequencies, ps = result
 
-        if updateExistingPlot:
-            self.plotAttributes["curve"].setData(x=frequencies[idx], y=ps[idx])
-        else:
-            # noinspection PyTypeChecker
-            self.plotAttributes["curve"] = PlotCurveItem(x=frequencies[idx],
-                                                         y=ps[idx], pen=1)
+        with self.timings.stage("draw"):
+            if updateExistingPlot:
+                self.plotAttributes["curve"].setData(x=frequencies, y=ps)
+            else:
+                # noinspection PyTypeChecker
+                self.plotAttributes["curve"] = PlotCurveItem(x=frequencies,
+                                                             y=ps, pen=1)
+                self.plot.addItem(self.plotAttributes["curve"])
 
-        self.plot.addItem(self.plotAttributes["curve"])
-        self.plot.setTitle(self.devices["A"])
-        self.plotAttributes["frequencies"] = frequencies
+                self.plotAttributes["waterfall"] = ImageItem()
+                self.plot.addItem(self.plotAttributes["waterfall"])
+
+            self.plotAttributes["frequencies"] = frequencies
+            self.plotWaterfall()
 
         return ps
 
+    ############################################################################
+    # In waterfall mode the spectrum curve gets swapped out for an image of
+    # the past spectra (in dB), frequency along x and one row per segment
+    # along y, with the newest row at the top (y = 0)
+    ############################################################################
+    def plotWaterfall(self):
+        waterfall = self.plotAttributes["waterfall"]
+        showWaterfall = (self.config.waterfall
+                         and self.engine.spectrogram.count > 0)
+
+        self.plotAttributes["curve"].setVisible(not showWaterfall)
+        waterfall.setVisible(showWaterfall)
+
+        if not showWaterfall:
+            self.plot.setTitle(self.config.devices["A"])
+            return
+
+        self.plot.setTitle(self.config.devices["A"] + " (waterfall, dB)")
+
+        rows = self.engine.spectrogram.ordered()
+        waterfall.setImage(rows.T)
+        waterfall.setRect(QRectF(0, -rows.shape[0],
+                                 self.plotAttributes["frequencies"][-1],
+                                 rows.shape[0]))
+
     # noinspection PyTypeChecker
     def cleanPlot(self):
         self.plot.clear()
+        self.plot.getAxis("bottom").setTicks(None)
+        self.plot.getAxis("left").setTicks(None)
+        self.filterStatus.setText('')
+        self.timings.clear()
 
         self.text["avg"] = TextItem('', color=(200, 200, 250), anchor=(0, 1))
         self.text["std"] = TextItem('', color=(200, 200, 250), anchor=(0, 1))
@@ -1005,36 +1156,46 @@ class RTBSA(QMainWindow):
             self.plot.addItem(plotLabel)
 
     def initializeData(self):
-        self.printStatus("Initializing " + self.devices["A"] + " buffer...",
-                         True)
+        self.printStatus("Initializing " + self.config.devices["A"]
+                         + " buffer...", True)
 
         if self.ui.dropdownButtonA.isChecked():
-            self.devices["A"] = str(self.ui.dropdownA.currentText())
+            self.config.devices["A"] = str(self.ui.dropdownA.currentText())
 
         elif self.ui.searchButtonA.isChecked():
             pv = str(self.ui.searchInputA.text()).strip()
             if pv and pv in self.bsapvs:
-                self.devices["A"] = pv
+                self.config.devices["A"] = pv
             else:
                 return None
         else:
             return None
 
-        # Initializing our data by putting a callback on the history buffer PV
-        self.clearAndUpdateCallback("A", "HSTBR", self.callbackA,
-                                    self.devices["A"], True)
+        # Initializing our data from the history cache, or by putting a
+        # callback on the history buffer PV
+        self.loadHistories(["A"])
 
-        while (not self.timeStamps["A"]) and not self.abort:
-            QApplication.processEvents()
+        if not self.waitFor(lambda: self.engine.acquisition.timeStamps["A"],
+                            [self.signals.historyReceived],
+                            self.historyTimeout,
+                            "Waiting for " + self.config.devices["A"]
+                            + " history buffer..."):
+            self.historyTimedOut()
+            return None
+
+        # The buffer was populated in the callback function. Only keep the
+        # newest numPoints samples, since that's the window the BR PV writes
+        # into
+        self.engine.acquisition.truncate(self.config.numPoints)
 
         # Removing that callback and manually appending new values to our local
         # data buffer using the usual PV
         # TODO ask Ahmed what the BR is for
-        self.clearAndUpdateCallback("A", "BR", self.callbackA,
-                                    self.devices["A"])
+        self.clearAndUpdateCallback("A", "BR")
 
-        # This was populated in the callback function
-        return self.rawBuffers["A"]
+        # A copy, since the plot hangs on to it
+        with self.engine.acquisition.snapshot() as rawBuffers:
+            return rawBuffers.ordered_view("A").copy()
 
     ############################################################################
     # This is the main plotting function for "Plot A FFT" that gets called
@@ -1044,18 +1205,22 @@ class RTBSA(QMainWindow):
         if not self.checkPlotStatus():
             return
 
-        ps = self.genPlotFFT(self.rawBuffers["A"], True)
+        ps = self.genPlotFFT(True)
+
+        if ps is not None and self.ui.checkBoxAutoscale.isChecked():
+            frequencies = self.plotAttributes["frequencies"]
 
-        if self.ui.checkBoxAutoscale.isChecked():
-            mx = max(ps)
-            mn = min(ps)
-            if mx - mn > .00001:
-                frequencies = self.plotAttributes["frequencies"]
-                self.plot.setYRange(mn, mx)
+            if self.plotAttributes["waterfall"].isVisible():
+                self.plot.setYRange(-self.engine.spectrogram.count, 0)
                 # noinspection PyTypeChecker
                 self.plot.setXRange(min(frequencies), max(frequencies))
-
-        self.timer.singleShot(self.updateTime, self.updatePlotFFT)
+            else:
+                mx = max(ps)
+                mn = min(ps)
+                if mx - mn > .00001:
+                    self.plot.setYRange(mn, mx)
+                    # noinspection PyTypeChecker
+                    self.plot.setXRange(min(frequencies), max(frequencies))
 
     def AvsTClick(self):
         if not self.ui.checkBoxAvsT.isChecked():
@@ -1063,6 +1228,7 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxBvsA.setChecked(False)
             self.ui.checkBoxFFT.setChecked(False)
+            self.correlationMatrixAction.setChecked(False)
             self.AvsBClick()
 
     def AvsBClick(self):
@@ -1077,6 +1243,7 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxAvsT.setChecked(False)
             self.ui.checkBoxFFT.setChecked(False)
+            self.correlationMatrixAction.setChecked(False)
             self.AvsTClick()
             self.ui.groupBoxB.setDisabled(False)
             self.ui.bsaListB.setDisabled(True)
@@ -1095,8 +1262,155 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxBvsA.setChecked(False)
             self.ui.checkBoxAvsT.setChecked(False)
+            self.correlationMatrixAction.setChecked(False)
             self.AvsBClick()
 
+    ############################################################################
+    # Asks for the PVs to show the correlation matrix of, as a comma separated
+    # list (the common PVs to start with), then starts it in place of whatever
+    # plot was running
+    ############################################################################
+    def correlationMatrixClick(self):
+        if not self.correlationMatrixAction.isChecked():
+            self.stop()
+            return
+
+        # noinspection PyCallByClass,PyTypeChecker
+        text, accepted = QInputDialog.getText(
+            self, "Correlation matrix", "PVs (comma separated):",
+            text=", ".join(self.matrixPVs))
+
+        pvs = []
+        for pv in str(text).split(","):
+            if pv.strip() and pv.strip() not in pvs:
+                pvs.append(pv.strip())
+
+        invalid = [pv for pv in pvs if pv not in self.bsapvs
+                   and pv not in rtbsaUtils.commonlist]
+
+        if not accepted or invalid or len(pvs) < 2:
+            if invalid:
+                self.statusBar().showMessage('Not a BSA PV: ' + invalid[0],
+                                             6000)
+            elif accepted:
+                self.statusBar().showMessage('Pick at least two PVs', 6000)
+
+            self.correlationMatrixAction.setChecked(False)
+            return
+
+        self.matrixPVs = pvs
+
+        self.ui.checkBoxAvsT.setChecked(False)
+        self.ui.checkBoxBvsA.setChecked(False)
+        self.ui.checkBoxFFT.setChecked(False)
+        self.AvsBClick()
+
+    ############################################################################
+    # Ranks every BSA PV by how well it correlates with a target (A's PV to
+    # start with), from their history buffers, then offers the best of them
+    # to plot against the target as B vs A
+    ############################################################################
+    def findCorrelatedSignals(self):
+        # noinspection PyCallByClass,PyTypeChecker
+        text, accepted = QInputDialog.getText(
+            self, "Find correlated signals", "Target PV:",
+            text=self.config.devices["A"])
+        target = str(text).strip()
+
+        if not accepted:
+            return
+
+        if target not in self.bsapvs and target not in rtbsaUtils.commonlist:
+            self.statusBar().showMessage('Not a BSA PV: ' + target, 6000)
+            return
+
+        # noinspection PyCallByClass,PyTypeChecker
+        maxLag, accepted = QInputDialog.getInt(
+            self, "Find correlated signals",
+            "Also try lags of up to (shots):", 0, 0, 100)
+
+        if not accepted:
+            return
+
+        scan = CorrelationScan(self.pvPool, self.getRate, target, self.bsapvs,
+                               maxLag=maxLag)
+
+        progress = QProgressDialog("Fetching " + str(len(scan.pvs))
+                                   + " history buffers...", "Cancel", 0,
+                                   len(scan.pvs), self)
+        progress.setWindowModality(Qt.WindowModal)
+
+        steps = scan.run()
+        try:
+            for done in steps:
+                progress.setValue(done)
+                QApplication.processEvents()
+
+                if progress.wasCanceled():
+                    self.statusBar().showMessage('Scan cancelled', 6000)
+                    return
+
+        except ValueError as error:
+            self.printStatus(str(error))
+            return
+
+        finally:
+            steps.close()
+            progress.close()
+
+        ranked = []
+        for result in scan.results[:SCAN_RESULTS_SHOWN]:
+            if isnan(result.correlation):
+                break
+
+            ranked.append("{:+.3f}  {}".format(result.correlation, result.pv)
+                          + ("  (lag {:+d})".format(result.lag)
+                             if result.lag else ""))
+
+        if not ranked:
+            self.printStatus('No PV had enough pulses in common with '
+                             + target)
+            return
+
+        # noinspection PyCallByClass,PyTypeChecker
+        choice, accepted = QInputDialog.getItem(
+            self, "Correlated with " + target, "Plot against " + target + ":",
+            ranked, 0, False)
+
+        if not accepted:
+            return
+
+        self.ui.checkBoxBvsA.setChecked(True)
+        self.AvsBClick()
+
+        # The plot only gets started once AvsBClick's timer fires, so it
+        # picks these up
+        self.selectPV("A", target)
+        self.selectPV("B", scan.results[ranked.index(str(choice))].pv)
+
+    # Points device A or B at the given PV, through its dropdown of common PVs
+    # if it's in there and its search box otherwise
+    def selectPV(self, device, pv):
+        dropdownButton = getattr(self.ui, "dropdownButton" + device)
+        dropdown = getattr(self.ui, "dropdown" + device)
+        searchButton = getattr(self.ui, "searchButton" + device)
+        searchInput = getattr(self.ui, "searchInput" + device)
+        bsaList = getattr(self.ui, "bsaList" + device)
+
+        index = dropdown.findText(pv)
+        common = index >= 0
+
+        dropdownButton.setChecked(common)
+        dropdown.setEnabled(common)
+        searchButton.setChecked(not common)
+        searchInput.setEnabled(not common)
+        bsaList.setEnabled(not common)
+
+        if common:
+            dropdown.setCurrentIndex(index)
+        else:
+            searchInput.setText(pv)
+
     def avg_click(self):
         if not self.ui.checkBoxShowAve.isChecked():
             self.text["avg"].setText('')
@@ -1160,20 +1474,20 @@ class RTBSA(QMainWindow):
 
     def fitOrderActivated(self):
         try:
-            self.fitOrder = int(self.ui.fitOrder.text())
+            self.config.fitOrder = int(self.ui.fitOrder.text())
         except ValueError:
             self.statusBar().showMessage('Enter an integer, 1-10', 6000)
             return
 
-        if self.fitOrder > 10 or self.fitOrder < 1:
+        if self.config.fitOrder > 10 or self.config.fitOrder < 1:
             self.statusBar().showMessage('Really?  That is going to be useful'
                                          + ' to you?  The (already ridiculous)'
                                          + ' range is 1-10.  Hope you win a '
                                          + 'nobel prize jackass.', 6000)
             self.ui.fitOrder.setText('2')
-            self.fitOrder = 2
+            self.config.fitOrder = 2
 
-        if self.fitOrder != 2:
+        if self.config.fitOrder != 2:
             try:
                 self.text["slope"].setText('')
             except AttributeError:
@@ -1196,35 +1510,37 @@ class RTBSA(QMainWindow):
     def reinitialize_plot(self):
         self.cleanPlot()
 
+        if self.correlationMatrixAction.isChecked():
+            self.genCorrelationMatrix()
+
         # Setup for single PV plotting
-        if self.ui.checkBoxAvsT.isChecked():
+        elif self.ui.checkBoxAvsT.isChecked():
             self.genTimePlotA()
 
         elif self.ui.checkBoxBvsA.isChecked():
             self.genPlotAB()
         else:
-            self.genPlotFFT(self.synchronizedBuffers["A"], False)
+            self.InitializeFFTPlot()
 
     def logbook(self):
         rtbsaUtils.logbook('Python Real-Time BSA', 'BSA Data',
-                           str(self.numPoints) + ' points', self.plot.plotItem)
+                           str(self.config.numPoints) + ' points',
+                           self.plot.plotItem)
         self.statusBar().showMessage('Sent to LCLS Physics Logbook!', 10000)
 
     def MCCLog(self):
         rtbsaUtils.MCCLog('/tmp/RTBSA.png', '/tmp/RTBSA.ps', self.plot.plotItem)
 
-    def clearCallbacks(self, device):
-        if self.pvObjects[device]:
-            self.pvObjects[device].clear_callbacks()
-            self.pvObjects[device].disconnect()
-
     def stop(self):
-        self.clearCallbacks("A")
+        for device in self.subscriptions:
+            self.clearPV(device)
 
-        if self.pvObjects["B"]:
-            self.clearCallbacks("B")
+        for device in list(self.gapFills):
+            self.endGapFill(device)
 
         self.abort = True
+        self.scheduler.stop()
+        self.signals.stopped.emit()
         self.statusBar().showMessage('Stopped')
         self.ui.startButton.setDisabled(False)
         QApplication.processEvents()
@@ -1242,11 +1558,128 @@ class RTBSA(QMainWindow):
         rtbsaUtils.add_actions(self.file_menu, (load_file_action, None,
                                                 quit_action))
 
+        self.densityMapAction = self.create_action(
+            "&Density map for large B vs A", slot=self.settingsChanged,
+            checkable=True,
+            tip="Draw B vs A as a 2D histogram past "
+                + str(DENSITY_MAP_THRESHOLD) + " points")
+        self.densityMapAction.setChecked(True)
+
+        self.robustCutAction = self.create_action(
+            "&Robust (median/MAD) std dev cut", slot=self.settingsChanged,
+            checkable=True,
+            tip="Cut around the median, with the spread estimated from the "
+                + "median absolute deviation")
+
+        hardLimitsAction = self.create_action(
+            "Set &hard limits...", slot=self.editHardLimits,
+            tip="Set the range of values to believe from device A and B")
+
+        self.waterfallAction = self.create_action(
+            "&Waterfall for A FFT", slot=self.settingsChanged,
+            checkable=True,
+            tip="Show the history of the spectrum instead of the latest one")
+
+        self.correlationMatrixAction = self.create_action(
+            "Correlation &matrix...", slot=self.correlationMatrixClick,
+            checkable=True,
+            tip="Show the correlation coefficients of every pair of a list "
+                + "of PVs as a heatmap")
+
+        findCorrelatedAction = self.create_action(
+            "&Find correlated signals...", slot=self.findCorrelatedSignals,
+            tip="Rank every BSA PV by its correlation with a target PV")
+
+        self.timingsAction = self.create_action(
+            "Frame &timings", slot=self.showTimings, checkable=True,
+            tip="Show the p50/p99 time each stage of a plot update takes, "
+                + "in milliseconds")
+
+        rtbsaUtils.add_actions(self.view_menu, (self.correlationMatrixAction,
+                                                findCorrelatedAction, None,
+                                                self.densityMapAction,
+                                                self.waterfallAction, None,
+                                                self.robustCutAction,
+                                                hardLimitsAction, None,
+                                                self.timingsAction))
+
         about_action = self.create_action("&About", shortcut='F1',
                                           slot=self.on_about, tip='About')
 
         rtbsaUtils.add_actions(self.help_menu, (about_action,))
 
+    def showTimings(self):
+        show = self.timingsAction.isChecked()
+        self.timingOverlay.setVisible(show)
+        self.timingStatus.setVisible(show)
+        self.refreshTimings()
+
+    ############################################################################
+    # Puts the p50/p99 of each stage on the overlay and the frame's in the
+    # status bar (against the interval the scheduler's trying to keep), and
+    # every TIMING_LOG_INTERVAL seconds prints them all while a plot's running
+    ############################################################################
+    def refreshTimings(self):
+        if self.timingsAction.isChecked():
+            summary = list(self.timings.summary())
+
+            lines = ["stage  p50/p99 (ms)"]
+            lines.extend("{}  {:.1f}/{:.1f}".format(name, p50, p99)
+                         for name, p50, p99 in summary)
+            self.timingOverlay.setText("\n".join(lines))
+            self.timingOverlay.adjustSize()
+
+            self.timingStatus.setText('')
+            for name, p50, p99 in summary:
+                if name == "frame":
+                    self.timingStatus.setText(
+                        "Frame {:.1f}/{:.1f} ms of {} ms".format(
+                            p50, p99, self.scheduler.interval))
+
+        if time() - self.lastTimingLog >= TIMING_LOG_INTERVAL:
+            self.lastTimingLog = time()
+            if not self.abort:
+                print "Timings p50/p99 (ms): " + self.timings.describe()
+
+    ############################################################################
+    # Asks for the hard limits of each device in use as "low, high", where
+    # either can be left blank for no limit on that side
+    ############################################################################
+    def editHardLimits(self):
+        devices = ["A", "B"] if self.ui.checkBoxBvsA.isChecked() else ["A"]
+
+        for device in devices:
+            pv = self.config.devices[device]
+            if not pv:
+                continue
+
+            low, high = self.config.hardLimits.get(pv, (None, None))
+            current = ", ".join("" if limit is None else str(limit)
+                                for limit in (low, high))
+
+            # noinspection PyCallByClass,PyTypeChecker
+            text, accepted = QInputDialog.getText(
+                self, "Hard limits", "Limits for " + pv + " (low, high):",
+                text=current)
+
+            if not accepted:
+                return
+
+            try:
+                low, high = [float(limit) if limit.strip() else None
+                             for limit in str(text).split(",")]
+            except ValueError:
+                self.statusBar().showMessage('Enter limits as "low, high"',
+                                             6000)
+                return
+
+            if low is None and high is None:
+                self.config.hardLimits.pop(pv, None)
+            else:
+                self.config.hardLimits[pv] = (low, high)
+
+            self.settingsChanged()
+
     def create_action(self, text, slot=None, shortcut=None, icon=None, tip=None,
                       checkable=False, signal="triggered()"):
 
@@ -1284,7 +1717,15 @@ class RTBSA(QMainWindow):
 # TODO I bless the rains down in Africa!
 def main():
     app = QApplication(argv)
-    window = RTBSA()
+
+    # --simulate runs off of simulated PVs instead of Channel Access
+    source = None
+    if "--simulate" in argv:
+        # Stamped with the real time, so the callback latency means something
+        source = rtbsaSource.SimulatedSource(startTime=time())
+        source.start()
+
+    window = RTBSA(source=source)
     window.show()
     exit(app.exec_())
 
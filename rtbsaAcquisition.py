@@ -0,0 +1,481 @@
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+from time import time
+from traceback import print_exc
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from rtbsaBuffer import PulseStore, MAX_HISTORY_LENGTH, HSTBR_LENGTH
+import rtbsaSync
+
+
+# How many PVs' histories are kept around after they stop being watched
+HISTORY_CACHE_SIZE = 8
+
+# How long call() waits for the worker to get to a command, in seconds
+CALL_TIMEOUT = 5.0
+
+
+# Marks queue entries that are commands from the GUI rather than samples
+_CALL = object()
+_STOP = object()
+
+
+# A PV's history as of when it stopped being watched: the pulse keys and
+# values of its shots (oldest first), the fiducials between shots, the
+# timestamp of its last sample and how many rows its window had
+CachedHistory = namedtuple("CachedHistory",
+                           "keys values step timeStamp length")
+
+
+############################################################################
+# One published copy of the raw column store, along with how many times each
+# device's column had changed as of the snapshot
+############################################################################
+class Snapshot(PulseStore):
+
+    def __init__(self, devices, capacity):
+        PulseStore.__init__(self, devices, capacity)
+        self.generations = dict.fromkeys(devices, 0)
+
+
+############################################################################
+# The acquisition worker owns the raw buffers, which are the columns of one
+# PulseStore (one per device, however many devices there are). The pyepics
+# callbacks only queue up what they're handed (which is cheap, so they never
+# hold the CA thread up), and this thread is the only thing that ever writes
+# to the raw buffers.
+#
+# At most once every publishInterval seconds, the raw buffers get copied into
+# the back half of a pair of preallocated snapshot buffers, which is then
+# swapped to the front. The renderer only ever reads the front half (through
+# snapshot()), so a burst of callbacks can't tear the arrays being drawn,
+# and a slow redraw can't hold up ingestion. If the renderer is still
+# holding the half that would be written next, that publish is skipped and
+# retried on the next interval.
+#
+# Anything else that needs to touch the raw buffers (resets, truncation,
+# changing the devices) goes through call(), so that it's ordered with
+# respect to the samples already in the queue.
+#
+# A sample or command that raises gets its traceback printed and is skipped,
+# so one bad callback can't take the whole thread down with it.
+#
+# When a device gets switched to another PV (or the devices get changed
+# altogether), the history of the PV it was watching goes into an LRU cache
+# of the last HISTORY_CACHE_SIZE of them. Switching back to one puts its
+# history straight back in the column (see restoreHistories), so only the
+# pulses it missed in the meantime need filling in.
+############################################################################
+class AcquisitionWorker(Thread):
+
+    def __init__(self, getRate, devices=("A", "B"), publishInterval=0.05,
+                 capacity=MAX_HISTORY_LENGTH):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.getRate = getRate
+        self.publishInterval = publishInterval
+        self.capacity = capacity
+
+        self._front = 0
+        self._held = None
+        self._lock = Lock()
+
+        self._queue = Queue()
+        self._dirty = False
+
+        # Bumped every time a new snapshot is published
+        self.generation = 0
+
+        # PV name -> CachedHistory, least recently watched first
+        self.historyCache = OrderedDict()
+        self.historyCacheSize = HISTORY_CACHE_SIZE
+
+        # The newest pulse key any device has had a sample for, which is how
+        # old the cached histories get measured against
+        self.latestKey = -1
+
+        self._allocate(devices)
+
+        # Functions to call (on this thread, with the device name) whenever a
+        # history buffer has been received, so nobody has to poll for it
+        self.historyListeners = []
+
+        # If set (to an rtbsaTiming.StageTimings), gets the latency of every
+        # callback and how long each sample takes to go into the buffers
+        self.timings = None
+
+    def _allocate(self, devices):
+        self.devices = list(devices)
+
+        # The raw, unsynchronized, unfiltered buffers
+        self.store = PulseStore(self.devices, self.capacity)
+
+        # Two sets of snapshot buffers, one being drawn from (the front) and
+        # one being written to (the back)
+        self._snapshots = [Snapshot(self.devices, self.capacity)
+                           for _ in range(2)]
+
+        # Bumped every time a device's raw buffer changes, so whoever's
+        # drawing it can tell whether there's anything new to draw
+        self.generations = dict.fromkeys(self.devices, 0)
+
+        # The times when each buffer finished its last data acquisition
+        self.timeStamps = dict.fromkeys(self.devices)
+
+        # The pulse key of the most recent sample from each device
+        self.pulseKeys = dict.fromkeys(self.devices)
+
+        # Used for the kill switch
+        self.counter = dict.fromkeys(self.devices, 0)
+
+        # The PV each device's column holds the history of, if anybody said
+        # (see restoreHistories), and the devices whose next history buffer
+        # only fills in the shots missing from a restored one
+        self.watching = dict.fromkeys(self.devices)
+        self._gapFills = set()
+
+    # Called from the pyepics callback thread, so it does as little as possible
+    def submit(self, device, pvname, timestamp, value, nanoseconds=None):
+        if self.timings is not None:
+            self.timings.recordLatency(timestamp)
+
+        self._queue.put((device, pvname, timestamp, value, nanoseconds))
+
+    def stop(self):
+        self._queue.put((_STOP,))
+
+    def run(self):
+        nextPublish = time() + self.publishInterval
+
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, nextPublish - time()))
+            except Empty:
+                item = None
+
+            if item is not None:
+                if item[0] is _STOP:
+                    return
+
+                elif item[0] is _CALL:
+                    self._runCall(*item[1:])
+
+                else:
+                    try:
+                        if self.timings is not None:
+                            with self.timings.stage("ingest"):
+                                self.updateTimeAndBuffer(*item)
+                        else:
+                            self.updateTimeAndBuffer(*item)
+
+                    except Exception:
+                        print("Error handling a sample from " + str(item[1]))
+                        print_exc()
+
+            now = time()
+            if now >= nextPublish:
+                if self._dirty:
+                    self.publish()
+                nextPublish = now + self.publishInterval
+
+    ########################################################################
+    # Runs func on the worker thread, then publishes and waits for it to
+    # finish, so the next snapshot reflects whatever it did. Returns what
+    # func did, or raises whatever it raised (or a RuntimeError if the
+    # worker didn't get to it within CALL_TIMEOUT seconds). If the thread
+    # isn't running (e.g. when a script or benchmark feeds the worker by
+    # calling updateTimeAndBuffer itself), func just runs right here
+    ########################################################################
+    def call(self, func, *args):
+        if not self.is_alive():
+            result = func(*args)
+            self.publish()
+            return result
+
+        done = Event()
+        outcome = []
+        self._queue.put((_CALL, func, args, done, outcome))
+
+        if not done.wait(CALL_TIMEOUT):
+            raise RuntimeError("The acquisition worker didn't get to "
+                               + getattr(func, "__name__", "a command")
+                               + " within {} s".format(CALL_TIMEOUT))
+
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    # The worker's side of call(): hands back (result, exception)
+    def _runCall(self, func, args, done, outcome):
+        try:
+            result = func(*args)
+            self.publish()
+            outcome.append((result, None))
+
+        except Exception as error:
+            print("Error in acquisition command "
+                  + getattr(func, "__name__", repr(func)))
+            print_exc()
+            outcome.append((None, error))
+
+        finally:
+            done.set()
+
+    def flush(self):
+        self.call(lambda: None)
+
+    def reset(self, device):
+        def resetDevice():
+            self.timeStamps[device] = None
+            self.pulseKeys[device] = None
+            self.generations[device] += 1
+
+        self.call(resetDevice)
+
+    # Every device shares the one window, so this truncates all of them
+    def truncate(self, length):
+        def truncateStore():
+            self.store.truncate(length)
+            self._touchAll()
+
+        self.call(truncateStore)
+
+    ########################################################################
+    # Starts over with a column for each of the given devices, which throws
+    # out everything in the buffers. Samples for devices that aren't in the
+    # new list get dropped, so the callbacks of the old ones should be
+    # cleared first.
+    ########################################################################
+    def setDevices(self, devices):
+        def reallocate():
+            for device in self.devices:
+                self._retire(device)
+
+            with self._lock:
+                self._allocate(devices)
+                self._front = 0
+                self._held = None
+
+        self.call(reallocate)
+
+    ########################################################################
+    # Points each of the given devices (a dict of device -> PV name) at a
+    # new PV, caching the history of whatever it was watching before. The
+    # ones whose PV is in the cache get its history back right away, as long
+    # as it's from the current rate, covers at least length shots (or the
+    # whole history buffer) and its newest shot is still inside a window of
+    # length shots ending at the newest pulse anybody's seen; the rest are
+    # reset to wait for their history buffer. Returns the devices that got
+    # their history back, whose next history buffer only fills in the shots
+    # they don't have.
+    ########################################################################
+    def restoreHistories(self, pvs, length):
+        def restore():
+            # All of them go into the cache first, so swapping A and B works
+            for device in pvs:
+                self._retire(device)
+
+            rate = self.getRate()
+            step = rtbsaSync.fiducialsPerShot(rate) if rate >= 1 else None
+            restored = []
+
+            for device, pv in pvs.items():
+                self.watching[device] = pv
+                self._gapFills.discard(device)
+                cached = self.historyCache.pop(pv, None)
+
+                if (cached is None or step is None or not cached.keys.size
+                        or cached.step != step
+                        or cached.length < min(length, HSTBR_LENGTH)
+                        or self.latestKey - cached.keys[-1] >= length * step):
+                    self.timeStamps[device] = None
+                    self.pulseKeys[device] = None
+                    continue
+
+                self.store.seed(device, cached.values, cached.keys,
+                                cached.step)
+                self.timeStamps[device] = cached.timeStamp
+                self.pulseKeys[device] = int(cached.keys[-1])
+                self.counter[device] = 0
+                self._gapFills.add(device)
+                restored.append(device)
+
+            self._touchAll()
+            return restored
+
+        return self.call(restore)
+
+    # Puts the history of the PV the device's been watching in the cache
+    def _retire(self, device):
+        pv = self.watching[device]
+        if pv is None or not self.timeStamps[device]:
+            return
+
+        order = self.store.rowOrder()
+        keys = self.store.pulseIds[order]
+        rows = order[keys >= 0]
+
+        self.historyCache.pop(pv, None)
+        self.historyCache[pv] = CachedHistory(
+            self.store.pulseIds[rows],
+            self.store.data[rows, self.store.columns[device]],
+            self.store.step, self.timeStamps[device], self.store.length)
+
+        while len(self.historyCache) > self.historyCacheSize:
+            self.historyCache.popitem(last=False)
+
+        self.watching[device] = None
+
+    def _touchAll(self):
+        for device in self.generations:
+            self.generations[device] += 1
+
+    def publish(self):
+        back = 1 - self._front
+
+        with self._lock:
+            if self._held == back:
+                return
+
+        self.store.flushCoMomentMatrix()
+        self._snapshots[back].copyFrom(self.store)
+        self._snapshots[back].generations.update(self.generations)
+
+        with self._lock:
+            self._front = back
+            self.generation += 1
+
+        self._dirty = False
+
+    # The generations of the given devices' buffers in the front snapshot
+    # (devices that aren't being watched right now never change)
+    def publishedGenerations(self, devices):
+        with self._lock:
+            generations = self._snapshots[self._front].generations
+            return tuple(generations.get(device) for device in devices)
+
+    ########################################################################
+    # Hands out the front Snapshot for as long as the with block lasts. It
+    # must not be written to, and there's only meant to be one reader (the
+    # GUI thread).
+    ########################################################################
+    @contextmanager
+    def snapshot(self):
+        with self._lock:
+            front = self._front
+            self._held = front
+
+        try:
+            yield self._snapshots[front]
+        finally:
+            with self._lock:
+                self._held = None
+
+    ########################################################################
+    # This is where the data is actually acquired and saved to the buffers.
+    # Callbacks are effectively listeners that listen for change, so we
+    # basically put a callback on the PVs of interest (however many devices
+    # are being watched) so that every time the value of that PV changes, we
+    # get that new value and write it to that device's column of the raw
+    # data.
+    # Initialization of the buffer is slightly different in that the listener is
+    # put on the history buffer of that PV (denoted by the HSTBR suffix), so
+    # that we just immediately write the previous 2800 points to our raw buffer
+    # (the buffers can hold a lot more than that, so whatever's older than
+    # the history buffer starts out as nans and fills in from the BR PV)
+    #
+    # Every sample goes in the row of the (unwrapped) pulse ID from its
+    # timestamp, which is what lines the devices up
+    ########################################################################
+    def updateTimeAndBuffer(self, device, pvname, timestamp, value,
+                            nanoseconds=None):
+
+        # Left over from a device that's since been dropped
+        if device not in self.generations:
+            return
+
+        key = rtbsaSync.pulseKey(timestamp, nanoseconds)
+        headKey = self.store.headKey
+        self.latestKey = max(self.latestKey, key)
+
+        if "HSTBR" in pvname:
+            rate = self.getRate()
+            keys = step = None
+
+            # The history buffer only comes with the timestamp of its newest
+            # point, so the keys of the older ones are inferred from the rate
+            if rate >= 1:
+                keys = rtbsaSync.historyPulseKeys(key, value.size, rate)
+                step = rtbsaSync.fiducialsPerShot(rate)
+
+            # A history that came out of the cache just gets the shots it
+            # missed filled in (and the BR PV may have moved on already)
+            if device in self._gapFills:
+                self._gapFills.discard(device)
+
+                if keys is not None:
+                    self.store.seed(device, value, keys, step,
+                                    onlyMissing=True)
+
+                self.pulseKeys[device] = max(self.pulseKeys[device], key)
+                self.timeStamps[device] = max(self.timeStamps[device],
+                                              timestamp)
+
+            else:
+                self.store.seed(device, value, keys, step)
+                self.pulseKeys[device] = key
+                self.timeStamps[device] = timestamp
+
+                # Reset the counter every time we reinitialize the plot
+                self.counter[device] = 0
+
+            for listener in self.historyListeners:
+                listener(device)
+
+        else:
+            if not self.timeStamps[device]:
+                return
+
+            rate = self.getRate()
+            if rate < 1:
+                return
+
+            if self.pulseKeys[device] is None:
+                elapsedPulses = 1
+            else:
+                elapsedPulses = rtbsaSync.elapsedShots(self.pulseKeys[device],
+                                                       key, rate)
+
+            if elapsedPulses <= 0:
+                return
+
+            # The rows of any pulses this device missed just stay nan. If it's
+            # so far behind the others that its row is gone, it's dropped
+            if not self.store.write(device, key, value,
+                                    rtbsaSync.fiducialsPerShot(rate)):
+                return
+
+            # A restored history's first sample can come long after its last
+            # one, and that catch-up shouldn't count towards the kill switch
+            if device in self._gapFills:
+                self.counter[device] += 1
+            else:
+                self.counter[device] += elapsedPulses
+
+            self.timeStamps[device] = timestamp
+            self.pulseKeys[device] = key
+
+        # A new shot moves every device's window along, not just this one's
+        if self.store.headKey != headKey:
+            self._touchAll()
+        else:
+            self.generations[device] += 1
+
+        self._dirty = True
@@ -0,0 +1,461 @@
+from numpy import (empty, nan, int64, asarray, arange, full, where, isnan,
+                   isfinite, zeros, flatnonzero)
+
+from rtbsaStats import (RunningStats, StreamingPolyFit, RunningCoMoments,
+                        RunningHistogram2D, RunningCoMomentMatrix)
+
+
+# Length of the HSTBR history waveforms served by the BSA IOCs
+HSTBR_LENGTH = 2800
+
+# How many points we're willing to keep client side (5 minutes at 120Hz). The
+# HSTBR waveform only seeds the newest HSTBR_LENGTH of them, and the rest
+# fill in from the BR PV as it updates
+MAX_HISTORY_LENGTH = 120 * 60 * 5
+
+
+############################################################################
+# The pulse-aligned buffers of any number of BSA signals, kept in one
+# preallocated (pulse x device) array. Every row is one shot and every column
+# one device, so whatever the devices measured on the same shot sits side by
+# side, and lining them up is just picking the rows they all have a value in.
+# Watching another device costs one more column rather than another buffer
+# to keep in step with the rest.
+#
+# The rows wrap around like a ring buffer's slots: head is the newest row and
+# length the number of rows in use, out of the capacity that was allocated up
+# front (so the window can shrink to the number of points asked for without
+# reallocating anything). Every row holds the pulse key of its shot. A
+# sample from a shot newer than the head moves the head up to that shot,
+# and the rows in between get the keys of the shots that were skipped,
+# so a device whose callbacks lag behind the others' still has a row to land
+# in. Cells that never got a sample (dropped pulses, devices that aren't
+# being fed) are nan.
+#
+# stats and fits keep the running statistics of the first two columns (the
+# fits are against the pulse keys), which are the ones that get plotted on
+# their own, and coMoments, pairFit and pairDensity those of their pairs. The
+# rest of the columns are only there for the correlation matrix, so keeping
+# their own would just slow down every sample. They're all updated as cells
+# are written and rows evicted, and rebuilt from scratch every window's worth
+# of evicted rows.
+#
+# With more than two devices, coMomentMatrix keeps the co-moments of every
+# pair of columns too. Rather than paying for a pass over every column on
+# every sample, the rows that changed are just marked, and
+# flushCoMomentMatrix() takes their old contents out and puts the new ones
+# in as one batch of matrix products (the acquisition worker does it before
+# every publish).
+############################################################################
+class PulseStore(object):
+
+    def __init__(self, devices, capacity=HSTBR_LENGTH):
+        self.devices = list(devices)
+        self.columns = dict((device, column)
+                            for column, device in enumerate(self.devices))
+
+        self.capacity = capacity
+        self.length = capacity
+
+        self.data = empty((capacity, len(self.devices)))
+        self.pulseIds = empty(capacity, dtype=int64)
+
+        # Scratch space that ordered_view writes into
+        self._ordered = empty(capacity)
+
+        self.head = -1
+
+        # The spacing of the pulse keys of the newest rows
+        self.step = None
+
+        # x is the first device, y the second
+        self.pairedDevices = tuple(self.devices[:2])
+        self._tracked = [(device, self.columns[device])
+                         for device in self.pairedDevices]
+
+        self.stats = dict((device, RunningStats())
+                          for device in self.pairedDevices)
+        self.fits = dict((device, StreamingPolyFit())
+                         for device in self.pairedDevices)
+        self._paired = len(self.pairedDevices) == 2
+        self.coMoments = RunningCoMoments()
+        self.pairFit = StreamingPolyFit()
+        self.pairDensity = RunningHistogram2D()
+
+        self.coMomentMatrix = None
+        if len(self.devices) > 2:
+            self.coMomentMatrix = RunningCoMomentMatrix(len(self.devices))
+
+            # What each row held the last time it went into coMomentMatrix,
+            # and which rows have changed since
+            self._accounted = empty((capacity, len(self.devices)))
+            self._changed = zeros(capacity, dtype=bool)
+
+        # Number of rows taken out of the statistics (plus cells overwritten)
+        # since they were last rebuilt. Counting cells instead would rebuild
+        # every device's statistics once per window / number of devices
+        self._evictions = 0
+
+        self.reset()
+
+    def reset(self):
+        self.data[:] = nan
+        self.pulseIds[:] = -1
+        self.head = -1
+        self.rebuildStats()
+
+    @property
+    def headKey(self):
+        return int(self.pulseIds[self.head]) if self.head >= 0 else -1
+
+    # Recomputes the running statistics from scratch to flush out the rounding
+    # error that taking samples out of them accumulates
+    def rebuildStats(self):
+        window, keys = self.data[:self.length], self.pulseIds[:self.length]
+        keyed = keys >= 0
+
+        for device, column in self._tracked:
+            self.stats[device].rebuild(window[:, column])
+            self.fits[device].rebuild(keys[keyed], window[keyed, column],
+                                      newestLast=True)
+
+        if self._paired:
+            pairs = window[:, 0], window[:, 1]
+            self.coMoments.rebuild(*pairs)
+            self.pairFit.rebuild(*pairs)
+            self.pairDensity.rebuild(*pairs)
+
+        if self.coMomentMatrix is not None:
+            self.coMomentMatrix.rebuild(window)
+            self._accounted[:self.length] = window
+            self._changed[:] = False
+
+        self._evictions = 0
+
+    # Brings coMomentMatrix up to date with the rows that have changed
+    def flushCoMomentMatrix(self):
+        if self.coMomentMatrix is None:
+            return
+
+        rows = flatnonzero(self._changed[:self.length])
+        if not rows.size:
+            return
+
+        self.coMomentMatrix.removeRows(self._accounted[rows])
+        self._accounted[rows] = self.data[rows]
+        self.coMomentMatrix.addRows(self._accounted[rows])
+        self._changed[rows] = False
+
+    def _evicted(self, numEvicted):
+        self._evictions += numEvicted
+        if self._evictions >= self.length:
+            self.rebuildStats()
+
+    # Makes this store an exact copy of other without reallocating anything
+    # (both need the same devices and capacity)
+    def copyFrom(self, other):
+        length = other.length
+
+        self.data[:length] = other.data[:length]
+        self.pulseIds[:length] = other.pulseIds[:length]
+
+        self.length = length
+        self.head = other.head
+        self.step = other.step
+
+        for device in self.pairedDevices:
+            self.stats[device].copyFrom(other.stats[device])
+            self.fits[device].copyFrom(other.fits[device])
+
+        self.coMoments.copyFrom(other.coMoments)
+        self.pairFit.copyFrom(other.pairFit)
+        self.pairDensity.copyFrom(other.pairDensity)
+
+        if self.coMomentMatrix is not None:
+            self.coMomentMatrix.copyFrom(other.coMomentMatrix)
+
+    # The rows in use, from the oldest shot to the newest
+    def rowOrder(self):
+        return (self.head + 1 + arange(self.length)) % self.length
+
+    # Whether the pulse keys go up by step from each row to the next all the
+    # way back (rows that haven't been given a shot yet aside), which stops
+    # being true for a window's worth of shots after the rate changes
+    def evenlySpaced(self):
+        if self.head < 0 or not self.step:
+            return False
+
+        keys = self.pulseIds[self.rowOrder()]
+        expected = self.headKey - self.step * arange(self.length - 1, -1, -1)
+        keyed = keys >= 0
+        return bool((keys[keyed] == expected[keyed]).all())
+
+    ########################################################################
+    # The rows of the given pulse keys, or -1 where there isn't one. The rows
+    # go one shot after another, so a row is just an offset back from the
+    # head (which gets double-checked against the key that's actually
+    # stored there). If claim is set, rows that haven't been given a shot
+    # yet get the keys that would land in them.
+    ########################################################################
+    def rowsOf(self, keys, claim=False):
+        keys = asarray(keys, dtype=int64)
+        headKey = self.headKey
+
+        if headKey < 0 or not self.step:
+            return full(keys.shape, -1, dtype=int64)
+
+        offsets = (headKey - keys) // self.step
+        rows = (self.head - offsets) % self.length
+        inWindow = (offsets >= 0) & (offsets < self.length)
+
+        if claim:
+            unclaimed = (inWindow & (self.pulseIds[rows] < 0)
+                         & ((headKey - keys) % self.step == 0))
+            self.pulseIds[rows[unclaimed]] = keys[unclaimed]
+
+        return where(inWindow & (self.pulseIds[rows] == keys), rows, -1)
+
+    def rowOf(self, key):
+        headKey = self.headKey
+
+        if headKey < 0 or not self.step:
+            return -1
+
+        offset = (headKey - key) // self.step
+        if not 0 <= offset < self.length:
+            return -1
+
+        row = (self.head - offset) % self.length
+        return row if self.pulseIds[row] == key else -1
+
+    ########################################################################
+    # Moves the head up to the shot with the given key, evicting the oldest
+    # rows to make room for it and for any shots in between. Returns False
+    # if the key isn't newer than the head.
+    ########################################################################
+    def advance(self, key, step):
+        headKey = self.headKey
+
+        if headKey < 0:
+            numShots = 1
+        else:
+            numShots = int(round(float(key - headKey) / step))
+
+        if numShots <= 0:
+            return False
+
+        self.step = step
+
+        # One shot at a time is by far the most common case, and isn't worth
+        # going through arrays for
+        if numShots == 1:
+            self.head = (self.head + 1) % self.length
+            self._evictRow(self.head)
+            self.pulseIds[self.head] = key
+            return True
+
+        numRows = min(numShots, self.length)
+        rows = (self.head + 1 + arange(numRows)) % self.length
+
+        self._evictRows(rows)
+        self.pulseIds[rows] = key - step * arange(numRows - 1, -1, -1)
+
+        self.head = int(rows[-1])
+        return True
+
+    def _evictRow(self, row):
+        values = self.data[row]
+        key = float(self.pulseIds[row])
+        evicted = not isnan(values).all()
+
+        if self._paired:
+            self._updatePair(row, -1)
+
+        for device, column in self._tracked:
+            value = values[column]
+            if not isnan(value):
+                self.stats[device].remove(value)
+                if key >= 0:
+                    self.fits[device].remove(key, value)
+
+        if evicted and self.coMomentMatrix is not None:
+            self._changed[row] = True
+
+        values[:] = nan
+        self.pulseIds[row] = -1
+
+        if evicted:
+            self._evicted(1)
+
+    def _evictRows(self, rows):
+        values = self.data[rows]
+        keys = self.pulseIds[rows]
+
+        if not isnan(values).all():
+            keyed = keys >= 0
+
+            for device, column in self._tracked:
+                self.stats[device].removeMany(values[:, column])
+                self.fits[device].removeMany(keys[keyed],
+                                             values[keyed, column])
+
+            if self._paired:
+                pairs = values[:, 0], values[:, 1]
+                self.coMoments.removeMany(*pairs)
+                self.pairFit.removeMany(*pairs)
+                self.pairDensity.removeMany(*pairs)
+
+            if self.coMomentMatrix is not None:
+                self._changed[rows] = True
+
+            self._evicted(int(isfinite(values).any(axis=1).sum()))
+
+        self.data[rows] = nan
+        self.pulseIds[rows] = -1
+
+    def _updatePair(self, row, sign):
+        x, y = self.data[row, 0], self.data[row, 1]
+
+        if sign > 0:
+            self.coMoments.add(x, y)
+            self.pairFit.add(x, y)
+            self.pairDensity.add(x, y)
+        else:
+            self.coMoments.remove(x, y)
+            self.pairFit.remove(x, y)
+            self.pairDensity.remove(x, y)
+
+    ########################################################################
+    # Puts a device's sample from the shot with the given key in its row,
+    # first moving the head up if it's the newest shot yet. step is the
+    # spacing of the keys at the current rate. Returns False if the shot is
+    # too old to still have a row.
+    ########################################################################
+    def write(self, device, key, value, step):
+        if key > self.headKey:
+            self.advance(key, step)
+
+        row = self.rowOf(key)
+        if row < 0:
+            return False
+
+        column = self.columns[device]
+        oldValue = self.data[row, column]
+        paired = self._paired and column < 2
+
+        if paired:
+            self._updatePair(row, -1)
+
+        fit = self.fits.get(device)
+        if fit is not None:
+            self.stats[device].remove(oldValue)
+            self.stats[device].add(value)
+            fit.remove(float(key), oldValue)
+            fit.add(float(key), value)
+
+        self.data[row, column] = value
+
+        if paired:
+            self._updatePair(row, 1)
+
+        if self.coMomentMatrix is not None:
+            self._changed[row] = True
+
+        if not isnan(oldValue):
+            self._evicted(1)
+
+        # Re-bin if the pairs have wandered off of the density map, and
+        # re-center the fits if a sample landed too far out for them
+        if (fit is not None and fit.stale or paired
+                and (self.pairDensity.stale or self.pairFit.stale)):
+            self.rebuildStats()
+
+        return True
+
+    ########################################################################
+    # Replaces a device's column with an HSTBR waveform (or anything else
+    # that comes with the keys of its shots), moving the head up first if it
+    # goes past it. Without keys, the values just fill the newest rows. With
+    # onlyMissing (and keys), the column is kept and only its nans get
+    # filled in.
+    ########################################################################
+    def seed(self, device, values, pulseIds=None, step=None,
+             onlyMissing=False):
+        values = asarray(values, dtype=float)
+        column = self.columns[device]
+
+        if not onlyMissing:
+            self.data[:self.length, column] = nan
+
+        if pulseIds is None:
+            n = min(values.size, self.length)
+            if self.head < 0:
+                self.head = n - 1 if n else -1
+
+            rows = (self.head - arange(n - 1, -1, -1)) % self.length
+            self.data[rows, column] = values[values.size - n:]
+
+        elif values.size:
+            pulseIds = asarray(pulseIds, dtype=int64)
+            if pulseIds[-1] > self.headKey:
+                self.advance(int(pulseIds[-1]), step)
+
+            rows = self.rowsOf(pulseIds, claim=True)
+            found = rows >= 0
+            if onlyMissing:
+                found &= isnan(self.data[rows, column])
+
+            self.data[rows[found], column] = values[found]
+
+        self.rebuildStats()
+
+    ########################################################################
+    # Returns a device's column ordered from oldest to newest shot. It's a
+    # view into a scratch array (allocated once, up front) that gets
+    # overwritten by the next call.
+    ########################################################################
+    def ordered_view(self, device):
+        column = self.columns[device]
+        length = self.length
+        start = (self.head + 1) % length
+        tail = length - start
+
+        self._ordered[:tail] = self.data[start:length, column]
+        self._ordered[tail:length] = self.data[:start, column]
+
+        return self._ordered[:length]
+
+    ########################################################################
+    # The given devices' samples from the shots that all of them have one
+    # for, as one array per device, ordered from oldest to newest shot
+    ########################################################################
+    def aligned(self, devices):
+        columns = [self.columns[device] for device in devices]
+        window = self.data[:self.length, columns]
+
+        keep = isfinite(window).all(axis=1) & (self.pulseIds[:self.length]
+                                               >= 0)
+        order = self.rowOrder()
+        rows = order[keep[order]]
+
+        return tuple(window[rows].T.copy())
+
+    ########################################################################
+    # Shrinks the window to the newest length rows, compacting them to the
+    # front of the array in time order, for every column at once (so the
+    # raw row order and the time order agree again afterwards)
+    ########################################################################
+    def truncate(self, length):
+        length = max(1, min(length, self.capacity))
+        newest = self.rowOrder()[max(0, self.length - length):]
+        n = newest.size
+        wasEmpty = self.head < 0
+
+        self.data[:n] = self.data[newest]
+        self.data[n:length] = nan
+        self.pulseIds[:n] = self.pulseIds[newest]
+        self.pulseIds[n:length] = -1
+
+        self.length = length
+        self.head = -1 if wasEmpty else (n - 1) % length
+        self.rebuildStats()
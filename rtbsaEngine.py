@@ -0,0 +1,456 @@
+from collections import OrderedDict
+
+from numpy import (arange, isnan, abs, polyfit, linspace, nanmin, nanmax,
+                   ix_)
+
+from rtbsaAcquisition import AcquisitionWorker
+from rtbsaBuffer import MAX_HISTORY_LENGTH
+from rtbsaStats import (StreamingPolyFit, RunningHistogram2D,
+                        RunningCoMomentMatrix)
+from rtbsaFilter import FilterPipeline
+from rtbsaSpectrum import WelchSpectrum, Spectrogram
+
+
+# How many points the fit curves get drawn with
+FIT_GRID_POINTS = 200
+
+
+############################################################################
+# Everything that decides what the engine computes. The GUI copies its
+# checkboxes and text boxes in here, and anything else (scripts, benchmarks)
+# just sets the attributes. Call changed() after changing anything that
+# should make the plots redraw, so the caches know to throw out what they've
+# got.
+############################################################################
+class EngineConfig(object):
+
+    def __init__(self, numPoints=2800, stdDevsToKeep=3.0, fitOrder=2,
+                 hardLimits=None):
+        # The PV name behind each device, in the order of their columns in
+        # the raw buffers. The plots only ever look at A and B, but any
+        # number of devices can be watched at once
+        self.devices = OrderedDict([("A", ""), ("B", "")])
+
+        # How many of the newest points get plotted
+        self.numPoints = numPoints
+
+        # Whether to cut outliers, how far out to cut them, and whether to
+        # cut around the median instead of the mean
+        self.stdDevCut = False
+        self.stdDevsToKeep = stdDevsToKeep
+        self.robustCut = False
+
+        # The order of the polynomial fit
+        self.fitOrder = fitOrder
+
+        # The (low, high) limits on the values we'll believe from each PV
+        self.hardLimits = dict(hardLimits or {})
+
+        # Whether B vs A gets drawn as a density map when it's big, and the
+        # A FFT as a waterfall
+        self.densityMap = True
+        self.waterfall = False
+
+        # Bumped by changed()
+        self.generation = 0
+
+    def changed(self):
+        self.generation += 1
+
+
+############################################################################
+# The acquisition and analysis behind the plots, without any Qt in it: it
+# owns the acquisition worker (and so the raw buffers), and turns the
+# snapshots it publishes into the synchronized and filtered buffers, the
+# running statistics and fits, and the spectra that get drawn.
+#
+# The results of each stage are cached against the generations of the data
+# and of the config they came from, so asking for them again when nothing's
+# changed is free. Like the snapshots, they're only meant to be read from one
+# thread.
+############################################################################
+class Engine(object):
+
+    def __init__(self, config, getRate, publishInterval=0.05,
+                 capacity=MAX_HISTORY_LENGTH):
+        self.config = config
+        self.capacity = capacity
+
+        # Owns the raw buffers, which the callbacks feed from the CA thread.
+        # Everything here only ever reads the snapshots it publishes
+        self.acquisition = AcquisitionWorker(getRate, list(config.devices),
+                                             publishInterval=publishInterval,
+                                             capacity=capacity)
+
+        # The pulse-aligned samples of the devices that were last
+        # synchronized, by device
+        self.synchronizedBuffers = {}
+
+        # Versions of data buffers A and B with the nans, hard limit and
+        # standard deviation cuts applied. Didn't want to edit those buffers
+        # directly so that we could unfilter or refilter with a different
+        # number more efficiently
+        self.filteredBuffers = {}
+
+        # Index of every slot, to filter along with A for the time plot
+        self.slotIndices = arange(capacity, dtype=float)
+
+        # The cuts for each plot, in the order they get applied
+        self.timePlotFilter = self.genFilterPipeline(["A"], "index")
+        self.pairFilter = self.genFilterPipeline(["A", "B"])
+
+        # The running statistics of the raw buffers, as of the last snapshot,
+        # and how many rows the window they cover had
+        self.overlayStats = {}
+        self.overlayLength = 0
+
+        # The running fit sums of the raw buffers, as of the last snapshot,
+        # along with (a, b) such that x = a * (plot x coordinate) + b for the
+        # x the sums were kept in. fitAxis is None if they can't be used
+        self.overlayFit = StreamingPolyFit()
+        self.fitAxis = None
+
+        # The density map of the B vs A pairs, as of the last snapshot (or
+        # of the filtered buffers, if anything but nans got cut)
+        self.overlayDensity = RunningHistogram2D()
+
+        # The spectral engine behind "Plot A FFT", which hangs on to the
+        # spectra of the segments it's already transformed
+        self.spectrum = WelchSpectrum()
+
+        # The history of the spectra for the waterfall view
+        self.spectrogram = Spectrogram()
+
+        # The inputs each stage last ran on, so stages whose inputs haven't
+        # changed can be skipped
+        self.viewCache = {}
+
+    def start(self):
+        self.acquisition.start()
+
+    def stop(self):
+        self.acquisition.stop()
+
+    ########################################################################
+    # Watches the given (device, PV name) pairs instead, which starts the
+    # raw buffers over with a column for each. A and B should stay in there
+    # for the plots that use them.
+    ########################################################################
+    def setDevices(self, devices):
+        self.config.devices = OrderedDict(devices)
+        self.acquisition.setDevices(list(self.config.devices))
+
+        self.synchronizedBuffers = {}
+        self.filteredBuffers = {}
+        self.viewCache = {}
+        self.config.changed()
+
+    # What the results for the given devices depend on. Nothing needs to be
+    # recomputed unless this changes
+    def frameKey(self, devices):
+        return (self.acquisition.publishedGenerations(devices),
+                self.config.generation)
+
+    ############################################################################
+    # Device A and device B are not guaranteed to start acquisition at the same
+    # time, drop the same pulses, or have their callbacks fire in the same
+    # order, so their raw buffers can't just be laid on top of each other. See
+    # the diagram below, where the dotted line represents the time axis (one
+    # buffer is contained by square brackets [], the other by curly braces {}).
+    #
+    #
+    #          [           {                            ]           }
+    # <----------------------------------------------------------------------> t
+    #       t1_start    t2_start                     t1_end      t2_end
+    #
+    #
+    # Only the shots between t2_start and t1_end are in both buffers. Rather
+    # than working out how much to chop off of each end from the timestamps
+    # and the beam rate, every sample goes in the row of the pulse it was
+    # taken on (see rtbsaBuffer.PulseStore), so we just keep the rows that
+    # every device has a sample in. Dropped pulses, rate changes and lag
+    # between the callbacks all fall out of that for free, so there's no
+    # need to re-pull the history buffers when they drift apart, and it
+    # works the same for any number of devices.
+    #
+    # The newest numPoints shots are kept. For A and B, the running
+    # statistics of the pairs get picked up from the same snapshot.
+    ############################################################################
+    def synchronize(self, devices=("A", "B")):
+        devices = tuple(devices)
+
+        with self.acquisition.snapshot() as rawBuffers:
+            inputs = (devices, tuple(rawBuffers.generations[device]
+                                     for device in devices))
+
+            # Nothing's changed since the last time we synchronized
+            if inputs != self.viewCache.get("synchronized"):
+                self._synchronize(rawBuffers, devices)
+                self.viewCache["synchronized"] = inputs
+
+        # Make sure the buffer size doesn't exceed the desired number of
+        # points
+        for device in devices:
+            self.synchronizedBuffers[device] = \
+                self.synchronizedBuffers[device][-self.config.numPoints:]
+
+    def _synchronize(self, rawBuffers, devices):
+        self.synchronizedBuffers = dict(zip(devices,
+                                            rawBuffers.aligned(devices)))
+        self.overlayLength = rawBuffers.length
+
+        # The running statistics only cover the first two devices' pairs
+        if devices != rawBuffers.pairedDevices:
+            self.overlayStats = {}
+            self.fitAxis = None
+            return
+
+        deviceX, deviceY = devices
+        coMoments = rawBuffers.coMoments
+        self.overlayStats = {"mean" + deviceX: coMoments.meanX,
+                             "std" + deviceX: coMoments.stdX,
+                             "sampleStd" + deviceX: coMoments.sampleStdX,
+                             "mean" + deviceY: coMoments.meanY,
+                             "std" + deviceY: coMoments.stdY,
+                             "sampleStd" + deviceY: coMoments.sampleStdY,
+                             "corr": coMoments.correlation}
+
+        # The pairs are fit in terms of A itself
+        self.overlayFit.copyFrom(rawBuffers.pairFit)
+        self.fitAxis = (1.0, 0.0)
+
+        self.overlayDensity.copyFrom(rawBuffers.pairDensity)
+
+    ########################################################################
+    # The filtered (slot index, A) points of the time plot. The column store
+    # hands back its window oldest-first, which is what makes it scroll :P
+    # Thanks to Ben for the inspiration!
+    ########################################################################
+    def timeSeries(self):
+        with self.acquisition.snapshot() as rawBuffers:
+            inputs = (rawBuffers.generations["A"], self.config.generation)
+            cached = self.viewCache.get("timePlot")
+
+            if cached and cached[0] == inputs:
+                return cached[1]
+
+            choppedBuffer = rawBuffers.ordered_view("A")
+
+            stats = rawBuffers.stats["A"]
+            self.overlayStats = {"meanA": stats.mean, "stdA": stats.std}
+            self.overlayLength = rawBuffers.length
+
+            # A is fit in terms of pulse keys, and point i on the plot is the
+            # shot (length - 1 - i) steps before the newest one. That only
+            # holds if every shot in the window is step apart, so until the
+            # shots from before a rate change are gone the fit is a polyfit
+            headKey = rawBuffers.headKey
+            self.overlayFit.copyFrom(rawBuffers.fits["A"])
+
+            if rawBuffers.evenlySpaced():
+                self.fitAxis = (float(rawBuffers.step),
+                                float(headKey - (rawBuffers.length - 1)
+                                      * rawBuffers.step))
+            else:
+                self.fitAxis = None
+
+            filtered = self.timePlotFilter.run(
+                {"A": choppedBuffer,
+                 "index": self.slotIndices[:choppedBuffer.size]})
+
+        self.viewCache["timePlot"] = (inputs, (filtered["index"],
+                                               filtered["A"]))
+
+        return filtered["index"], filtered["A"]
+
+    ########################################################################
+    # The filtered (A, B) pairs. Need to filter out errant indices from both
+    # buffers to keep them synchronized, which the pipeline does by cutting
+    # them both with the same mask
+    ########################################################################
+    def pairs(self):
+        self.synchronize()
+
+        inputs = (self.viewCache.get("synchronized"), self.config.numPoints,
+                  self.config.generation)
+
+        if inputs != self.viewCache.get("pairs"):
+            self.viewCache["pairs"] = inputs
+
+            filtered = self.pairFilter.run(self.synchronizedBuffers)
+            self.filteredBuffers["A"] = filtered["A"]
+            self.filteredBuffers["B"] = filtered["B"]
+
+        return self.filteredBuffers["A"], self.filteredBuffers["B"]
+
+    ########################################################################
+    # The cuts that get applied to the given devices' buffers. index names an
+    # extra buffer that just gets carried along (like the plot x coordinates)
+    ########################################################################
+    def genFilterPipeline(self, devices, index=None):
+        config = self.config
+        names = list(devices) + ([index] if index else [])
+        pipeline = FilterPipeline(self.capacity, names)
+
+        # ANDs two masks, either of which can be None (for no cut)
+        def combine(mask, otherMask):
+            return otherMask if mask is None else mask & otherMask
+
+        def nanFilter(buffers, keep):
+            mask = None
+            for device in devices:
+                mask = combine(mask, ~isnan(buffers[device]))
+            return mask
+
+        def hardLimitFilter(buffers, keep):
+            mask = None
+            for device in devices:
+                low, high = config.hardLimits.get(config.devices[device],
+                                                  (None, None))
+                if low is not None:
+                    mask = combine(mask, buffers[device] >= low)
+                if high is not None:
+                    mask = combine(mask, buffers[device] <= high)
+            return mask
+
+        ####################################################################
+        # Cuts at stdDevsToKeep standard deviations around the mean, or in
+        # robust mode, around the median (with the standard deviation
+        # estimated from the median absolute deviation, so the outliers
+        # being cut can't blow it up and let themselves through)
+        ####################################################################
+        def stdDevFilter(buffers, keep):
+            if not config.stdDevCut:
+                return None
+
+            # Only the nans have been cut so far unless the hard limits
+            # kicked in, in which case the running statistics are no good
+            useRunningStats = self.runningStatsApply(pipeline, "std dev")
+
+            mask = None
+            for device in devices:
+                if config.robustCut:
+                    center, spread = pipeline.keptMedianSpread(
+                        buffers[device], keep)
+                elif useRunningStats:
+                    center = self.overlayStats["mean" + device]
+                    spread = self.overlayStats["std" + device]
+                else:
+                    center, spread = pipeline.keptMeanStd(buffers[device],
+                                                          keep)
+
+                mask = combine(mask, self.stdDevFilterFunc(
+                    center, spread)(buffers[device]))
+            return mask
+
+        return (pipeline.addStage("nans", nanFilter)
+                .addStage("hard limits", hardLimitFilter)
+                .addStage("std dev", stdDevFilter))
+
+    def stdDevFilterFunc(self, average, stdDev):
+        return lambda x: abs(x - average) < self.config.stdDevsToKeep * stdDev
+
+    ########################################################################
+    # The running statistics from the acquisition worker cover every (finite)
+    # point in the window, so they only describe what came out of the given
+    # filter if nothing else (other than the given stages) got cut out of it,
+    # and the window is numPoints long (it isn't between numPoints changing
+    # and the window being truncated to match). Otherwise they have to be
+    # computed from the filtered buffers.
+    ########################################################################
+    def runningStatsApply(self, pipeline, *stages):
+        if (not self.overlayStats
+                or self.overlayLength != self.config.numPoints):
+            return False
+
+        return pipeline.onlyCut("nans", *stages)
+
+    ########################################################################
+    # If the running fit sums describe exactly what came out of the filter,
+    # the fit is a small solve off of those instead of a polyfit over every
+    # point
+    ########################################################################
+    def fitCoefficients(self, xData, yData, order, useRunningFit):
+        if useRunningFit and self.fitAxis:
+            co = self.overlayFit.coefficients(order, *self.fitAxis)
+            if co is not None:
+                return co
+
+        return polyfit(xData, yData, order)
+
+    # The fit gets drawn over a fixed number of evenly spaced points, which
+    # saves us sorting the data every update
+    @staticmethod
+    def fitGrid(xData):
+        return linspace(nanmin(xData), nanmax(xData), FIT_GRID_POINTS)
+
+    # The density map of the given (filtered) pairs, which is only rebinned
+    # from them if something other than nans got cut
+    def pairDensity(self, bufferA, bufferB):
+        if not self.runningStatsApply(self.pairFilter):
+            self.overlayDensity.rebuild(bufferA, bufferB)
+
+        return self.overlayDensity
+
+    ########################################################################
+    # The Pearson correlation coefficient of every pair of the given devices,
+    # as a matrix in their order. Each pair gets all of the shots in the
+    # window that both of them have, and none of the cuts apply. It comes
+    # straight from the running co-moments when the raw buffers keep them,
+    # and otherwise from one pass of matrix products over the window.
+    ########################################################################
+    def correlationMatrix(self, devices):
+        with self.acquisition.snapshot() as rawBuffers:
+            inputs = (tuple(devices), tuple(rawBuffers.generations[device]
+                                            for device in devices))
+            cached = self.viewCache.get("correlationMatrix")
+
+            if cached and cached[0] == inputs:
+                return cached[1]
+
+            columns = [rawBuffers.columns[device] for device in devices]
+            coMoments = rawBuffers.coMomentMatrix
+
+            if coMoments is None:
+                coMoments = RunningCoMomentMatrix(len(columns))
+                coMoments.rebuild(rawBuffers.data[:rawBuffers.length,
+                                                  columns])
+                matrix = coMoments.correlation()
+            else:
+                matrix = coMoments.correlation()[ix_(columns, columns)]
+
+        self.viewCache["correlationMatrix"] = (inputs, matrix)
+
+        return matrix
+
+    ########################################################################
+    # The Welch spectrum of the newest numPoints of A, as (frequencies,
+    # spectrum), or None if there's no data. restart throws out the cached
+    # segments and the waterfall, for when the data's been replaced.
+    ########################################################################
+    def updateSpectrum(self, rate, restart=False):
+        if restart:
+            self.spectrum.clear()
+
+        with self.acquisition.snapshot() as rawBuffers:
+            headKey = rawBuffers.headKey
+
+            # The segments are laid out on shot numbers, which is what lets
+            # them be reused as the window scrolls
+            newestShot = (int(headKey // rawBuffers.step)
+                          if headKey >= 0 and rawBuffers.step else None)
+
+            result = self.spectrum.update(
+                rawBuffers.ordered_view("A")[-self.config.numPoints:],
+                newestShot, rate)
+
+        if result is None:
+            return None
+
+        if restart:
+            self.spectrogram.reset(result[0].size)
+
+        for power in self.spectrum.newSegments:
+            self.spectrogram.addRow(power)
+
+        return result
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+from numpy import (empty, compress, count_nonzero, logical_and, copyto, dot,
+                   subtract, errstate)
+from math import sqrt
+
+from rtbsaStats import medianAndSpread
+
+
+############################################################################
+# A chain of cuts applied to a set of equally sized buffers (e.g. A and B, or
+# A and its plot x coordinates) that have to stay lined up with each other.
+#
+# Each stage is a predicate that gets handed the input buffers (by name) and
+# the mask of what's survived the stages before it, and returns a boolean
+# array of what it wants to keep (or None if it's got nothing to cut this
+# time, e.g. because its checkbox isn't checked). The masks all get ANDed
+# into one, and the buffers are compacted exactly once at the end, into
+# output buffers that are allocated up front and reused on every run.
+#
+# rejected holds how many points each stage cut on the last run. A point
+# that more than one stage would have cut is only counted against the first.
+############################################################################
+class FilterPipeline(object):
+
+    def __init__(self, capacity, names):
+        self.capacity = capacity
+        self.names = tuple(names)
+
+        self._stages = []
+        self.rejected = OrderedDict()
+
+        self._keep = empty(capacity, dtype=bool)
+        self._scratch = empty(capacity)
+        self._outputs = dict((name, empty(capacity)) for name in self.names)
+
+    # Returns the pipeline so stages can be chained
+    def addStage(self, name, predicate):
+        self._stages.append((name, predicate))
+        self.rejected[name] = 0
+        return self
+
+    ########################################################################
+    # Returns a dict of the compacted buffers. They're views into the output
+    # buffers, so they're only good until the next run.
+    ########################################################################
+    def run(self, buffers):
+        size = len(buffers[self.names[0]])
+        keep = self._keep[:size]
+        keep[:] = True
+        numKept = size
+
+        # The points that have already been cut are still in there, nans and
+        # all, so comparing them is expected to be noisy
+        with errstate(invalid="ignore"):
+            for name, predicate in self._stages:
+                mask = predicate(buffers, keep)
+
+                if mask is None:
+                    self.rejected[name] = 0
+                    continue
+
+                logical_and(keep, mask, out=keep)
+                stillKept = count_nonzero(keep)
+                self.rejected[name] = numKept - stillKept
+                numKept = stillKept
+
+        return dict((name, compress(keep, buffers[name],
+                                    out=self._outputs[name][:numKept]))
+                    for name in self.names)
+
+    ########################################################################
+    # The mean and (population) standard deviation of the points in values
+    # that keep lets through, for stages that cut relative to what's left.
+    # Goes through scratch space rather than compacting values.
+    ########################################################################
+    def keptMeanStd(self, values, keep):
+        numKept = count_nonzero(keep)
+        if not numKept:
+            return float("nan"), float("nan")
+
+        scratch = self._scratch[:len(values)]
+        scratch[:] = 0
+        copyto(scratch, values, where=keep)
+
+        average = scratch.sum() / numKept
+
+        subtract(scratch, average, out=scratch, where=keep)
+        return average, sqrt(dot(scratch, scratch) / numKept)
+
+    # The robust counterpart of keptMeanStd: the median, and the median
+    # absolute deviation scaled to a standard deviation
+    def keptMedianSpread(self, values, keep):
+        numKept = count_nonzero(keep)
+        return medianAndSpread(compress(keep, values,
+                                        out=self._scratch[:numKept]))
+
+    # Whether nothing but the named stages cut anything on the last run
+    def onlyCut(self, *names):
+        return not any(count for name, count in self.rejected.items()
+                       if name not in names)
+
+    def describeRejections(self):
+        return ", ".join(name + ": " + str(count)
+                         for name, count in self.rejected.items())
@@ -0,0 +1,70 @@
+from numpy import (arange, asarray, concatenate, sort, linspace, array, where,
+                   ubyte)
+
+
+# Past this many points, B vs A gets drawn as a density map (if that's turned
+# on) instead of a marker per point
+DENSITY_MAP_THRESHOLD = 5000
+
+# The ends and middle of the colour scale the correlation matrix is drawn in
+NEGATIVE_COLOUR = (59, 76, 192)
+ZERO_COLOUR = (255, 255, 255)
+POSITIVE_COLOUR = (180, 4, 38)
+
+
+############################################################################
+# Cuts a (time ordered) curve down to what can actually be seen on a plot
+# that's numColumns pixels wide, M4 style: the points are split into
+# numColumns consecutive buckets, and each bucket is replaced by its first,
+# last, minimum and maximum points, in their original order. Drawing those
+# lights up exactly the same pixels as drawing every point, so a single
+# glitch or outlier still shows up (which isn't true of pyqtgraph's own
+# downsampling, which subsamples or averages).
+#
+# The buckets are made the same size by padding the last one with copies of
+# its final point, so the whole thing is a handful of vectorized passes.
+# Curves that are already short enough are handed back untouched.
+############################################################################
+def decimateMinMax(xData, yData, numColumns):
+    xData, yData = asarray(xData), asarray(yData)
+    numPoints = yData.size
+    numColumns = max(1, int(numColumns))
+
+    if numPoints <= 4 * numColumns:
+        return xData, yData
+
+    bucketSize = -(-numPoints // numColumns)
+    numBuckets = -(-numPoints // bucketSize)
+
+    padding = numBuckets * bucketSize - numPoints
+    buckets = concatenate([yData, yData[-1:].repeat(padding)])
+    buckets = buckets.reshape(numBuckets, bucketSize)
+
+    firsts = arange(numBuckets) * bucketSize
+    lasts = (firsts + bucketSize - 1).clip(max=numPoints - 1)
+
+    extremes = concatenate([buckets.argmin(axis=1)[:, None],
+                            buckets.argmax(axis=1)[:, None]], axis=1)
+    extremes = sort(extremes, axis=1) + firsts[:, None]
+
+    indices = concatenate([firsts[:, None], extremes, lasts[:, None]], axis=1)
+    indices = indices.ravel()
+
+    return xData[indices], yData[indices]
+
+
+############################################################################
+# A lookup table for drawing values between -1 and 1 (like correlation
+# coefficients), fading from NEGATIVE_COLOUR through ZERO_COLOUR at 0 to
+# POSITIVE_COLOUR, so the sign and the strength both read at a glance
+############################################################################
+def divergingLookupTable(size=256):
+    levels = linspace(-1, 1, size)[:, None]
+    zero = array(ZERO_COLOUR, dtype=float)
+
+    table = where(levels < 0,
+                  zero + (array(NEGATIVE_COLOUR) - zero) * -levels,
+                  zero + (array(POSITIVE_COLOUR) - zero) * levels)
+
+    return table.round().astype(ubyte)
+
@@ -0,0 +1,259 @@
+from collections import deque, namedtuple
+from functools import partial
+from time import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from numpy import asarray, full, nan, isnan, absolute, nanargmax, arange
+
+from rtbsaStats import correlateColumns
+import rtbsaSync
+
+
+# How many history buffers get fetched at once
+SCAN_CONNECTIONS = 32
+
+# How many PVs get correlated against the target at a time, which (along
+# with the length of the target's history) is what bounds the memory a scan
+# takes
+SCAN_CHUNK = 64
+
+# How long to wait for any one history buffer, in seconds
+SCAN_TIMEOUT = 5.0
+
+# How often a scan that's waiting on history buffers hands control back to
+# whoever's running it, in seconds
+SCAN_POLL_INTERVAL = 0.1
+
+# PVs with fewer pulses than this in common with the target don't get ranked
+MIN_OVERLAP = 100
+
+
+# The best correlation (at lag shots, see CorrelationScan) of a PV with the
+# target, and how many pulses it was over
+ScanResult = namedtuple("ScanResult", "pv correlation lag overlap")
+
+
+############################################################################
+# Fetches the HSTBR history buffers of a list of BSA root names through an
+# rtbsaSource.PVPool, with at most connections of them subscribed to at
+# once. A monitor hands over the PV's current value as soon as it connects,
+# so all that happens here is subscribing, waiting for that first callback
+# (which comes in on the CA thread) and letting go of the PV. Nothing blocks
+# on any one PV, so a slow or dead one only holds up one connection until it
+# times out. Going through the pool means a history the plot is using at the
+# same time gets shared rather than disconnected out from under it.
+############################################################################
+class HistoryFetcher(object):
+
+    def __init__(self, pvPool, connections=SCAN_CONNECTIONS,
+                 timeout=SCAN_TIMEOUT):
+        self.pvPool = pvPool
+        self.connections = connections
+        self.timeout = timeout
+
+    ########################################################################
+    # Yields (root name, value, timestamp, nanoseconds) for each PV as its
+    # history comes in, in whatever order they come in. The value is None
+    # for PVs that timed out. Every SCAN_POLL_INTERVAL seconds that go by
+    # with nothing new, it yields None instead, so the caller can keep a
+    # GUI responsive or give up (by not asking for more).
+    ########################################################################
+    def fetch(self, roots):
+        pending = deque(roots)
+        received = Queue()
+
+        # Root name -> (subscription, when to give up on it)
+        inFlight = {}
+
+        try:
+            while pending or inFlight:
+                while pending and len(inFlight) < self.connections:
+                    root = pending.popleft()
+                    inFlight[root] = (self.pvPool.subscribe(
+                        root + "HSTBR", partial(self._received, received,
+                                                root)),
+                                      time() + self.timeout)
+
+                deadline = min(giveUp for _, giveUp in inFlight.values())
+
+                try:
+                    root, value, timestamp, nanoseconds = received.get(
+                        timeout=max(0, min(deadline - time(),
+                                           SCAN_POLL_INTERVAL)))
+                except Empty:
+                    expired = [root for root, (_, giveUp) in inFlight.items()
+                               if giveUp <= time()]
+
+                    for root in expired:
+                        self.pvPool.unsubscribe(inFlight.pop(root)[0])
+                        yield root, None, None, None
+
+                    if not expired:
+                        yield None
+                    continue
+
+                # A monitor can fire again before it's been let go of
+                if root not in inFlight:
+                    continue
+
+                self.pvPool.unsubscribe(inFlight.pop(root)[0])
+                yield root, value, timestamp, nanoseconds
+
+        finally:
+            for subscription, _ in inFlight.values():
+                self.pvPool.unsubscribe(subscription)
+
+    # Runs on the CA thread
+    # noinspection PyUnusedLocal
+    @staticmethod
+    def _received(received, root, pvname=None, value=None, timestamp=None,
+                  **kw):
+        received.put((root, asarray(value, dtype=float), timestamp,
+                      kw.get("nanoseconds")))
+
+
+############################################################################
+# Ranks a list of BSA PVs by how well they correlate with a target PV, from
+# their history buffers. The target's history is fetched first, and its
+# pulse keys make up the rows everybody else gets lined up on (by the pulse
+# keys of their own histories, so PVs fetched a few seconds later just have
+# less in common with the target rather than being misaligned).
+#
+# The histories are lined up chunkSize PVs at a time into one (rows x
+# chunkSize) array as they come in, which gets correlated against the
+# target in one vectorized pass once it fills up and is then reused, so a
+# scan of the whole catalog never holds more than one chunk of histories.
+#
+# With maxLag, each PV is also tried shifted by up to maxLag shots either
+# way, and its best lag is the one with the largest |r|. A positive lag
+# means the PV follows the target (its value lag shots later is what lines
+# up with the target's). Results are sorted by |r|, with the PVs that
+# couldn't be correlated (no history, too few pulses in common with the
+# target, constant values) at the end with an r of nan.
+#
+# run() is a generator that does the scan a bit at a time, yielding how
+# many PVs are done so far, so a GUI can show progress and cancel it.
+############################################################################
+class CorrelationScan(object):
+
+    def __init__(self, pvPool, getRate, target, pvs, maxLag=0,
+                 chunkSize=SCAN_CHUNK, minOverlap=MIN_OVERLAP,
+                 fetcher=None):
+        self.getRate = getRate
+        self.target = target
+        self.pvs = [pv for pv in pvs if pv != target]
+        self.maxLag = maxLag
+        self.chunkSize = chunkSize
+        self.minOverlap = minOverlap
+        self.fetcher = fetcher or HistoryFetcher(pvPool)
+
+        self.results = []
+        self.done = 0
+
+        self._targetKeys = None
+        self._targetValues = None
+        self._step = None
+        self._chunk = None
+        self._chunkPVs = []
+
+    def run(self):
+        self.results = []
+        self.done = 0
+
+        for item in self.fetcher.fetch([self.target]):
+            if item is not None:
+                self._setTarget(*item)
+            yield self.done
+
+        for item in self.fetcher.fetch(self.pvs):
+            if item is not None:
+                self._add(*item)
+            yield self.done
+
+        self._correlateChunk()
+        self.results.sort(key=lambda result: (isnan(result.correlation),
+                                              -abs(result.correlation)))
+        yield self.done
+
+    # The pulse keys of a history, and how many fiducials apart they are
+    def _historyKeys(self, value, timestamp, nanoseconds):
+        rate = self.getRate()
+        if rate < 1:
+            raise ValueError("No beam, so there's no telling which pulses "
+                             + "the history buffers are from")
+
+        key = rtbsaSync.pulseKey(timestamp, nanoseconds)
+        return (rtbsaSync.historyPulseKeys(key, value.size, rate),
+                rtbsaSync.fiducialsPerShot(rate))
+
+    def _setTarget(self, root, value, timestamp, nanoseconds):
+        if value is None or not value.size:
+            raise ValueError("Unable to get the history of " + root)
+
+        self._targetKeys, self._step = self._historyKeys(value, timestamp,
+                                                         nanoseconds)
+        self._targetValues = value
+
+        # Padded by maxLag rows on either side, so every lag is a view
+        self._chunk = full((value.size + 2 * self.maxLag, self.chunkSize),
+                           nan)
+
+    def _add(self, root, value, timestamp, nanoseconds):
+        if value is None or not value.size:
+            self.results.append(ScanResult(root, nan, 0, 0))
+            self.done += 1
+            return
+
+        keys, step = self._historyKeys(value, timestamp, nanoseconds)
+
+        # The rate changed since the target's history came in
+        if step != self._step:
+            self.results.append(ScanResult(root, nan, 0, 0))
+            self.done += 1
+            return
+
+        rows = (keys - self._targetKeys[0]) // step + self.maxLag
+        inWindow = (rows >= 0) & (rows < self._chunk.shape[0])
+
+        column = len(self._chunkPVs)
+        self._chunk[rows[inWindow], column] = value[inWindow]
+        self._chunkPVs.append(root)
+
+        if len(self._chunkPVs) == self.chunkSize:
+            self._correlateChunk()
+
+    def _correlateChunk(self):
+        numPVs = len(self._chunkPVs)
+        if not numPVs:
+            return
+
+        numRows = self._targetValues.size
+        lags = arange(-self.maxLag, self.maxLag + 1)
+        correlations = full((lags.size, numPVs), nan)
+        overlaps = full((lags.size, numPVs), 0)
+
+        for index, lag in enumerate(lags):
+            start = self.maxLag + lag
+            correlations[index], overlaps[index] = correlateColumns(
+                self._targetValues,
+                self._chunk[start:start + numRows, :numPVs])
+
+        correlations[overlaps < self.minOverlap] = nan
+
+        for column, pv in enumerate(self._chunkPVs):
+            if isnan(correlations[:, column]).all():
+                best = self.maxLag
+            else:
+                best = nanargmax(absolute(correlations[:, column]))
+
+            self.results.append(ScanResult(pv, correlations[best, column],
+                                           int(lags[best]),
+                                           int(overlaps[best, column])))
+
+        self.done += numPVs
+        self._chunk[:] = nan
+        self._chunkPVs = []
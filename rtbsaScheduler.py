@@ -0,0 +1,126 @@
+from time import time
+
+from PyQt4.QtCore import QObject, QTimer
+
+
+# How much of the GUI thread's time the plot is allowed to take up
+RENDER_BUDGET = 0.5
+
+# Weight of the newest measurement in the running average of the render cost
+RENDER_COST_WEIGHT = 0.2
+
+
+############################################################################
+# Drives the plot updates off of one repeating timer, instead of every update
+# re-arming a singleShot when it's done (which made the frame period the
+# interval plus however long the frame took, and could leave a chain running
+# after a stop).
+#
+# A frame is skipped if the frame key (anything that can be compared, e.g.
+# the generations of the data being drawn and of the settings) hasn't changed
+# since the last one was drawn. The interval starts out at minInterval
+# milliseconds and is stretched so that:
+#   - rendering takes up at most RENDER_BUDGET of the GUI thread's time
+#   - we don't redraw faster than the beam rate can bring in new pulses
+# but it never goes past maxInterval.
+#
+# pause() stops the timer without forgetting the frame method, so resume()
+# can pick it back up (e.g. when the beam comes back). If timings (an
+# rtbsaTiming.StageTimings) is given, every frame that's drawn gets recorded
+# in it as "frame".
+############################################################################
+class FrameScheduler(QObject):
+
+    def __init__(self, parent, getFrameKey, getRate, minInterval=50,
+                 maxInterval=1000, timings=None):
+        QObject.__init__(self, parent)
+
+        self.getFrameKey = getFrameKey
+        self.getRate = getRate
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.timings = timings
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+
+        self.frameMethod = None
+        self.interval = minInterval
+
+        # The running average of how long a frame takes, in milliseconds
+        self.renderCost = 0.0
+
+        self.framesDrawn = 0
+        self.framesSkipped = 0
+        self._drawnKey = None
+
+        # Set while a frame is being drawn, since a frame that waits on
+        # something runs a local event loop that this timer can fire in
+        self._inFrame = False
+
+    @property
+    def paused(self):
+        return self.frameMethod is not None and not self.timer.isActive()
+
+    def start(self, frameMethod):
+        self.frameMethod = frameMethod
+        self.renderCost = 0.0
+        self.framesDrawn = 0
+        self.framesSkipped = 0
+        self._drawnKey = None
+
+        self.interval = self.minInterval
+        self.timer.start(self.interval)
+
+    def stop(self):
+        self.timer.stop()
+        self.frameMethod = None
+
+    def pause(self):
+        self.timer.stop()
+
+    def resume(self):
+        if self.frameMethod is not None and not self.timer.isActive():
+            self._drawnKey = None
+            self.timer.start(self.interval)
+
+    def tick(self):
+        if self.frameMethod is None or self._inFrame:
+            return
+
+        frameKey = self.getFrameKey()
+        if frameKey == self._drawnKey:
+            self.framesSkipped += 1
+            return
+
+        begin = time()
+        self._inFrame = True
+        try:
+            self.frameMethod()
+        finally:
+            self._inFrame = False
+        cost = (time() - begin) * 1000
+
+        self._drawnKey = frameKey
+        self.framesDrawn += 1
+        self.renderCost += RENDER_COST_WEIGHT * (cost - self.renderCost)
+
+        if self.timings is not None:
+            self.timings.record("frame", cost)
+
+        self.retune()
+
+    def retune(self):
+        rate = self.getRate()
+        pulsePeriod = 1000.0 / rate if rate >= 1 else self.maxInterval
+
+        interval = int(min(self.maxInterval,
+                           max(self.minInterval, pulsePeriod,
+                               self.renderCost / RENDER_BUDGET)))
+
+        # Restarting the timer resets its phase, so leave it alone unless the
+        # change is worth it
+        if abs(interval - self.interval) > 0.1 * self.interval:
+            self.interval = interval
+            if self.timer.isActive():
+                self.timer.start(interval)
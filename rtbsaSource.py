@@ -0,0 +1,477 @@
+from collections import OrderedDict
+from heapq import heappush, heappop
+from threading import Thread, RLock, Event
+from time import time
+from zlib import crc32
+
+from numpy import asarray, arange, empty, sin, pi, sqrt
+from numpy.random import RandomState
+
+from rtbsaBuffer import HSTBR_LENGTH
+import rtbsaSync
+
+
+RATE_PV = 'IOC:IN20:EV01:RG01_ACTRATE'
+
+# The state of the rate PV for each beam rate (the inverse of
+# rtbsaUtils.rateDict)
+RATE_STATES = {0.0: 1, 1.0: 2, 10.0: 3, 30.0: 4, 60.0: 5, 120.0: 6}
+
+# The simulated noise is generated this many fiducials at a time
+NOISE_BLOCK = 4096
+
+# How many connections a PVPool keeps open that nobody's using
+POOL_CAPACITY = 64
+
+
+# Strips the HSTBR or BR suffix off of a BSA PV name
+def rootName(pvname):
+    for suffix in ("HSTBR", "BR"):
+        if pvname.endswith(suffix):
+            return pvname[:-len(suffix)], suffix
+    return pvname, ""
+
+
+############################################################################
+# Where the PVs come from. A source hands out PV objects that look like
+# pyepics' (add_callback, clear_callbacks, disconnect and value), so the GUI
+# doesn't care whether it's talking to Channel Access or the simulator.
+############################################################################
+class EpicsSource(object):
+
+    @staticmethod
+    def pv(pvname, form='native'):
+        # Only imported here so nothing else needs pyepics
+        from epics import PV
+        return PV(pvname, form=form)
+
+    # Has to be called by any thread of our own before it makes PVs, so they
+    # end up in the same CA context as everybody else's
+    @staticmethod
+    def attachThread():
+        from epics.ca import use_initial_context
+        use_initial_context()
+
+
+class SimulatedPV(object):
+
+    def __init__(self, source, pvname):
+        self.source = source
+        self.pvname = pvname
+        self.value = None
+
+        # Index -> callback, like pyepics, so one can be taken off without
+        # disturbing the others
+        self.callbacks = OrderedDict()
+        self._nextIndex = 0
+
+    def add_callback(self, callback):
+        index = self._nextIndex
+        self._nextIndex += 1
+
+        self.callbacks[index] = callback
+        self.source.subscribe(self)
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+        if not self.callbacks:
+            self.source.unsubscribe(self)
+
+    def clear_callbacks(self):
+        self.callbacks.clear()
+        self.source.unsubscribe(self)
+
+    def disconnect(self):
+        self.clear_callbacks()
+
+    def run_callbacks(self, **kw):
+        for callback in list(self.callbacks.values()):
+            callback(pvname=self.pvname, value=self.value, **kw)
+
+
+############################################################################
+# Keeps PV connections open between uses, so switching between signals (or
+# from a history buffer to its BR PV and back) doesn't pay for a CA search
+# and connect every time. Connections are shared and reference counted: each
+# subscribe() adds a callback to the one PV object for that name, and
+# unsubscribe() takes just that callback back off. Once nobody's using a
+# connection it stays open, up to capacity of them, after which the least
+# recently used ones get disconnected.
+#
+# Idle connections keep their monitors, which is nothing for a BR PV's one
+# value but a whole waveform a shot for an HSTBR PV, so history buffers get
+# disconnected as soon as the last user lets go of them.
+#
+# preconnect() opens connections in the background (e.g. to the common PVs
+# at startup) that then sit idle until somebody wants them.
+############################################################################
+class PVPool(object):
+
+    def __init__(self, source, capacity=POOL_CAPACITY):
+        self.source = source
+        self.capacity = capacity
+
+        # Name -> PV, least recently used first
+        self._pvs = OrderedDict()
+        self._refCounts = {}
+
+        self._lock = RLock()
+
+    def acquire(self, pvname):
+        with self._lock:
+            pv = self._pvs.pop(pvname, None)
+            # Without the time form, the callbacks wouldn't get timestamps
+            if pv is None:
+                pv = self.source.pv(pvname, form='time')
+
+            self._pvs[pvname] = pv
+            self._refCounts[pvname] = self._refCounts.get(pvname, 0) + 1
+            return pv
+
+    def release(self, pvname):
+        with self._lock:
+            if not self._refCounts.get(pvname):
+                return
+
+            self._refCounts[pvname] -= 1
+
+            if not self._refCounts[pvname]:
+                if rootName(pvname)[1] == "HSTBR":
+                    self._disconnect(pvname)
+                else:
+                    self._evictIdle()
+
+    # Returns the subscription to hand back to unsubscribe()
+    def subscribe(self, pvname, callback):
+        with self._lock:
+            pv = self.acquire(pvname)
+            return pvname, pv.add_callback(callback)
+
+    def unsubscribe(self, subscription):
+        pvname, index = subscription
+
+        with self._lock:
+            pv = self._pvs.get(pvname)
+            if pv is None:
+                return
+
+            pv.remove_callback(index)
+            self.release(pvname)
+
+    def preconnect(self, pvnames):
+        def connect():
+            if hasattr(self.source, "attachThread"):
+                self.source.attachThread()
+
+            for pvname in pvnames:
+                self.acquire(pvname)
+                self.release(pvname)
+
+        thread = Thread(target=connect)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            for pvname in list(self._pvs):
+                self._disconnect(pvname)
+
+    def __contains__(self, pvname):
+        return pvname in self._pvs
+
+    def _evictIdle(self):
+        idle = [pvname for pvname in self._pvs
+                if not self._refCounts[pvname]]
+
+        for pvname in idle[:max(0, len(idle) - self.capacity)]:
+            self._disconnect(pvname)
+
+    def _disconnect(self, pvname):
+        pv = self._pvs.pop(pvname)
+        del self._refCounts[pvname]
+        pv.disconnect()
+
+
+############################################################################
+# A deterministic stand-in for the accelerator, for working on the sync,
+# gap filling and rendering without Channel Access. Every PV name is a
+# signal: an offset and scale picked off of a hash of the name, applied to a
+# mix of a component that all the signals share (noise plus a sine at
+# lineFrequency Hz, so the FFT has something to find) and noise of its own.
+# correlation is the fraction of the variance that's shared, so it's about
+# the correlation coefficient between any two of them.
+#
+# Time only moves when advance() is called (or, after start(), in real time
+# on a thread of its own, like the CA thread), and the values only depend on
+# the seed, the PV name and the fiducial, so the same calls always produce
+# the same callbacks in the same order. On top of the signal:
+#   - dropRate is the chance that a BR PV misses a given pulse
+#   - jitter is how many shots late a BR callback can show up, so A and B
+#     get handed their pulses at different times and in different orders
+#   - skews maps PV root names to how many seconds their timestamps are off
+#     (the pulse ID in the nsec field is still right)
+#   - rateSchedule is a list of (seconds since the start, rate) changes
+#   - without withPulseIds, the callbacks don't get the nsec field (and so
+#     the pulse ID), like with an older pyepics
+#
+# An HSTBR PV gets a callback with the newest historyLength values on the
+# first shot after each callback is added to it, like a monitor connecting.
+# Callbacks only ever fire on shots, so nothing comes in while there's no
+# beam.
+############################################################################
+class SimulatedSource(object):
+
+    def __init__(self, rate=120.0, seed=0, correlation=0.9, lineFrequency=7.5,
+                 lineAmplitude=0.5, dropRate=0.0, jitter=0, skews=None,
+                 rateSchedule=(), withPulseIds=True,
+                 historyLength=HSTBR_LENGTH, startTime=1.5e9):
+        self.seed = seed
+        self.correlation = correlation
+        self.lineFrequency = lineFrequency
+        self.lineAmplitude = lineAmplitude
+        self.dropRate = dropRate
+        self.jitter = jitter
+        self.skews = dict(skews or {})
+        self.withPulseIds = withPulseIds
+        self.historyLength = historyLength
+
+        self.rate = float(rate)
+        self.startFiducial = int(startTime * rtbsaSync.FIDUCIAL_RATE)
+        self.fiducial = self.startFiducial
+        self._rateSchedule = sorted(
+            ((self.startFiducial + int(seconds * rtbsaSync.FIDUCIAL_RATE),
+              float(newRate)) for seconds, newRate in rateSchedule),
+            key=lambda change: change[0])
+
+        self.ratePV = SimulatedPV(self, RATE_PV)
+        self.ratePV.value = RATE_STATES[self.rate]
+
+        # Every PV that's been handed out, by name, and the ones with
+        # callbacks on them
+        self._pvs = {}
+        self._subscribed = []
+
+        # (fiducial to deliver on, order queued in, PV, callback arguments)
+        self._deliveries = []
+        self._queued = 0
+        self._lastDelivery = {}
+
+        # (stream, block) -> the noise for that block of fiducials
+        self._noise = {}
+
+        self._lock = RLock()
+        self._stopped = Event()
+        self._thread = None
+
+    def pv(self, pvname, form='native'):
+        with self._lock:
+            if pvname == RATE_PV:
+                return self.ratePV
+
+            if pvname not in self._pvs:
+                self._pvs[pvname] = SimulatedPV(self, pvname)
+            return self._pvs[pvname]
+
+    # Called every time a callback is added. Like an HSTBR PV that updates
+    # every shot, each new callback on one gets its history on the next shot
+    def subscribe(self, pv):
+        with self._lock:
+            if pv is self.ratePV:
+                return
+
+            if rootName(pv.pvname)[1] == "HSTBR":
+                self._queue(self.fiducial, pv, None)
+
+            if pv not in self._subscribed:
+                self._subscribed.append(pv)
+
+    def unsubscribe(self, pv):
+        with self._lock:
+            if pv in self._subscribed:
+                self._subscribed.remove(pv)
+            self._lastDelivery.pop(pv, None)
+
+            self._deliveries = [delivery for delivery in self._deliveries
+                                if delivery[2] is not pv]
+            self._deliveries.sort()
+
+    def setRate(self, rate):
+        with self._lock:
+            self.rate = float(rate)
+            self.ratePV.value = RATE_STATES[self.rate]
+            self.ratePV.run_callbacks()
+
+    ########################################################################
+    # Moves time forward by the given number of seconds, firing the
+    # callbacks of every shot (and rate change) along the way
+    ########################################################################
+    def advance(self, seconds):
+        with self._lock:
+            end = self.fiducial + int(round(seconds
+                                            * rtbsaSync.FIDUCIAL_RATE))
+
+            while self.fiducial < end:
+                while (self._rateSchedule
+                       and self._rateSchedule[0][0] <= self.fiducial):
+                    self.setRate(self._rateSchedule.pop(0)[1])
+
+                segmentEnd = end
+                if self._rateSchedule:
+                    segmentEnd = min(end, self._rateSchedule[0][0])
+
+                self._runShots(self.fiducial + 1, segmentEnd)
+                self.fiducial = segmentEnd
+
+            self._pruneNoise()
+
+    # Advances by the given number of shots at the current rate
+    def advanceShots(self, numShots):
+        self.advance(numShots / self.rate if self.rate >= 1 else 0)
+
+    # Runs advance() in real time until stop()
+    def start(self, tickInterval=0.01):
+        begin, beginFiducial = time(), self.fiducial
+
+        # Kept in step with the clock, rather than adding up the ticks, so
+        # the rounding doesn't pile up
+        def run():
+            while not self._stopped.wait(tickInterval):
+                behind = (beginFiducial - self.fiducial + int(
+                    (time() - begin) * rtbsaSync.FIDUCIAL_RATE))
+                self.advance(behind / float(rtbsaSync.FIDUCIAL_RATE))
+
+        self._stopped.clear()
+        self._thread = Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _runShots(self, first, last):
+        if self.rate < 1:
+            return
+
+        step = rtbsaSync.fiducialsPerShot(self.rate)
+
+        for fiducial in range(-(-first // step) * step, last + 1, step):
+            for pv in self._subscribed:
+                root, suffix = rootName(pv.pvname)
+                if suffix != "BR":
+                    continue
+
+                if (self.dropRate
+                        and self._uniform(root + ":drop",
+                                          fiducial) < self.dropRate):
+                    continue
+
+                deliverAt = fiducial
+                if self.jitter:
+                    lag = int(self._uniform(root + ":lag", fiducial)
+                              * (self.jitter + 1))
+                    deliverAt = max(fiducial + lag * step,
+                                    self._lastDelivery.get(pv, fiducial))
+
+                self._lastDelivery[pv] = deliverAt
+                self._queue(deliverAt, pv, self._sample(root, fiducial))
+
+            self._deliver(fiducial)
+
+    def _queue(self, fiducial, pv, kw):
+        heappush(self._deliveries, (fiducial, self._queued, pv, kw))
+        self._queued += 1
+
+    def _deliver(self, fiducial):
+        while self._deliveries and self._deliveries[0][0] <= fiducial:
+            _, _, pv, kw = heappop(self._deliveries)
+
+            # A history buffer is whatever it holds as of delivery
+            if kw is None:
+                kw = self._history(rootName(pv.pvname)[0], fiducial)
+
+            pv.value = kw.pop("value")
+            pv.run_callbacks(**kw)
+
+    def _sample(self, root, fiducial):
+        kw = self._timestamp(root, fiducial)
+        kw["value"] = float(self.values(root, [fiducial])[0])
+        return kw
+
+    # The newest historyLength shots as of the given fiducial, stamped with
+    # the newest one's time
+    def _history(self, root, fiducial):
+        step = rtbsaSync.fiducialsPerShot(self.rate)
+        newest = fiducial - fiducial % step
+        fiducials = newest - step * arange(self.historyLength - 1, -1, -1)
+
+        kw = self._timestamp(root, newest)
+        kw["value"] = self.values(root, fiducials)
+        return kw
+
+    def _timestamp(self, root, fiducial):
+        timestamp = (float(fiducial) / rtbsaSync.FIDUCIAL_RATE
+                     + self.skews.get(root, 0.0))
+
+        if not self.withPulseIds:
+            return {"timestamp": timestamp}
+
+        nanoseconds = int((timestamp % 1) * 1e9) & ~rtbsaSync.PULSE_ID_MASK
+        nanoseconds |= fiducial % rtbsaSync.PULSE_ID_ROLLOVER
+        return {"timestamp": timestamp, "nanoseconds": nanoseconds}
+
+    ########################################################################
+    # The values of the named signal on the given fiducials
+    ########################################################################
+    def values(self, root, fiducials):
+        fiducials = asarray(fiducials, dtype=int)
+
+        seconds = fiducials / float(rtbsaSync.FIDUCIAL_RATE)
+        shared = (self._normal("shared", fiducials) + self.lineAmplitude
+                  * sqrt(2) * sin(2 * pi * self.lineFrequency * seconds))
+        own = self._normal(root, fiducials)
+
+        hashed = crc32(root.encode("utf-8")) & 0xffffffff
+        offset = hashed % 1000
+        scale = 1 + (hashed >> 10) % 10
+
+        return offset + scale * (sqrt(self.correlation) * shared
+                                 + sqrt(1 - self.correlation) * own)
+
+    def _normal(self, stream, fiducials):
+        return self._random(stream, fiducials, "standard_normal")
+
+    def _uniform(self, stream, fiducial):
+        return self._random(stream, asarray([fiducial]), "random_sample")[0]
+
+    # Pieces together the noise for the given fiducials from the blocks
+    # they fall in, each of which is seeded off of its own position, so the
+    # noise doesn't depend on the order it's asked for in
+    def _random(self, stream, fiducials, kind):
+        streamId = crc32((stream + ":" + kind).encode("utf-8")) & 0xffffffff
+        blocks = fiducials // NOISE_BLOCK
+        result = empty(fiducials.shape)
+
+        for block in set(blocks.tolist()):
+            key = (streamId, block)
+            if key not in self._noise:
+                generator = RandomState([self.seed, streamId,
+                                         block & 0xffffffff])
+                self._noise[key] = getattr(generator, kind)(NOISE_BLOCK)
+
+            inBlock = blocks == block
+            result[inBlock] = self._noise[key][fiducials[inBlock]
+                                               % NOISE_BLOCK]
+
+        return result
+
+    # Throws out the noise that's too old to make it into a history buffer
+    def _pruneNoise(self):
+        oldest = (self.fiducial - self.historyLength
+                  * rtbsaSync.FIDUCIAL_RATE) // NOISE_BLOCK
+        for key in [key for key in self._noise if key[1] < oldest]:
+            del self._noise[key]
@@ -0,0 +1,208 @@
+from numpy import (asarray, isnan, interp, hanning, arange, sqrt, empty,
+                   maximum, log10)
+from numpy.fft import rfft, rfftfreq
+
+
+# The longest segment the spectrum is averaged over. At 120Hz that's about
+# 0.23Hz of resolution
+MAX_SEGMENT_LENGTH = 512
+
+# How many spectra the waterfall keeps. A new one comes in every half segment
+# (about 2 seconds at 120Hz), so that's several minutes' worth
+WATERFALL_ROWS = 200
+
+# Power that's floored before taking the log for the waterfall
+POWER_FLOOR = 1e-20
+
+
+def nextPowerOfTwo(n):
+    power = 1
+    while power < n:
+        power *= 2
+    return power
+
+
+############################################################################
+# Welch's method for the "Plot A FFT" view: the window is cut into segments
+# that overlap by half, each one gets its mean removed, a Hann window and an
+# rfft (padded to a power of two), and the power spectra of all the segments
+# get averaged. That's a lot less noisy than one transform of the whole
+# window, at the cost of frequency resolution.
+#
+# Segments are laid out on absolute shot numbers rather than on positions in
+# the window, so that as the window scrolls, a segment keeps covering the
+# same shots. Once a segment is complete its spectrum never changes, so each
+# update only transforms the segments that new shots have completed, and
+# drops the ones that have scrolled out of the window.
+#
+# The result is scaled as an amplitude spectrum (a sine of amplitude a shows
+# up with a peak of about a / 2, like abs(fft) / N of the raw data).
+############################################################################
+class WelchSpectrum(object):
+
+    def __init__(self, maxSegmentLength=MAX_SEGMENT_LENGTH):
+        self.maxSegmentLength = maxSegmentLength
+
+        self.segmentLength = None
+        self.hop = None
+        self.fftLength = None
+        self.window = None
+        self._windowSum = None
+
+        # (fftLength, rate) -> frequencies
+        self._frequencies = {}
+
+        # First shot of the segment -> its power spectrum
+        self._segments = {}
+
+        # The power spectra of the segments that the last update completed,
+        # oldest first
+        self.newSegments = []
+
+    def clear(self):
+        self._segments.clear()
+
+    # Caches the window function for the given segment length, throwing out
+    # every segment computed with a different one
+    def _configure(self, segmentLength):
+        if segmentLength == self.segmentLength:
+            return
+
+        self.clear()
+
+        self.segmentLength = segmentLength
+        self.hop = max(1, segmentLength // 2)
+        self.fftLength = nextPowerOfTwo(segmentLength)
+
+        # Without the end points, which are zero
+        self.window = hanning(segmentLength + 2)[1:-1]
+        self._windowSum = self.window.sum()
+
+    def frequencies(self, rate):
+        key = (self.fftLength, rate)
+        if key not in self._frequencies:
+            self._frequencies[key] = rfftfreq(self.fftLength, 1.0 / rate)
+        return self._frequencies[key]
+
+    def _segmentPower(self, segment):
+        nans = isnan(segment)
+
+        if nans.all():
+            return None
+
+        if nans.any():
+            indices = arange(segment.size)
+            segment = segment.copy()
+            segment[nans] = interp(indices[nans], indices[~nans],
+                                   segment[~nans])
+
+        spectrum = rfft((segment - segment.mean()) * self.window,
+                        self.fftLength)
+        return (spectrum.real ** 2 + spectrum.imag ** 2) / self._windowSum ** 2
+
+    ########################################################################
+    # data is the window, oldest shot first, and newestShot is the absolute
+    # shot number of its last point (or None if it isn't known, in which
+    # case nothing can be reused and every segment gets transformed).
+    # Returns (frequencies, spectrum), or None if there's no data.
+    ########################################################################
+    def update(self, data, newestShot, rate):
+        data = asarray(data, dtype=float)
+        if not data.size:
+            return None
+
+        # Short windows get shorter segments, short enough that at least one
+        # whole segment fits wherever the segment boundaries happen to fall
+        self._configure(min(self.maxSegmentLength,
+                            max(1, 2 * (data.size + 1) // 3)))
+
+        self.newSegments = []
+
+        # Without shot numbers every segment is recomputed every time, so
+        # none of them count as new
+        reusable = newestShot is not None
+
+        if not reusable:
+            self.clear()
+            newestShot = data.size - 1
+
+        firstShot = newestShot - data.size + 1
+
+        # The complete segments that are inside the window
+        firstSegment = -(-firstShot // self.hop) * self.hop
+        lastSegment = ((newestShot - self.segmentLength + 1) // self.hop
+                       * self.hop)
+        starts = range(firstSegment, lastSegment + 1, self.hop)
+
+        for start in list(self._segments):
+            if start < firstSegment or start > lastSegment:
+                del self._segments[start]
+
+        for start in starts:
+            if start not in self._segments:
+                offset = start - firstShot
+                power = self._segmentPower(data[offset:offset
+                                                 + self.segmentLength])
+                self._segments[start] = power
+
+                if reusable and power is not None:
+                    self.newSegments.append(power)
+
+        powers = [power for power in self._segments.values()
+                  if power is not None]
+        if not powers:
+            return None
+
+        return self.frequencies(rate), sqrt(sum(powers) / len(powers))
+
+
+############################################################################
+# The waterfall: a ring buffer of successive segment spectra (in dB), one row
+# per segment that WelchSpectrum completes, so each row costs one rfft. The
+# rows and the scratch space that ordered() copies them into in time order
+# are only reallocated if the number of frequencies changes. Segments that
+# were nothing but nans don't get a row.
+############################################################################
+class Spectrogram(object):
+
+    def __init__(self, numRows=WATERFALL_ROWS):
+        self.numRows = numRows
+
+        self.rows = None
+        self._ordered = None
+
+        self.head = -1
+        self.count = 0
+
+    def reset(self, numColumns):
+        if self.rows is None or self.rows.shape[1] != numColumns:
+            self.rows = empty((self.numRows, numColumns))
+            self._ordered = empty((self.numRows, numColumns))
+
+        self.head = -1
+        self.count = 0
+
+    def addRow(self, power):
+        if self.rows is None or self.rows.shape[1] != power.size:
+            self.reset(power.size)
+
+        self.head = (self.head + 1) % self.numRows
+        self.count = min(self.count + 1, self.numRows)
+
+        row = self.rows[self.head]
+        maximum(power, POWER_FLOOR, out=row)
+        log10(row, out=row)
+        row *= 10
+
+    # The rows that have been written, oldest first
+    def ordered(self):
+        if self.count < self.numRows:
+            start = 0
+        else:
+            start = (self.head + 1) % self.numRows
+        tail = self.count - start
+
+        self._ordered[:tail] = self.rows[start:self.count]
+        self._ordered[tail:self.count] = self.rows[:start]
+
+        return self._ordered[:self.count]
@@ -0,0 +1,665 @@
+from math import isnan, isinf, sqrt
+
+from numpy import (asarray, isfinite, nan, arange, zeros, array, newaxis, dot,
+                   concatenate, polyadd, polymul, floor, bincount, int64,
+                   subtract, absolute, where, maximum, errstate, vander)
+from numpy.linalg import lstsq
+
+
+def _isFinite(x):
+    return not (isnan(x) or isinf(x))
+
+
+############################################################################
+# Running mean and variance of a sliding window, updated one sample at a time
+# (Welford's algorithm, run backwards to take a sample out of the window).
+# Batches of samples get merged in or taken out with Chan's pairwise
+# formulas, so that padding a long gap or seeding from a history buffer is
+# one vectorized pass over the batch rather than a Python loop.
+#
+# Non-finite values are ignored, so nan padding never makes it in. Taking
+# samples out accumulates rounding error, so whoever owns the window should
+# rebuild() from the raw data every so often (every window length's worth of
+# removals keeps the cost amortized O(1) per sample).
+#
+# The variance is the population variance (like numpy's std default), and
+# sampleStd is the n - 1 one (like scipy.stats.nanstd).
+############################################################################
+class RunningStats(object):
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def clear(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def copyFrom(self, other):
+        self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+
+    def add(self, x):
+        if not _isFinite(x):
+            return
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        if not _isFinite(x) or self.n == 0:
+            return
+
+        if self.n == 1:
+            self.clear()
+            return
+
+        oldMean = self.mean
+        self.n -= 1
+        self.mean = oldMean - (x - oldMean) / self.n
+        self.m2 = max(0.0, self.m2 - (x - oldMean) * (x - self.mean))
+
+    def addMany(self, values):
+        values = asarray(values, dtype=float)
+        values = values[isfinite(values)]
+        nb = values.size
+
+        if not nb:
+            return
+
+        meanB = values.mean()
+        m2B = ((values - meanB) ** 2).sum()
+        n = self.n + nb
+        delta = meanB - self.mean
+
+        self.m2 += m2B + delta * delta * self.n * nb / n
+        self.mean += delta * nb / n
+        self.n = n
+
+    def removeMany(self, values):
+        values = asarray(values, dtype=float)
+        values = values[isfinite(values)]
+        nb = values.size
+
+        if not nb:
+            return
+
+        if nb >= self.n:
+            self.clear()
+            return
+
+        meanB = values.mean()
+        m2B = ((values - meanB) ** 2).sum()
+        na = self.n - nb
+        meanA = (self.n * self.mean - nb * meanB) / na
+        delta = meanB - meanA
+
+        self.m2 = max(0.0, self.m2 - m2B - delta * delta * na * nb / self.n)
+        self.mean = meanA
+        self.n = na
+
+    def rebuild(self, values):
+        self.clear()
+        self.addMany(values)
+
+    @property
+    def variance(self):
+        return self.m2 / self.n if self.n else nan
+
+    @property
+    def std(self):
+        return sqrt(self.variance) if self.n else nan
+
+    @property
+    def sampleStd(self):
+        return sqrt(self.m2 / (self.n - 1)) if self.n > 1 else nan
+
+
+############################################################################
+# The same idea for a window of (x, y) pairs, adding the co-moment so we can
+# get the correlation coefficient (and the least squares slope) without
+# touching the window. A pair is only counted if both x and y are finite.
+############################################################################
+class RunningCoMoments(object):
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.meanX = 0.0
+        self.meanY = 0.0
+        self.m2X = 0.0
+        self.m2Y = 0.0
+        self.cXY = 0.0
+
+    def copyFrom(self, other):
+        self.n = other.n
+        self.meanX, self.meanY = other.meanX, other.meanY
+        self.m2X, self.m2Y, self.cXY = other.m2X, other.m2Y, other.cXY
+
+    def add(self, x, y):
+        if not (_isFinite(x) and _isFinite(y)):
+            return
+
+        self.n += 1
+        dx = x - self.meanX
+        dy = y - self.meanY
+        self.meanX += dx / self.n
+        self.meanY += dy / self.n
+        self.m2X += dx * (x - self.meanX)
+        self.m2Y += dy * (y - self.meanY)
+        self.cXY += dx * (y - self.meanY)
+
+    def remove(self, x, y):
+        if not (_isFinite(x) and _isFinite(y)) or self.n == 0:
+            return
+
+        if self.n == 1:
+            self.clear()
+            return
+
+        self.n -= 1
+        dx = x - self.meanX
+        dy = y - self.meanY
+        self.meanX -= dx / self.n
+        self.meanY -= dy / self.n
+        self.m2X = max(0.0, self.m2X - dx * (x - self.meanX))
+        self.m2Y = max(0.0, self.m2Y - dy * (y - self.meanY))
+        self.cXY -= dx * (y - self.meanY)
+
+    @staticmethod
+    def _finitePairs(xValues, yValues):
+        xValues = asarray(xValues, dtype=float)
+        yValues = asarray(yValues, dtype=float)
+        keep = isfinite(xValues) & isfinite(yValues)
+        return xValues[keep], yValues[keep]
+
+    def addMany(self, xValues, yValues):
+        xValues, yValues = self._finitePairs(xValues, yValues)
+        nb = xValues.size
+
+        if not nb:
+            return
+
+        meanXB, meanYB = xValues.mean(), yValues.mean()
+        dxB, dyB = xValues - meanXB, yValues - meanYB
+        n = self.n + nb
+        dx, dy = meanXB - self.meanX, meanYB - self.meanY
+        weight = float(self.n) * nb / n
+
+        self.m2X += (dxB * dxB).sum() + dx * dx * weight
+        self.m2Y += (dyB * dyB).sum() + dy * dy * weight
+        self.cXY += (dxB * dyB).sum() + dx * dy * weight
+        self.meanX += dx * nb / n
+        self.meanY += dy * nb / n
+        self.n = n
+
+    def removeMany(self, xValues, yValues):
+        xValues, yValues = self._finitePairs(xValues, yValues)
+        nb = xValues.size
+
+        if not nb:
+            return
+
+        if nb >= self.n:
+            self.clear()
+            return
+
+        meanXB, meanYB = xValues.mean(), yValues.mean()
+        dxB, dyB = xValues - meanXB, yValues - meanYB
+        na = self.n - nb
+        meanXA = (self.n * self.meanX - nb * meanXB) / na
+        meanYA = (self.n * self.meanY - nb * meanYB) / na
+        dx, dy = meanXB - meanXA, meanYB - meanYA
+        weight = float(na) * nb / self.n
+
+        self.m2X = max(0.0, self.m2X - (dxB * dxB).sum() - dx * dx * weight)
+        self.m2Y = max(0.0, self.m2Y - (dyB * dyB).sum() - dy * dy * weight)
+        self.cXY -= (dxB * dyB).sum() + dx * dy * weight
+        self.meanX, self.meanY = meanXA, meanYA
+        self.n = na
+
+    def rebuild(self, xValues, yValues):
+        self.clear()
+        self.addMany(xValues, yValues)
+
+    @property
+    def stdX(self):
+        return sqrt(self.m2X / self.n) if self.n else nan
+
+    @property
+    def stdY(self):
+        return sqrt(self.m2Y / self.n) if self.n else nan
+
+    @property
+    def sampleStdX(self):
+        return sqrt(self.m2X / (self.n - 1)) if self.n > 1 else nan
+
+    @property
+    def sampleStdY(self):
+        return sqrt(self.m2Y / (self.n - 1)) if self.n > 1 else nan
+
+    @property
+    def correlation(self):
+        denominator = sqrt(self.m2X * self.m2Y)
+        return self.cXY / denominator if denominator else nan
+
+
+############################################################################
+# The co-moments of every pair of columns of a window of rows (one column per
+# device), for the whole correlation matrix at once. It's nan aware the same
+# way RunningCoMoments is: each pair of columns only counts the rows where
+# both of them are finite, so a device that dropped a pulse doesn't throw out
+# that shot for everybody else. For every pair (i, j) we keep
+#   counts[i, j]    the number of rows where both are finite
+#   sums[i, j]      the sum of column i over those rows
+#   squares[i, j]   the sum of column i squared over those rows
+#   products[i, j]  the sum of column i times column j
+# Each of those is one matrix product of the rows (with the non-finite
+# values zeroed) and/or their finite mask, so adding or taking out a batch of
+# rows is four products, and rebuild() does the whole window in one go.
+#
+# The columns are shifted by their means as of the last rebuild() before
+# they go into the sums, which keeps the sums of squares from cancelling
+# away the variance of signals that sit far from zero.
+############################################################################
+class RunningCoMomentMatrix(object):
+
+    def __init__(self, numColumns):
+        self.numColumns = numColumns
+        self.shift = zeros(numColumns)
+
+        self.counts = zeros((numColumns, numColumns))
+        self.sums = zeros((numColumns, numColumns))
+        self.squares = zeros((numColumns, numColumns))
+        self.products = zeros((numColumns, numColumns))
+
+    def clear(self):
+        self.counts[:] = 0
+        self.sums[:] = 0
+        self.squares[:] = 0
+        self.products[:] = 0
+
+    def copyFrom(self, other):
+        self.shift[:] = other.shift
+        self.counts[:] = other.counts
+        self.sums[:] = other.sums
+        self.squares[:] = other.squares
+        self.products[:] = other.products
+
+    def _update(self, rows, sign):
+        rows = asarray(rows, dtype=float).reshape(-1, self.numColumns)
+        finite = isfinite(rows)
+        values = where(finite, rows - self.shift, 0.0)
+        finite = finite.astype(float)
+
+        self.counts += sign * dot(finite.T, finite)
+        self.sums += sign * dot(values.T, finite)
+        self.squares += sign * dot((values * values).T, finite)
+        self.products += sign * dot(values.T, values)
+
+    def addRows(self, rows):
+        self._update(rows, 1)
+
+    def removeRows(self, rows):
+        self._update(rows, -1)
+
+    def rebuild(self, rows):
+        rows = asarray(rows, dtype=float).reshape(-1, self.numColumns)
+        finite = isfinite(rows)
+        numFinite = finite.sum(axis=0)
+
+        self.shift[:] = where(finite, rows, 0.0).sum(axis=0) / maximum(
+            numFinite, 1)
+
+        self.clear()
+        self._update(rows, 1)
+
+    ########################################################################
+    # The matrix of correlation coefficients, with nans for the pairs that
+    # don't have two shots in common or where either one is constant
+    ########################################################################
+    def correlation(self):
+        with errstate(divide="ignore", invalid="ignore"):
+            means = self.sums / self.counts
+            covariance = self.products / self.counts - means * means.T
+            variances = self.squares / self.counts - means * means
+
+            # variances[i, j] is column i's, variances.T[i, j] column j's
+            result = covariance / (variances * variances.T) ** 0.5
+            defined = ((self.counts >= 2) & (variances > 0)
+                       & (variances.T > 0))
+
+        return where(defined, result.clip(-1, 1), nan)
+
+
+############################################################################
+# The correlation coefficient of x with every column of columns (which has a
+# row for each value of x), each over just the rows where both are finite,
+# all in one vectorized pass. Returns the coefficients and how many rows went
+# into each, with nans where there weren't two rows or either side was
+# constant. Like RunningCoMomentMatrix, everything's shifted by its mean
+# first so the sums of squares don't cancel.
+############################################################################
+def correlateColumns(x, columns):
+    x = asarray(x, dtype=float)
+    columns = asarray(columns, dtype=float).reshape(x.size, -1)
+
+    finiteX = isfinite(x)
+    finite = finiteX[:, newaxis] & isfinite(columns)
+    counts = finite.sum(axis=0)
+
+    shiftX = x[finiteX].mean() if finiteX.any() else 0.0
+    shifts = where(finite, columns, 0.0).sum(axis=0) / maximum(counts, 1)
+
+    xValues = where(finite, (x - shiftX)[:, newaxis], 0.0)
+    yValues = where(finite, columns - shifts, 0.0)
+
+    with errstate(divide="ignore", invalid="ignore"):
+        meanX = xValues.sum(axis=0) / counts
+        meanY = yValues.sum(axis=0) / counts
+        covariance = (xValues * yValues).sum(axis=0) / counts - meanX * meanY
+        varianceX = (xValues * xValues).sum(axis=0) / counts - meanX * meanX
+        varianceY = (yValues * yValues).sum(axis=0) / counts - meanY * meanY
+
+        result = covariance / (varianceX * varianceY) ** 0.5
+        defined = (counts >= 2) & (varianceX > 0) & (varianceY > 0)
+
+    return where(defined, result.clip(-1, 1), nan), counts
+
+
+# Scales the median absolute deviation so it estimates the standard deviation
+# of normally distributed data
+MAD_TO_SIGMA = 1.4826
+
+
+def _partitionMedian(values):
+    half = values.size // 2
+
+    if values.size % 2:
+        values.partition(half)
+        return float(values[half])
+
+    values.partition([half - 1, half])
+    return (values[half - 1] + values[half]) / 2.0
+
+
+############################################################################
+# The median of values, and the median absolute deviation around it scaled
+# to a standard deviation. Unlike the mean and standard deviation, a handful
+# of enormous outliers can't drag these around. Both medians come from
+# numpy's partition based selection, which is O(n) (no sort), but shuffles
+# values in place and then overwrites it, so hand it scratch space.
+############################################################################
+def medianAndSpread(values):
+    if not values.size:
+        return nan, nan
+
+    median = _partitionMedian(values)
+
+    subtract(values, median, out=values)
+    absolute(values, out=values)
+
+    return median, MAD_TO_SIGMA * _partitionMedian(values)
+
+
+# The highest order the fit overlays let you pick
+MAX_FIT_ORDER = 10
+
+# How far out of [-1, 1] (in u, see StreamingPolyFit) a sample can land before
+# the fit needs new center and scale. Past this, its high powers are big
+# enough that taking it back out leaves more rounding error than the sums of
+# everything else
+FIT_RANGE_LIMIT = 2.0
+
+
+############################################################################
+# Least squares polynomial fits of a sliding window of (x, y) samples, from
+# running sums. We keep the power sums of x up to 2 * maxOrder and of x^k * y
+# up to maxOrder (the entries of the normal equations), adding and taking out
+# samples as they enter and leave the window, so getting a fit of any order
+# is a solve of an (order + 1) x (order + 1) system no matter how big the
+# window is.
+#
+# Raw power sums up to x^20 would be hopeless numerically, so x is mapped to
+# u = (x - center) / scale first, with center and scale picked on rebuild()
+# so that the window (and whatever comes in before the next rebuild) lands in
+# roughly [-1, 1]. The system gets its diagonal scaled to 1 before solving.
+# Once a sample comes in further out than FIT_RANGE_LIMIT (an outlier, or a
+# jump in x), stale comes true and whoever owns it should rebuild(), like
+# with RunningHistogram2D.
+############################################################################
+class StreamingPolyFit(object):
+
+    def __init__(self, maxOrder=MAX_FIT_ORDER):
+        self.maxOrder = maxOrder
+        self._powers = arange(2 * maxOrder + 1)
+
+        self.sumsX = zeros(2 * maxOrder + 1)
+        self.sumsXY = zeros(maxOrder + 1)
+
+        self.center = 0.0
+        self.scale = 1.0
+        self.stale = False
+
+    def clear(self):
+        self.sumsX[:] = 0
+        self.sumsXY[:] = 0
+        self.stale = False
+
+    def copyFrom(self, other):
+        self.sumsX[:] = other.sumsX
+        self.sumsXY[:] = other.sumsXY
+        self.center, self.scale = other.center, other.scale
+        self.stale = other.stale
+
+    @property
+    def n(self):
+        return int(round(self.sumsX[0]))
+
+    def _update(self, x, y, sign):
+        if not (_isFinite(x) and _isFinite(y)):
+            return
+
+        u = (x - self.center) / self.scale
+        if sign > 0 and abs(u) > FIT_RANGE_LIMIT:
+            self.stale = True
+
+        powers = u ** self._powers
+        self.sumsX += sign * powers
+        self.sumsXY += (sign * y) * powers[:self.maxOrder + 1]
+
+    def add(self, x, y):
+        self._update(x, y, 1)
+
+    def remove(self, x, y):
+        self._update(x, y, -1)
+
+    def _updateMany(self, xValues, yValues, sign):
+        xValues, yValues = RunningCoMoments._finitePairs(xValues, yValues)
+
+        if not xValues.size:
+            return
+
+        u = (xValues - self.center) / self.scale
+        if sign > 0 and absolute(u).max() > FIT_RANGE_LIMIT:
+            self.stale = True
+
+        # Each row is 1, u, u**2, ... built up by multiplying, which is a lot
+        # cheaper than raising every sample to every power
+        powers = vander(u, self._powers.size, increasing=True)
+        self.sumsX += sign * powers.sum(axis=0)
+        self.sumsXY += sign * dot(yValues, powers[:, :self.maxOrder + 1])
+
+    def addMany(self, xValues, yValues):
+        self._updateMany(xValues, yValues, 1)
+
+    def removeMany(self, xValues, yValues):
+        self._updateMany(xValues, yValues, -1)
+
+    ########################################################################
+    # Starts over from the given window. If newestLast is set, x is expected
+    # to keep increasing (like a pulse key), so the window is mapped onto
+    # [-1, 0] to leave room for the next window's worth of samples
+    ########################################################################
+    def rebuild(self, xValues, yValues, newestLast=False):
+        self.clear()
+
+        xValues, yValues = RunningCoMoments._finitePairs(xValues, yValues)
+        if not xValues.size:
+            return
+
+        low, high = float(xValues.min()), float(xValues.max())
+
+        if newestLast:
+            self.center, self.scale = high, (high - low) or 1.0
+        else:
+            self.center = (high + low) / 2
+            self.scale = (high - low) / 2 or 1.0
+
+        self.addMany(xValues, yValues)
+
+    # Fit coefficients in terms of u, highest order first
+    def _solve(self, order):
+        indices = arange(order + 1)
+        normalMatrix = self.sumsX[indices[:, newaxis] + indices]
+        rhs = self.sumsXY[:order + 1]
+
+        diagonal = normalMatrix.diagonal() ** 0.5
+        diagonal[diagonal == 0] = 1
+
+        solution = lstsq(normalMatrix / diagonal[:, newaxis] / diagonal,
+                         rhs / diagonal, rcond=None)[0] / diagonal
+
+        return solution[::-1]
+
+    ########################################################################
+    # The fit coefficients (highest order first, like polyfit) as a function
+    # of t, where x = a * t + b. That lets the caller fit in whatever x is
+    # convenient to keep sums of (e.g. pulse keys) but get the polynomial in
+    # plot coordinates (e.g. sample index). Returns None if there aren't
+    # enough points for that order.
+    ########################################################################
+    def coefficients(self, order, a=1.0, b=0.0):
+        if self.n <= order:
+            return None
+
+        # u = (a * t + b - center) / scale, then substitute into the fit
+        uOfT = array([a / self.scale, (b - self.center) / self.scale])
+
+        result = zeros(1)
+        for coefficient in self._solve(order):
+            result = polyadd(polymul(result, uOfT), [coefficient])
+
+        return concatenate([zeros(order + 1 - result.size), result])
+
+
+# The number of bins along each axis of the density maps
+DENSITY_BINS = 100
+
+
+############################################################################
+# A 2D histogram of a sliding window of (x, y) pairs, kept up to date as pairs
+# enter and leave it, so drawing a density map of the window costs the same
+# no matter how many points are in it. The bin edges are picked on rebuild()
+# from the window's range plus a margin on every side. Pairs that land
+# outside of that don't get binned, and once more than a percent of the
+# window has, stale comes true and whoever owns it should rebuild() (which
+# picks new edges).
+############################################################################
+class RunningHistogram2D(object):
+
+    def __init__(self, numBins=DENSITY_BINS, margin=0.25):
+        self.numBins = numBins
+        self.margin = margin
+
+        self.counts = zeros((numBins, numBins), dtype=int64)
+        self.xRange = (0.0, 1.0)
+        self.yRange = (0.0, 1.0)
+
+        # The number of pairs in the window, and how many of those are out of
+        # range
+        self.n = 0
+        self.missed = 0
+
+    def clear(self):
+        self.counts[:] = 0
+        self.n = 0
+        self.missed = 0
+
+    def copyFrom(self, other):
+        self.counts[:] = other.counts
+        self.xRange, self.yRange = other.xRange, other.yRange
+        self.n, self.missed = other.n, other.missed
+
+    @property
+    def stale(self):
+        return self.missed * 100 > self.n
+
+    def _binsOf(self, values, valueRange):
+        low, high = valueRange
+        return floor((values - low) / (high - low)
+                     * self.numBins).astype(int64)
+
+    def _update(self, x, y, sign):
+        if not (_isFinite(x) and _isFinite(y)):
+            return
+
+        self.n += sign
+        ix, iy = self._binsOf(x, self.xRange), self._binsOf(y, self.yRange)
+
+        if 0 <= ix < self.numBins and 0 <= iy < self.numBins:
+            self.counts[ix, iy] += sign
+        else:
+            self.missed += sign
+
+    def add(self, x, y):
+        self._update(x, y, 1)
+
+    def remove(self, x, y):
+        self._update(x, y, -1)
+
+    def _updateMany(self, xValues, yValues, sign):
+        xValues, yValues = RunningCoMoments._finitePairs(xValues, yValues)
+
+        if not xValues.size:
+            return
+
+        ix = self._binsOf(xValues, self.xRange)
+        iy = self._binsOf(yValues, self.yRange)
+        inside = ((ix >= 0) & (ix < self.numBins)
+                  & (iy >= 0) & (iy < self.numBins))
+
+        flatCounts = self.counts.reshape(-1)
+        flatCounts += sign * bincount(ix[inside] * self.numBins + iy[inside],
+                                      minlength=flatCounts.size)
+
+        self.n += sign * xValues.size
+        self.missed += sign * int(xValues.size - inside.sum())
+
+    def addMany(self, xValues, yValues):
+        self._updateMany(xValues, yValues, 1)
+
+    def removeMany(self, xValues, yValues):
+        self._updateMany(xValues, yValues, -1)
+
+    def _rangeOf(self, values):
+        low, high = float(values.min()), float(values.max())
+        padding = (high - low) * self.margin or 1.0
+        return low - padding, high + padding
+
+    def rebuild(self, xValues, yValues):
+        self.clear()
+
+        xValues, yValues = RunningCoMoments._finitePairs(xValues, yValues)
+        if not xValues.size:
+            return
+
+        self.xRange = self._rangeOf(xValues)
+        self.yRange = self._rangeOf(yValues)
+
+        self.addMany(xValues, yValues)
@@ -0,0 +1,52 @@
+from numpy import arange
+
+
+# Fiducials are the 360Hz timing system ticks that pulse IDs count
+FIDUCIAL_RATE = 360
+
+# BSA IOCs overwrite the lower 17 bits of the timestamp's nsec field with the
+# pulse ID, which rolls over every 131040 fiducials (~6 minutes)
+PULSE_ID_MASK = 0x1FFFF
+PULSE_ID_ROLLOVER = 131040
+
+
+def decodePulseId(nanoseconds):
+    return int(nanoseconds) & PULSE_ID_MASK
+
+
+def fiducialsPerShot(rate):
+    return int(round(FIDUCIAL_RATE / float(rate)))
+
+
+############################################################################
+# The pulse ID on its own is ambiguous since it rolls over every 6 minutes,
+# which is less than a 2800 point buffer at 1Hz. We unwrap it into a "pulse
+# key" by picking the rollover that lands closest to the fiducial count that
+# the timestamp's seconds imply. Both devices get exactly the same timestamp
+# for the same pulse, so they always end up with the same key for it.
+#
+# Without the nsec field (older pyepics doesn't hand it to callbacks) we fall
+# back on that approximate fiducial count, which is still identical across
+# devices for the same pulse.
+############################################################################
+def pulseKey(timestamp, nanoseconds=None):
+    approxKey = int(round(timestamp * FIDUCIAL_RATE))
+
+    if nanoseconds is None:
+        return approxKey
+
+    pulseId = decodePulseId(nanoseconds)
+    rollovers = int(round(float(approxKey - pulseId) / PULSE_ID_ROLLOVER))
+    return pulseId + rollovers * PULSE_ID_ROLLOVER
+
+
+# The keys for an HSTBR waveform, given the key of its newest point (the
+# history buffer only has a timestamp for the most recent shot)
+def historyPulseKeys(lastKey, numShots, rate):
+    return lastKey - fiducialsPerShot(rate) * arange(numShots - 1, -1, -1)
+
+
+# The number of shots between two pulse keys at the given rate
+def elapsedShots(lastKey, key, rate):
+    return int(round(float(key - lastKey) / fiducialsPerShot(rate)))
+
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from numpy import empty, percentile
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 doesn't have a monotonic clock. The wall clock only jumps
+    # when it's set, which would throw off the odd sample at worst
+    from time import time as monotonic
+
+from time import time
+
+
+# How many of the most recent samples each stage's percentiles cover
+TIMING_WINDOW = 512
+
+
+############################################################################
+# The most recent TIMING_WINDOW samples of something, in a preallocated
+# ring, so recording one is a store and an increment. It's written from one
+# thread and read from another, which is fine since a reader that races a
+# write just sees a sample from one window ago.
+############################################################################
+class RollingSamples(object):
+
+    def __init__(self, size=TIMING_WINDOW):
+        self.samples = empty(size)
+        self.head = 0
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.head] = value
+        self.head = (self.head + 1) % self.samples.size
+        self.count = min(self.count + 1, self.samples.size)
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    # The given percentiles of what's in the window, or None if it's empty
+    def percentiles(self, *ps):
+        if not self.count:
+            return None
+        return percentile(self.samples[:self.count], ps)
+
+
+############################################################################
+# Rolling timings of each stage of a frame, in milliseconds, plus the
+# latency of the CA callbacks (how long after the EPICS timestamp of a
+# pulse its callback fired). Stages show up in the order they were first
+# timed.
+############################################################################
+class StageTimings(object):
+
+    def __init__(self, window=TIMING_WINDOW):
+        self.window = window
+        self.stages = OrderedDict()
+
+    def _samples(self, name):
+        if name not in self.stages:
+            self.stages[name] = RollingSamples(self.window)
+        return self.stages[name]
+
+    def record(self, name, milliseconds):
+        self._samples(name).add(milliseconds)
+
+    @contextmanager
+    def stage(self, name):
+        begin = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, (monotonic() - begin) * 1000)
+
+    # Called from the CA thread with the timestamp the pulse was stamped with
+    def recordLatency(self, timestamp):
+        if timestamp:
+            self.record("latency", (time() - timestamp) * 1000)
+
+    def clear(self):
+        for samples in self.stages.values():
+            samples.clear()
+
+    # (name, p50, p99) for every stage that has samples
+    def summary(self):
+        for name, samples in list(self.stages.items()):
+            result = samples.percentiles(50, 99)
+            if result is not None:
+                yield name, result[0], result[1]
+
+    def describe(self, separator=" | "):
+        return separator.join("{} {:.1f}/{:.1f}".format(name, p50, p99)
+                              for name, p50, p99 in self.summary())
@@ -1,4 +1,3 @@
-from numpy import nan
 from pyqtgraph import exporters
 from subprocess import Popen
 from time import sleep
@@ -9,7 +8,11 @@ from re import sub
 from shutil import copy
 
 
-IPK_LIMIT = 12000
+# The (low, high) limits on the values we'll believe from a PV, either of
+# which can be None. Anything outside of them gets cut before any statistics
+# are computed off of the data. The peak current PV gets insane values,
+# apparently
+hardLimits = {"BLEN:LI24:886:BIMAX": (None, 12000)}
 
 
 # IOC:IN20:EV01:RG01_ACTRATE returns one of 7 states, 0 through 6, where
@@ -25,11 +28,6 @@ def setPosAndText(attribute, value, posValX, posValY, textVal):
     attribute.setText(textVal + str(value))
 
 
-def filterBuffers(bufferToFilter, filterFunc, xData, yData):
-    mask = filterFunc(bufferToFilter)
-    return xData[mask], yData[mask]
-
-
 def add_actions(target, actions):
     for action in actions:
         if action is None:
@@ -38,50 +36,6 @@ def add_actions(target, actions):
             target.addAction(action)
 
 
-def padWithNans(dataBuffer, start, end):
-    for idx in xrange(start, end):
-        dataBuffer[idx] = nan
-
-
-############################################################################
-# A function that decides which indices to keep for each buffer. Using k to
-# denote the absolute value of the difference between the buffers, we get:
-#
-# Case 1: numBadShots is negative (buffer A is ahead and has had more
-#         points appended)
-#
-#       Case A: The multiplier for A's indices is 1, so:
-#
-#               max(0, mult * numBadShots) -> max(0, -k) -> 0
-#
-#               min(2800, 2800 + (mult * numBadShots))
-#               -> min(2800, 2800 - k) -> 2800-k
-#
-#               And we get [0, 2800-k] for buffer A
-#
-#       Case B: The multiplier for B's indices is -1, so:
-#
-#               max(0, mult * numBadShots) -> max(0, k) -> k
-#
-#               min(2800, 2800 + (mult * numBadShots))
-#               -> min(2800, 2800 + k) -> 2800
-#
-#               And we get [k, 2800] for buffer B
-#
-# Case 2: Using similar logic, the inverse is true when numBadShots is
-#         positive
-#
-# Side note, the @ is an annotation symbol that tells the interpreter
-# something about the thing it's annotating. In this case, it's telling us
-# that getIndices is a static method, meaning that it doesn't do anything
-# with class variables (i.e. there's no need for a "self" parameter)
-############################################################################
-def getIndices(numBadShots, mult):
-
-    return (max(0, mult * numBadShots),
-            min(2800, 2800 + (mult * numBadShots)))
-
-
 # Shamelessly stolen from Shawn (thanks buddy). A lot of this is probably
 # unnecessary for my purposes but I'm too lazy to clean it up
 def logbook(userText, titleText, textText, plotItem):